@@ -0,0 +1,62 @@
+"""Benchmark: cold query() vs a warm, connected agent.
+
+Needs a real Claude Code CLI and ANTHROPIC_API_KEY. Each turn sends a tiny
+prompt and records the time to the first message and to the ResultMessage.
+The first warm turn includes the connect; later ones reuse the subprocess.
+
+Usage:
+    uv run python benchmarks/agent_start_bench.py [--turns 5]
+"""
+
+import argparse
+import asyncio
+import statistics
+import tempfile
+import time
+
+from claude_agent_sdk import ClaudeAgentOptions, query
+
+from nanoclaw.pool import WarmAgent
+
+_PROMPT = "Reply with the single word OK."
+
+
+async def _prompt_stream(text: str):
+    yield {"type": "user", "message": {"role": "user", "content": text}}
+
+
+async def _timed(messages) -> tuple[float, float]:
+    start = time.perf_counter()
+    first = None
+    async for message in messages:
+        if first is None:
+            first = time.perf_counter() - start
+    return first or 0.0, time.perf_counter() - start
+
+
+def _report(name: str, samples: list[tuple[float, float]]) -> None:
+    firsts = [f * 1000 for f, _ in samples]
+    totals = [t * 1000 for _, t in samples]
+    print(f"{name:<12} first msg p50 {statistics.median(firsts):>7.0f} ms   turn p50 {statistics.median(totals):>7.0f} ms   (n={len(samples)})")
+
+
+async def main(turns: int) -> None:
+    with tempfile.TemporaryDirectory() as cwd:
+        options = ClaudeAgentOptions(cwd=cwd, max_turns=1)
+
+        cold = [await _timed(query(prompt=_prompt_stream(_PROMPT), options=options)) for _ in range(turns)]
+
+        agent = WarmAgent((0, "bench"), options, idle_timeout=300)
+        warm = [await _timed(agent.run(_PROMPT)) for _ in range(turns)]
+        agent.close()
+        await agent.wait_closed()
+
+    _report("cold", cold)
+    _report("warm (1st)", warm[:1])
+    _report("warm (rest)", warm[1:] or warm)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=5)
+    asyncio.run(main(parser.parse_args().turns))
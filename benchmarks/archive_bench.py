@@ -0,0 +1,72 @@
+"""Benchmark: per-message archive cost as today's file grows.
+
+Compares the old read_text + write_text rewrite against the buffered
+append-only ArchiveWriter. Prints the mean per-message cost for each block of
+messages; the rewrite grows with file size, the writer stays flat.
+
+Usage:
+    uv run python benchmarks/archive_bench.py [--messages 5000] [--block 500]
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from pathlib import Path
+
+for _var in ("TELEGRAM_BOT_TOKEN", "OWNER_ID", "ANTHROPIC_API_KEY"):
+    os.environ.setdefault(_var, "0")
+
+from nanoclaw.conversations import ArchiveWriter  # noqa: E402
+
+_ENTRY = "## 12:00:00 UTC\n\n**User**: " + "question " * 20 + "\n\n**Ape**: " + "answer " * 120 + "\n\n---\n\n"
+
+
+def _legacy_append(path: Path) -> None:
+    content = path.read_text(encoding="utf-8") if path.exists() else "# Conversations - 2024-01-01\n\n"
+    content += _ENTRY
+    path.write_text(content, encoding="utf-8")
+
+
+async def _run_legacy(directory: Path, messages: int, block: int) -> list[float]:
+    path = directory / "2024-01-01.md"
+    costs = []
+    for _ in range(messages // block):
+        start = time.perf_counter()
+        for _ in range(block):
+            _legacy_append(path)
+        costs.append((time.perf_counter() - start) / block)
+    return costs
+
+
+async def _run_writer(directory: Path, messages: int, block: int) -> list[float]:
+    writer = ArchiveWriter(directory, flush_interval=0.05, fsync_interval=5)
+    costs = []
+    for _ in range(messages // block):
+        start = time.perf_counter()
+        for _ in range(block):
+            writer.append("2024-01-01", _ENTRY)
+            await asyncio.sleep(0)
+        await writer.flush()
+        costs.append((time.perf_counter() - start) / block)
+    await writer.close()
+    return costs
+
+
+async def main(messages: int, block: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy = await _run_legacy(Path(tmp), messages, block)
+        buffered = await _run_writer(Path(tmp) / "writer", messages, block)
+
+    print(f"{'messages':>10} {'rewrite us/msg':>16} {'append us/msg':>15}")
+    for i, (old, new) in enumerate(zip(legacy, buffered), start=1):
+        print(f"{i * block:>10} {old * 1e6:>16.1f} {new * 1e6:>15.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--block", type=int, default=500)
+    args = parser.parse_args()
+    asyncio.run(main(args.messages, args.block))
@@ -0,0 +1,88 @@
+"""Microbenchmark: per-call aiosqlite.connect() vs the shared WAL connection.
+
+Each "op" is one scheduled run's worth of DB work: get_due_tasks, log_task_run,
+update_task_after_run.
+
+Usage:
+    uv run python benchmarks/db_bench.py [--ops 500]
+"""
+
+import argparse
+import asyncio
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import aiosqlite
+
+from nanoclaw import db
+
+
+async def _legacy_run(db_path: str, task_id: str) -> None:
+    """The old pattern: a fresh connection (and thread) for every call."""
+    now = datetime.now(timezone.utc).isoformat()
+    async with aiosqlite.connect(db_path) as conn:
+        conn.row_factory = aiosqlite.Row
+        cursor = await conn.execute("SELECT * FROM scheduled_tasks WHERE status = 'active' AND next_run <= ?", (now,))
+        await cursor.fetchall()
+    async with aiosqlite.connect(db_path) as conn:
+        await conn.execute(
+            "INSERT INTO task_run_logs (task_id, run_at, duration_ms, status, result, error) VALUES (?, ?, ?, ?, ?, ?)",
+            (task_id, now, 10, "success", "ok", None),
+        )
+        await conn.commit()
+    async with aiosqlite.connect(db_path) as conn:
+        await conn.execute(
+            "UPDATE scheduled_tasks SET last_run = ?, last_result = ?, next_run = ?, status = ? WHERE id = ?",
+            (now, "ok", now, "active", task_id),
+        )
+        await conn.commit()
+
+
+async def _pooled_run(db_path: str, task_id: str) -> None:
+    await db.get_due_tasks(db_path)
+    async with db.transaction(db_path):
+        await db.log_task_run(db_path, task_id, 10, "success", result="ok")
+        await db.update_task_after_run(db_path, task_id, "ok", db.now_ms())
+
+
+async def _bench(name: str, fn, db_path: str, task_id: str, ops: int) -> None:
+    start = time.perf_counter()
+    for _ in range(ops):
+        await fn(db_path, task_id)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<10} {ops / elapsed:>10.1f} ops/sec  ({elapsed * 1000 / ops:.2f} ms/op)")
+
+
+async def main(ops: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = str(Path(tmp) / "legacy.db")
+        pooled_path = str(Path(tmp) / "pooled.db")
+
+        # Legacy DB keeps the default rollback journal for a fair baseline.
+        async with aiosqlite.connect(legacy_path) as conn:
+            await conn.executescript(db._SCHEMA_V1)
+            await conn.commit()
+        legacy_task = "legacy01"
+        async with aiosqlite.connect(legacy_path) as conn:
+            await conn.execute(
+                "INSERT INTO scheduled_tasks (id, chat_id, prompt, schedule_type, schedule_value, next_run, created_at) VALUES (?, 1, 'p', 'interval', '60000', ?, ?)",
+                (legacy_task, "1970", "1970"),
+            )
+            await conn.commit()
+
+        await db.open_db(pooled_path)
+        try:
+            await db.init_db(pooled_path)
+            pooled_task = await db.create_task(pooled_path, 1, "p", "interval", "60000", 0)
+            await _bench("per-call", _legacy_run, legacy_path, legacy_task, ops)
+            await _bench("pooled", _pooled_run, pooled_path, pooled_task, ops)
+        finally:
+            await db.close_db()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ops", type=int, default=500)
+    asyncio.run(main(parser.parse_args().ops))
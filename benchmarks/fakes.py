@@ -0,0 +1,304 @@
+"""Local stand-ins for the Claude SDK and the Telegram bot, for offline benchmarks.
+
+`FakeSDK.install()` replaces `claude_agent_sdk.query`, `ClaudeSDKClient` and
+`create_sdk_mcp_server` with scripted versions. A fake turn sleeps
+`latency` seconds before each assistant message. For every tool call in
+its script it emits a ToolUseBlock, runs nanoclaw's real tool handler and
+emits the ToolResultBlock. Then it streams `text_blocks` TextBlocks and ends
+with a ResultMessage. Install it before nanoclaw.pool is imported, since
+that module binds ClaudeSDKClient at import. Sessions are modelled by
+size: a resumed session's input tokens grow by each turn's prompt and reply
+plus `turn_tokens` (standing in for tool results), and every turn's
+(prompt, input tokens) is kept in `usage_log`.
+
+`FakeBot` implements the few Bot API calls nanoclaw makes and records every
+send and edit, with an optional per-call latency.
+
+`FakeTelegramServer` is the Bot API over HTTP on localhost, for running the
+real python-telegram-bot Application: point TELEGRAM_BASE_URL at `base_url`.
+Updates passed to `push()` are served through getUpdates, or POSTed to the
+webhook once one is set. Every call waits `rtt` seconds, half before and
+half after it is handled, to stand in for the network.
+"""
+
+import asyncio
+import itertools
+import json
+import time
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Callable
+from urllib.parse import parse_qsl
+
+import claude_agent_sdk
+import httpx
+from claude_agent_sdk import AssistantMessage, ResultMessage, TextBlock, ToolResultBlock, ToolUseBlock, UserMessage
+
+ToolCall = tuple[str, dict[str, Any]]
+
+
+class FakeSDK:
+    def __init__(
+        self, latency: float = 0.05, text_blocks: int = 3, script: Callable[[str], list[ToolCall]] | None = None, cost_usd: float = 0.01, turn_tokens: int = 0
+    ) -> None:
+        self.latency = latency
+        self.text_blocks = text_blocks
+        self.script = script or (lambda prompt: [])
+        self.cost_usd = cost_usd
+        self.turn_tokens = turn_tokens
+        self.turns = 0
+        self.tool_calls = 0
+        self.usage_log: list[tuple[str, int]] = []
+        self._session_tokens: dict[str, int] = {}
+        self._ids = itertools.count(1)
+
+    def install(self) -> None:
+        sdk = self
+
+        def create_sdk_mcp_server(name: str, version: str = "1.0.0", tools: list | None = None) -> dict:
+            return {"type": "sdk", "name": name, "tools": {t.name: t for t in tools or []}}
+
+        async def query(*, prompt, options=None, **kwargs) -> AsyncIterator[Any]:
+            text = prompt if isinstance(prompt, str) else "".join([m["message"]["content"] async for m in prompt])
+            async for message in sdk.turn(text, options, getattr(options, "resume", None)):
+                yield message
+
+        class ClaudeSDKClient:
+            def __init__(self, options=None, **kwargs) -> None:
+                self.options = options
+                self.session_id = getattr(options, "resume", None) or f"fake-session-{next(sdk._ids)}"
+                self._prompt = ""
+
+            async def connect(self, prompt=None) -> None:
+                await asyncio.sleep(sdk.latency)
+
+            async def query(self, prompt: str, session_id: str = "default") -> None:
+                self._prompt = prompt
+
+            def receive_response(self) -> AsyncIterator[Any]:
+                return sdk.turn(self._prompt, self.options, self.session_id)
+
+            async def get_mcp_status(self) -> dict:
+                return {"mcpServers": [{"name": name, "status": "connected"} for name in (getattr(self.options, "mcp_servers", None) or {})]}
+
+            async def disconnect(self) -> None:
+                pass
+
+        claude_agent_sdk.create_sdk_mcp_server = create_sdk_mcp_server
+        claude_agent_sdk.query = query
+        claude_agent_sdk.ClaudeSDKClient = ClaudeSDKClient
+
+    async def turn(self, prompt: str, options, session_id: str | None = None) -> AsyncIterator[Any]:
+        start = time.perf_counter()
+        session_id = session_id or f"fake-session-{next(self._ids)}"
+        input_tokens = 100 + self._session_tokens.get(session_id, 0) + len(prompt) // 4
+        tools = {}
+        for server in (getattr(options, "mcp_servers", None) or {}).values():
+            tools.update(server.get("tools", {}))
+        for name, args in self.script(prompt):
+            await asyncio.sleep(self.latency)
+            tool_id = f"toolu_{next(self._ids)}"
+            yield AssistantMessage(content=[ToolUseBlock(id=tool_id, name=f"mcp__nanoclaw__{name}", input=args)], model="fake")
+            result = await tools[name].handler(args)
+            self.tool_calls += 1
+            yield UserMessage(content=[ToolResultBlock(tool_use_id=tool_id, content=result["content"], is_error=result.get("is_error"))])
+        for i in range(self.text_blocks):
+            await asyncio.sleep(self.latency)
+            yield AssistantMessage(content=[TextBlock(text=f"Part {i + 1} of the reply to: {prompt[:40]}\n")], model="fake")
+        self.turns += 1
+        self._session_tokens[session_id] = input_tokens - 100 + 20 * self.text_blocks + self.turn_tokens
+        self.usage_log.append((prompt, input_tokens))
+        yield ResultMessage(
+            subtype="success",
+            duration_ms=int((time.perf_counter() - start) * 1000),
+            duration_api_ms=0,
+            is_error=False,
+            num_turns=1,
+            session_id=session_id,
+            total_cost_usd=self.cost_usd,
+            usage={"input_tokens": input_tokens, "output_tokens": 20 * self.text_blocks},
+        )
+
+
+@dataclass
+class FakeChat:
+    id: int
+
+
+@dataclass
+class FakeUser:
+    id: int
+
+
+class FakeMessage:
+    def __init__(self, bot: "FakeBot", chat_id: int, text: str, message_id: int) -> None:
+        self.bot = bot
+        self.chat_id = chat_id
+        self.text = text
+        self.message_id = message_id
+
+    async def reply_text(self, text: str, **kwargs) -> "FakeMessage":
+        return await self.bot.send_message(chat_id=self.chat_id, text=text)
+
+    async def edit_text(self, text: str, **kwargs) -> "FakeMessage":
+        await asyncio.sleep(self.bot.latency)
+        self.text = text
+        self.bot.edits.append((self.chat_id, text))
+        return self
+
+
+@dataclass
+class FakeUpdate:
+    effective_user: FakeUser
+    effective_chat: FakeChat
+    message: FakeMessage
+
+
+@dataclass
+class FakeContext:
+    bot: "FakeBot"
+    args: list[str] = field(default_factory=list)
+
+
+class FakeBot:
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.sent: list[tuple[int, str]] = []
+        self.edits: list[tuple[int, str]] = []
+        self._ids = itertools.count(1)
+
+    async def send_message(self, chat_id: int, text: str, **kwargs) -> FakeMessage:
+        await asyncio.sleep(self.latency)
+        self.sent.append((chat_id, text))
+        return FakeMessage(self, chat_id, text, next(self._ids))
+
+    async def send_chat_action(self, chat_id: int, action: str, **kwargs) -> bool:
+        return True
+
+    def update(self, user_id: int, chat_id: int, text: str) -> FakeUpdate:
+        """An incoming text message, as _handle_message receives it."""
+        return FakeUpdate(FakeUser(user_id), FakeChat(chat_id), FakeMessage(self, chat_id, text, next(self._ids)))
+
+
+class FakeTelegramServer:
+    def __init__(self, token: str, rtt: float = 0.0, webhook_workers: int = 40) -> None:
+        self.token = token
+        self.rtt = rtt
+        self.webhook_workers = webhook_workers
+        self.base_url = ""
+        self.pushed_at: dict[int, float] = {}
+        # First call per chat of any kind, and first sendMessage per chat.
+        self.first_call_at: dict[int, float] = {}
+        self.first_send_at: dict[int, float] = {}
+        self.calls: dict[str, int] = {}
+        self.webhook_url: str | None = None
+        self._secret = ""
+        self._updates: list[dict] = []
+        self._new_update = asyncio.Condition()
+        self._deliveries: asyncio.Queue[dict] = asyncio.Queue()
+        self._workers: list[asyncio.Task] = []
+        self._server: asyncio.Server | None = None
+        self._ids = itertools.count(1)
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+        port = self._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}/bot"
+
+    async def stop(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        if self._server is not None:
+            self._server.close()
+
+    def push(self, user_id: int, chat_id: int, text: str) -> None:
+        """Telegram receives a message from `user_id` in `chat_id`."""
+        update_id = next(self._ids)
+        self.pushed_at[chat_id] = time.perf_counter()
+        update = {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "user"},
+                "text": text,
+            },
+        }
+        if self.webhook_url:
+            self._deliveries.put_nowait(update)
+        else:
+            self._updates.append(update)
+            asyncio.create_task(self._notify())
+
+    async def _notify(self) -> None:
+        async with self._new_update:
+            self._new_update.notify_all()
+
+    async def _deliver(self) -> None:
+        # Like Telegram, each connection carries one update at a time.
+        async with httpx.AsyncClient(timeout=30) as client:
+            while True:
+                update = await self._deliveries.get()
+                await asyncio.sleep(self.rtt / 2)
+                response = await client.post(self.webhook_url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": self._secret})
+                if response.status_code != 200:
+                    raise RuntimeError(f"webhook answered {response.status_code}")
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while request_line := await reader.readline():
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode().partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length") or 0))
+                method = request_line.decode().split()[1].rsplit("/", 1)[-1]
+                if "json" in headers.get("content-type", ""):
+                    params = json.loads(body or b"{}")
+                else:
+                    params = dict(parse_qsl(body.decode()))
+                await asyncio.sleep(self.rtt / 2)
+                result = await self._call(method, params)
+                await asyncio.sleep(self.rtt / 2)
+                payload = json.dumps({"ok": True, "result": result}).encode()
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n%s" % (len(payload), payload))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def _call(self, method: str, params: dict) -> Any:
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if "chat_id" in params:
+            chat_id = int(params["chat_id"])
+            self.first_call_at.setdefault(chat_id, time.perf_counter())
+            if method == "sendMessage":
+                self.first_send_at.setdefault(chat_id, time.perf_counter())
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "fake", "username": "fake_bot"}
+        if method == "getUpdates":
+            return await self._get_updates(int(params.get("offset") or 0), float(params.get("timeout") or 0))
+        if method == "setWebhook":
+            self.webhook_url, self._secret = params["url"], params.get("secret_token", "")
+            self._workers = [asyncio.create_task(self._deliver()) for _ in range(self.webhook_workers)]
+            return True
+        if method in ("sendMessage", "editMessageText"):
+            return {
+                "message_id": int(params.get("message_id") or next(self._ids)),
+                "date": int(time.time()),
+                "chat": {"id": int(params["chat_id"]), "type": "private"},
+                "text": params.get("text", ""),
+            }
+        return True
+
+    async def _get_updates(self, offset: int, timeout: float) -> list[dict]:
+        self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates and timeout:
+            async with self._new_update:
+                try:
+                    await asyncio.wait_for(self._new_update.wait(), timeout)
+                except TimeoutError:
+                    pass
+        return self._updates[:100]
@@ -0,0 +1,81 @@
+"""Benchmark: size of CLAUDE.md (loaded into every turn) as memories accumulate.
+
+Simulates an agent learning a few facts a day, a third of them updates to
+facts it already knew. "free-form" is the old approach, where every fact is
+kept as a line in CLAUDE.md. "store" is the memory store, where CLAUDE.md
+only carries the budgeted summary. Token counts are estimated at 4 chars per
+token.
+
+Usage:
+    uv run python benchmarks/memory_bench.py [--days 365] [--per-day 5]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import tempfile
+import time
+
+_BASE_DIR = tempfile.mkdtemp(prefix="nanoclaw-memory-bench-")
+os.environ["NANOCLAW_BASE_DIR"] = _BASE_DIR
+for _var in ("TELEGRAM_BOT_TOKEN", "OWNER_ID", "ANTHROPIC_API_KEY"):
+    os.environ.setdefault(_var, "0")
+
+from nanoclaw import db, memory  # noqa: E402
+from nanoclaw.config import DB_PATH, MEMORY_SUMMARY_CHARS, STORE_DIR, WORKSPACE_DIR  # noqa: E402
+
+_CHAT_ID = 1
+_TOPICS = "diet work family travel health music coding finance garden reading sport car".split()
+_CHECKPOINTS = (1, 7, 30, 90, 180, 365)
+
+
+def _fact(rng: random.Random, n: int) -> str:
+    topic = rng.choice(_TOPICS)
+    return f"User mentioned that their {topic} plans changed: " + " ".join(rng.choice(_TOPICS) for _ in range(n))
+
+
+async def main(days: int, per_day: int) -> None:
+    rng = random.Random(0)
+    STORE_DIR.mkdir(parents=True, exist_ok=True)
+    memory.ensure_workspace()
+    claude_md = WORKSPACE_DIR / "CLAUDE.md"
+    db_path = str(DB_PATH)
+    await db.open_db(db_path)
+    try:
+        await db.init_db(db_path)
+        free_form: dict[str, str] = {}
+        refresh_times = []
+        print(f"summary budget {MEMORY_SUMMARY_CHARS} chars\n")
+        print(f"{'day':>5} {'memories':>9} {'free-form tok':>14} {'store tok':>10} {'refresh ms':>11}")
+        for day in range(1, days + 1):
+            for _ in range(per_day):
+                if free_form and rng.random() < 0.33:
+                    key = rng.choice(list(free_form))
+                else:
+                    key = f"fact-{len(free_form) + 1}"
+                content = _fact(rng, rng.randint(8, 30))
+                free_form[key] = content
+                await db.upsert_memory(db_path, _CHAT_ID, key, content, [rng.choice(_TOPICS)], pinned=rng.random() < 0.02)
+                start = time.perf_counter()
+                await memory.refresh_memory_summary(db_path, _CHAT_ID)
+                refresh_times.append(time.perf_counter() - start)
+
+            if day in _CHECKPOINTS or day == days:
+                template = len(memory._INITIAL_CLAUDE_MD)
+                old_chars = template + sum(len(f"- {k}: {v}\n") for k, v in free_form.items())
+                new_chars = len(claude_md.read_text())
+                recent_ms = sum(refresh_times[-per_day:]) / per_day * 1000
+                print(f"{day:>5} {len(free_form):>9} {old_chars // 4:>14} {new_chars // 4:>10} {recent_ms:>11.2f}")
+    finally:
+        await db.close_db()
+        shutil.rmtree(_BASE_DIR, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--per-day", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(main(args.days, args.per_day))
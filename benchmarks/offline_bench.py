@@ -0,0 +1,202 @@
+"""Benchmark: nanoclaw's hot paths against a fake Claude SDK and a fake bot.
+
+Runs without API keys or network, in a throwaway NANOCLAW_BASE_DIR (see
+fakes.py for the stand-ins). Scenarios:
+
+    chat     --chats chats, each sending --messages messages through
+             bot._handle_message (debounce, agent turn, streaming reply,
+             archive), in bursts of --burst sent --burst-gap seconds apart;
+             latency is message sent -> the turn that answered it done
+    tasks    --tasks one-off tasks falling due at once, through the scheduler's
+             timer, leases and executor; latency is due time -> run recorded
+    archive  --archive-ops archive_exchange calls, --archive-concurrency at a time
+
+Every fake turn runs --tool-calls real nanoclaw tools (send_message for tasks,
+search_conversations for chat) and streams --text-blocks text blocks,
+sleeping --latency seconds before each message. Telegram rate limits default
+to 1000/s so the numbers reflect nanoclaw rather than the outbox's pacing;
+set TELEGRAM_CHAT_RATE / TELEGRAM_GLOBAL_RATE to measure with them.
+
+Prints one JSON object: throughput and p50/p99 latency per scenario.
+
+Usage:
+    uv run python benchmarks/offline_bench.py [--scenarios chat,tasks,archive] [--out results.json]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from fakes import FakeBot, FakeContext, FakeSDK
+
+_OWNER_ID = 1
+_SCENARIOS = ("chat", "tasks", "archive")
+
+
+def _percentile(sorted_values: list[float], q: float) -> float:
+    return sorted_values[max(1, math.ceil(q * len(sorted_values))) - 1] if sorted_values else 0.0
+
+
+def _summary(latencies: list[float], seconds: float, **extra) -> dict:
+    ms = sorted(x * 1000 for x in latencies)
+    return {
+        "ops": len(ms),
+        "seconds": round(seconds, 3),
+        "throughput_per_s": round(len(ms) / seconds, 2) if seconds else 0.0,
+        "p50_ms": round(_percentile(ms, 0.50), 2),
+        "p99_ms": round(_percentile(ms, 0.99), 2),
+        "max_ms": round(ms[-1], 2) if ms else 0.0,
+        **extra,
+    }
+
+
+async def _chat(args, bot: FakeBot, sdk: FakeSDK) -> dict:
+    from nanoclaw import bot as nanoclaw_bot
+
+    context = FakeContext(bot)
+    latencies: list[float] = []
+
+    async def one_chat(chat_id: int) -> None:
+        for first in range(0, args.messages, args.burst):
+            sent_at = []
+            for i in range(first, min(first + args.burst, args.messages)):
+                if sent_at:
+                    await asyncio.sleep(args.burst_gap)
+                sent_at.append(time.perf_counter())
+                await nanoclaw_bot._handle_message(bot.update(_OWNER_ID, chat_id, f"message {i} from chat {chat_id}: what did we talk about?"), context)
+            while (inbox := nanoclaw_bot._inboxes.get(chat_id)) is not None:
+                await inbox.worker
+            latencies.extend(time.perf_counter() - t for t in sent_at)
+
+    sends_before, turns_before = len(bot.sent), sdk.turns
+    start = time.perf_counter()
+    await asyncio.gather(*(one_chat(1000 + c) for c in range(args.chats)))
+    return _summary(latencies, time.perf_counter() - start, agent_turns=sdk.turns - turns_before, sends=len(bot.sent) - sends_before, edits=len(bot.edits))
+
+
+async def _tasks(args, bot: FakeBot, db_path: str) -> dict:
+    from nanoclaw import db, scheduler
+
+    done = asyncio.Event()
+    latencies: list[float] = []
+    execute = scheduler._execute_task
+
+    async def timed_execute(task: dict, *a, **kw) -> None:
+        await execute(task, *a, **kw)
+        latencies.append((db.now_ms() - task["next_run"]) / 1000)
+        if len(latencies) == args.tasks:
+            done.set()
+
+    scheduler._execute_task = timed_execute
+    scheduler.setup_scheduler(bot, db_path).start()
+    sends_before = len(bot.sent)
+    start = time.perf_counter()
+    due = datetime.now(timezone.utc)
+    for i in range(args.tasks):
+        await db.create_task(db_path, 2000 + i % max(1, args.chats), f"benchmark task {i}", "once", due.isoformat(), db.to_epoch_ms(due))
+    await asyncio.wait_for(done.wait(), timeout=args.timeout)
+    seconds = time.perf_counter() - start
+    await scheduler.stop_scheduler()
+    return _summary(latencies, seconds, sends=len(bot.sent) - sends_before)
+
+
+async def _archive(args) -> dict:
+    from nanoclaw.conversations import archive_exchange, close_archive
+
+    semaphore = asyncio.Semaphore(args.archive_concurrency)
+    latencies: list[float] = []
+
+    async def one(i: int) -> None:
+        async with semaphore:
+            start = time.perf_counter()
+            await archive_exchange(f"question {i} about the garden", f"answer {i}: water the tomatoes every morning", 3000 + i % 10)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(args.archive_ops)))
+    await close_archive()
+    return _summary(latencies, time.perf_counter() - start)
+
+
+async def main(args, sdk: FakeSDK) -> dict:
+    # Everything nanoclaw reads at import time must be in place before the first import.
+    from nanoclaw import db, memory
+    from nanoclaw import bot as nanoclaw_bot
+    from nanoclaw.config import DATA_DIR, DB_PATH, STORE_DIR, WORKSPACE_DIR
+
+    for d in (WORKSPACE_DIR, STORE_DIR, DATA_DIR):
+        d.mkdir(parents=True, exist_ok=True)
+    db_path = str(DB_PATH)
+    await db.open_db(db_path)
+    await db.init_db(db_path)
+    memory.ensure_workspace()
+
+    bot = FakeBot(args.bot_latency)
+    results: dict = {}
+    try:
+        for scenario in args.scenarios:
+            if scenario == "chat":
+                results["chat"] = await _chat(args, bot, sdk)
+            elif scenario == "tasks":
+                results["tasks"] = await _tasks(args, bot, db_path)
+            elif scenario == "archive":
+                results["archive"] = await _archive(args)
+    finally:
+        await nanoclaw_bot._post_shutdown(SimpleNamespace(bot_data={}))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(_SCENARIOS), help="comma-separated subset of: " + ", ".join(_SCENARIOS))
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=8, help="messages per chat")
+    parser.add_argument("--burst", type=int, default=4, help="messages per burst")
+    parser.add_argument("--burst-gap", type=float, default=0.3, help="seconds between messages in a burst")
+    parser.add_argument("--tasks", type=int, default=50)
+    parser.add_argument("--archive-ops", type=int, default=2000)
+    parser.add_argument("--archive-concurrency", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.05, help="fake model seconds per assistant message")
+    parser.add_argument("--text-blocks", type=int, default=3)
+    parser.add_argument("--tool-calls", type=int, default=1)
+    parser.add_argument("--bot-latency", type=float, default=0.0, help="fake Bot API seconds per call")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--out", help="also write the JSON here")
+    args = parser.parse_args()
+    args.scenarios = [s for s in args.scenarios.split(",") if s]
+    if unknown := set(args.scenarios) - set(_SCENARIOS):
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    base_dir = tempfile.mkdtemp(prefix="nanoclaw-offline-bench-")
+    os.environ["NANOCLAW_BASE_DIR"] = base_dir
+    os.environ["OWNER_ID"] = str(_OWNER_ID)
+    for var, value in (("TELEGRAM_BOT_TOKEN", "0"), ("ANTHROPIC_API_KEY", "0"), ("TELEGRAM_CHAT_RATE", "1000"), ("TELEGRAM_GLOBAL_RATE", "1000")):
+        os.environ.setdefault(var, value)
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+
+    def script(prompt: str) -> list:
+        if prompt.startswith("You are executing a scheduled task"):
+            return [("send_message", {"text": "Reminder: " + prompt[-40:]})] * args.tool_calls
+        return [("search_conversations", {"query": "garden"})] * args.tool_calls
+
+    sdk = FakeSDK(args.latency, args.text_blocks, script)
+    sdk.install()
+    try:
+        results = asyncio.run(main(args, sdk))
+    finally:
+        shutil.rmtree(base_dir, ignore_errors=True)
+    config = {k: v for k, v in vars(args).items() if k != "out"}
+    report = json.dumps({"config": config, "results": results}, indent=2)
+    print(report)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(report + "\n")
@@ -0,0 +1,92 @@
+"""Benchmark: FTS5 conversation search vs a Grep scan over a synthetic year.
+
+Writes 365 daily archive files, indexes them, then times a few queries both
+ways and reports latency and how many bytes each returns (a proxy for the
+tokens the agent has to read).
+
+Usage:
+    uv run python benchmarks/search_bench.py [--days 365] [--per-day 40]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+from datetime import date, timedelta
+from pathlib import Path
+
+for _var in ("TELEGRAM_BOT_TOKEN", "OWNER_ID", "ANTHROPIC_API_KEY"):
+    os.environ.setdefault(_var, "0")
+
+from nanoclaw import db  # noqa: E402
+from nanoclaw.conversations import parse_archive  # noqa: E402
+
+_WORDS = "python deploy weather invoice meeting travel budget server backup garden recipe music report schedule kernel docker lunch flight".split()
+_QUERIES = ["weather", "docker backup", "flight invoice", "kernel recipe garden"]
+
+
+def _sentence(rng: random.Random, n: int) -> str:
+    return " ".join(rng.choice(_WORDS) for _ in range(n))
+
+
+def _write_year(directory: Path, days: int, per_day: int) -> None:
+    rng = random.Random(0)
+    start = date(2024, 1, 1)
+    for d in range(days):
+        day = (start + timedelta(days=d)).isoformat()
+        parts = [f"# Conversations - {day}\n\n"]
+        for i in range(per_day):
+            parts.append(f"## {i // 60:02d}:{i % 60:02d}:00 UTC\n\n**User**: {_sentence(rng, 15)}\n\n**Ape**: {_sentence(rng, 80)}\n\n---\n\n")
+        (directory / f"{day}.md").write_text("".join(parts), encoding="utf-8")
+
+
+def _grep(directory: Path, query: str) -> bytes:
+    pattern = query.split()[0]
+    if shutil.which("rg"):
+        cmd = ["rg", "-i", "-n", pattern, str(directory)]
+    else:
+        cmd = ["grep", "-r", "-i", "-n", pattern, str(directory)]
+    return subprocess.run(cmd, capture_output=True, check=False).stdout
+
+
+async def main(days: int, per_day: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        archive = Path(tmp) / "conversations"
+        archive.mkdir()
+        db_path = str(Path(tmp) / "bench.db")
+        _write_year(archive, days, per_day)
+
+        await db.open_db(db_path)
+        try:
+            await db.init_db(db_path)
+            start = time.perf_counter()
+            for path in sorted(archive.glob("*.md")):
+                await db.index_exchanges(db_path, [(path.stem, t, None, u, a) for t, u, a in parse_archive(path)])
+            print(f"indexed {days * per_day} exchanges in {time.perf_counter() - start:.2f}s\n")
+
+            print(f"{'query':<24} {'grep ms':>9} {'grep KB':>9} {'fts ms':>8} {'fts KB':>8}")
+            for query in _QUERIES:
+                start = time.perf_counter()
+                grep_out = _grep(archive, query)
+                grep_ms = (time.perf_counter() - start) * 1000
+
+                start = time.perf_counter()
+                hits = await db.search_conversations(db_path, query)
+                fts_ms = (time.perf_counter() - start) * 1000
+                fts_bytes = sum(len(h["user_snippet"]) + len(h["assistant_snippet"]) + 20 for h in hits)
+
+                print(f"{query:<24} {grep_ms:>9.1f} {len(grep_out) / 1024:>9.1f} {fts_ms:>8.1f} {fts_bytes / 1024:>8.1f}")
+        finally:
+            await db.close_db()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--per-day", type=int, default=40)
+    args = parser.parse_args()
+    asyncio.run(main(args.days, args.per_day))
@@ -0,0 +1,104 @@
+"""Benchmark: input tokens per chat turn with and without session compaction.
+
+Drives --turns turns of one chat through agent.run_agent against the fake
+Claude SDK (fakes.FakeSDK), whose resumed sessions grow by --turn-tokens
+per turn. Runs once with compaction off and once with --max-tokens /
+--max-turns, and prints input tokens per chat turn (mean, p50, max, and
+mean over the last --tail turns) plus the total including the summary
+turns compaction adds.
+
+Usage:
+    uv run python benchmarks/session_bench.py [--turns 300] [--turn-tokens 1500] [--max-tokens 60000]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import shutil
+import sys
+import tempfile
+
+from fakes import FakeBot, FakeSDK
+
+_OWNER_ID = 1
+
+
+def _percentile(sorted_values: list[int], q: float) -> int:
+    return sorted_values[max(1, math.ceil(q * len(sorted_values))) - 1] if sorted_values else 0
+
+
+async def _run(args, sdk: FakeSDK, chat_id: int, max_tokens: int, max_turns: int) -> dict:
+    from nanoclaw import agent
+    from nanoclaw.config import DB_PATH
+
+    agent.SESSION_MAX_TOKENS, agent.SESSION_MAX_TURNS = max_tokens, max_turns
+    bot = FakeBot()
+    first = len(sdk.usage_log)
+    for i in range(args.turns):
+        await agent.run_agent(f"message {i}: what's next on my list?", bot, chat_id, str(DB_PATH))
+    log = sdk.usage_log[first:]
+    chat = [tokens for prompt, tokens in log if prompt != agent._COMPACT_PROMPT]
+    tail = chat[-args.tail :]
+    return {
+        "chat_turns": len(chat),
+        "compactions": len(log) - len(chat),
+        "mean_tokens_per_turn": round(sum(chat) / len(chat)),
+        "p50_tokens_per_turn": _percentile(sorted(chat), 0.5),
+        "max_tokens_per_turn": max(chat),
+        "tail_mean_tokens_per_turn": round(sum(tail) / len(tail)),
+        "total_input_tokens": sum(tokens for _, tokens in log),
+    }
+
+
+async def main(args, sdk: FakeSDK) -> dict:
+    from nanoclaw import db, memory
+    from nanoclaw.agent import close_agents
+    from nanoclaw.config import DATA_DIR, DB_PATH, STORE_DIR, WORKSPACE_DIR
+
+    for d in (WORKSPACE_DIR, STORE_DIR, DATA_DIR):
+        d.mkdir(parents=True, exist_ok=True)
+    await db.open_db(str(DB_PATH))
+    await db.init_db(str(DB_PATH))
+    memory.ensure_workspace()
+    try:
+        return {
+            "off": await _run(args, sdk, 1001, 0, 0),
+            "on": await _run(args, sdk, 1002, args.max_tokens, args.max_turns),
+        }
+    finally:
+        await close_agents()
+        await db.close_db()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=300)
+    parser.add_argument("--turn-tokens", type=int, default=1500, help="tokens each turn adds to its session besides prompt and reply")
+    parser.add_argument("--max-tokens", type=int, default=60000, help="SESSION_MAX_TOKENS for the compacted run")
+    parser.add_argument("--max-turns", type=int, default=0, help="SESSION_MAX_TURNS for the compacted run")
+    parser.add_argument("--tail", type=int, default=50, help="turns at the end to average separately")
+    parser.add_argument("--out", help="also write the JSON here")
+    args = parser.parse_args()
+
+    base_dir = tempfile.mkdtemp(prefix="nanoclaw-session-bench-")
+    os.environ["NANOCLAW_BASE_DIR"] = base_dir
+    os.environ["OWNER_ID"] = str(_OWNER_ID)
+    for var, value in (("TELEGRAM_BOT_TOKEN", "0"), ("ANTHROPIC_API_KEY", "0")):
+        os.environ.setdefault(var, value)
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+
+    sdk = FakeSDK(latency=0, text_blocks=3, turn_tokens=args.turn_tokens)
+    sdk.install()
+    try:
+        results = asyncio.run(main(args, sdk))
+    finally:
+        shutil.rmtree(base_dir, ignore_errors=True)
+    config = {k: v for k, v in vars(args).items() if k != "out"}
+    report = json.dumps({"config": config, "results": results}, indent=2)
+    print(report)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(report + "\n")
@@ -0,0 +1,100 @@
+"""Benchmark: import time and time to first Telegram poll.
+
+Import time is measured in fresh interpreters for `nanoclaw.bot` as the bot
+imports it, and again with claude_agent_sdk imported eagerly (what startup
+used to pay). Time to first poll starts `python -m nanoclaw` against a fake
+Bot API server (TELEGRAM_BASE_URL) in a throwaway NANOCLAW_BASE_DIR and
+measures spawn -> first getUpdates request.
+
+Usage:
+    uv run python benchmarks/startup_bench.py [--runs 5]
+"""
+
+import argparse
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_ENV = {"TELEGRAM_BOT_TOKEN": "1:bench", "OWNER_ID": "1", "ANTHROPIC_API_KEY": "bench", "METRICS_PORT": "0"}
+_IMPORT_SNIPPET = "import sys, time; t = time.perf_counter(); {imports}; print(time.perf_counter() - t, 'claude_agent_sdk' in sys.modules)"
+
+
+def _import_time(imports: str) -> tuple[float, bool]:
+    out = subprocess.run(
+        [sys.executable, "-c", _IMPORT_SNIPPET.format(imports=imports)], env={**os.environ, **_ENV}, capture_output=True, text=True, check=True
+    ).stdout.split()
+    return float(out[0]), out[1] == "True"
+
+
+class _FakeBotAPI(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    first_poll = threading.Event()
+
+    def do_POST(self) -> None:
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        method = self.path.rsplit("/", 1)[-1]
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method == "getUpdates":
+            _FakeBotAPI.first_poll.set()
+            result = []
+        else:
+            result = True
+        body = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+def _time_to_first_poll(base_url: str) -> float:
+    _FakeBotAPI.first_poll.clear()
+    with tempfile.TemporaryDirectory() as base_dir:
+        env = {**os.environ, **_ENV, "TELEGRAM_BASE_URL": base_url, "NANOCLAW_BASE_DIR": base_dir}
+        start = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, "-m", "nanoclaw"], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            if not _FakeBotAPI.first_poll.wait(timeout=60):
+                raise RuntimeError("bot never polled")
+            return time.perf_counter() - start
+        finally:
+            proc.send_signal(signal.SIGINT)
+            proc.wait(timeout=30)
+
+
+def _report(name: str, samples: list[float]) -> None:
+    ms = [s * 1000 for s in samples]
+    print(f"{name:<32} p50 {statistics.median(ms):>7.0f} ms   min {min(ms):>7.0f} ms   (n={len(ms)})")
+
+
+def main(runs: int) -> None:
+    lazy = [_import_time("import nanoclaw.__main__, nanoclaw.bot") for _ in range(runs)]
+    eager = [_import_time("import nanoclaw.__main__, nanoclaw.bot, claude_agent_sdk") for _ in range(runs)]
+    _report("import (sdk deferred)", [t for t, _ in lazy])
+    _report("import (sdk eager)", [t for t, _ in eager])
+    print(f"{'claude_agent_sdk loaded at start':<32} {lazy[0][1]}")
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _FakeBotAPI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        base_url = f"http://127.0.0.1:{server.server_address[1]}/bot"
+        _report("spawn -> first getUpdates", [_time_to_first_poll(base_url) for _ in range(runs)])
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    main(parser.parse_args().runs)
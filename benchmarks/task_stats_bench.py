@@ -0,0 +1,97 @@
+"""Benchmark: task listing, run history and stats queries over a large run log.
+
+Fills a throwaway DB with `--tasks` tasks spread over `--chats` chats and
+`--runs` run-log rows, then times each query with the current indexes and
+again with only the old single-column index on task_run_logs(task_id).
+
+Usage:
+    uv run python benchmarks/task_stats_bench.py [--runs 1000000] [--tasks 200] [--chats 10]
+"""
+
+import argparse
+import asyncio
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import aiosqlite
+
+from nanoclaw import db
+
+_REPEAT = 20
+
+
+async def _fill(db_path: str, runs: int, tasks: int, chats: int) -> list[tuple[str, int]]:
+    rng = random.Random(0)
+    now = datetime.now(timezone.utc)
+    task_rows = [(f"t{i:07d}", i % chats + 1) for i in range(tasks)]
+    async with aiosqlite.connect(db_path) as conn:
+        await conn.executemany(
+            "INSERT INTO scheduled_tasks (id, chat_id, prompt, schedule_type, schedule_value, next_run, last_result, created_at) "
+            "VALUES (?, ?, ?, 'interval', '60000', ?, ?, ?)",
+            [(task_id, chat_id, "p" * 500, db.to_epoch_ms(now), "r" * 4000, now.isoformat()) for task_id, chat_id in task_rows],
+        )
+        span = timedelta(days=60).total_seconds()
+        await conn.executemany(
+            "INSERT INTO task_run_logs (task_id, run_at, duration_ms, status, result) VALUES (?, ?, ?, ?, 'ok')",
+            (
+                (
+                    rng.choice(task_rows)[0],
+                    (now - timedelta(seconds=rng.random() * span)).isoformat(),
+                    int(rng.lognormvariate(7, 0.8)),
+                    "error" if rng.random() < 0.05 else "success",
+                )
+                for _ in range(runs)
+            ),
+        )
+        await conn.commit()
+    return task_rows
+
+
+async def _time(name: str, fn) -> None:
+    start = time.perf_counter()
+    for _ in range(_REPEAT):
+        await fn()
+    print(f"  {name:<26} {(time.perf_counter() - start) * 1000 / _REPEAT:>9.2f} ms")
+
+
+async def _run_queries(db_path: str, task_id: str, chat_id: int) -> None:
+    since = (datetime.now(timezone.utc) - timedelta(days=7)).isoformat()
+    await _time("list_tasks (chat, page 1)", lambda: db.list_tasks(db_path, chat_id, "active"))
+    await _time("get_task_runs (20)", lambda: db.get_task_runs(db_path, task_id, chat_id))
+    await _time("get_task_stats (task, 7d)", lambda: db.get_task_stats(db_path, since, chat_id, task_id))
+    await _time("get_task_stats (chat, 7d)", lambda: db.get_task_stats(db_path, since, chat_id))
+
+
+async def main(runs: int, tasks: int, chats: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = str(Path(tmp) / "bench.db")
+        await db.init_db(db_path)
+        print(f"filling {runs} runs over {tasks} tasks...")
+        task_rows = await _fill(db_path, runs, tasks, chats)
+        task_id, chat_id = task_rows[0]
+
+        await db.open_db(db_path)
+        try:
+            print("current indexes:")
+            await _run_queries(db_path, task_id, chat_id)
+            async with aiosqlite.connect(db_path) as conn:
+                await conn.executescript(
+                    "DROP INDEX idx_task_run_logs_task_run_at; DROP INDEX idx_scheduled_tasks_chat;"
+                    "CREATE INDEX idx_task_run_logs_task_id ON task_run_logs(task_id);"
+                )
+            print("old indexes:")
+            await _run_queries(db_path, task_id, chat_id)
+        finally:
+            await db.close_db()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=1_000_000)
+    parser.add_argument("--tasks", type=int, default=200)
+    parser.add_argument("--chats", type=int, default=10)
+    args = parser.parse_args()
+    asyncio.run(main(args.runs, args.tasks, args.chats))
@@ -0,0 +1,81 @@
+"""Benchmark: peak memory and stored size of a long agent run's output.
+
+Simulates a run streaming --blocks TextBlocks of --block-chars characters,
+whose ResultMessage.result repeats the last block (as the SDK does). "join"
+is the old approach: every block and the result kept in a list and joined.
+"collector" is TranscriptCollector with the chat budget. Peak memory is
+measured with tracemalloc; "kept" is the size of the string handed on to the
+archive and run log.
+
+Usage:
+    uv run python benchmarks/transcript_bench.py [--blocks 2000] [--block-chars 2000]
+"""
+
+import argparse
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+_BASE_DIR = tempfile.mkdtemp(prefix="nanoclaw-transcript-bench-")
+os.environ["NANOCLAW_BASE_DIR"] = _BASE_DIR
+for _var in ("TELEGRAM_BOT_TOKEN", "OWNER_ID", "ANTHROPIC_API_KEY"):
+    os.environ.setdefault(_var, "0")
+
+from nanoclaw.config import TRANSCRIPT_MAX_CHARS  # noqa: E402
+from nanoclaw.transcript import TranscriptCollector  # noqa: E402
+
+
+def _blocks(count: int, chars: int):
+    for i in range(count):
+        yield (f"block {i} " * chars)[:chars]
+
+
+def _join(count: int, chars: int) -> str:
+    parts = []
+    last = ""
+    for last in _blocks(count, chars):
+        parts.append(last)
+    parts.append(last)
+    return "".join(parts)
+
+
+def _collector(count: int, chars: int) -> str:
+    async def run() -> str:
+        transcript = TranscriptCollector(TRANSCRIPT_MAX_CHARS)
+        last = ""
+        for last in _blocks(count, chars):
+            await transcript.add(last)
+        await transcript.add_result(last)
+        return await transcript.finish()
+
+    return asyncio.run(run())
+
+
+def _measure(name: str, fn, count: int, chars: int) -> None:
+    tracemalloc.start()
+    start = time.perf_counter()
+    kept = fn(count, chars)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<10} peak {peak / 1e6:>8.1f} MB   kept {len(kept):>11,} chars   {elapsed * 1000:>8.1f} ms")
+
+
+def main(count: int, chars: int) -> None:
+    print(f"{count} blocks x {chars} chars = {count * chars:,} chars streamed, budget {TRANSCRIPT_MAX_CHARS:,}\n")
+    try:
+        _measure("join", _join, count, chars)
+        _measure("collector", _collector, count, chars)
+    finally:
+        shutil.rmtree(_BASE_DIR, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--blocks", type=int, default=2000)
+    parser.add_argument("--block-chars", type=int, default=2000)
+    args = parser.parse_args()
+    main(args.blocks, args.block_chars)
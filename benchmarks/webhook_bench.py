@@ -0,0 +1,156 @@
+"""Benchmark: update ingestion by webhook vs long polling.
+
+Runs the real python-telegram-bot Application against a local fake Bot API
+(fakes.FakeTelegramServer) and a fake Claude SDK, once with long polling and
+once with the webhook server. --messages messages, each from its own chat,
+arrive at --rate per second (0 = all at once). Every Bot API call and webhook
+delivery costs --rtt seconds of simulated network round trip.
+
+Reported per mode:
+    ingest   message sent -> the bot's first API call for that chat
+    reply    message sent -> the bot's first sendMessage for that chat
+and throughput = messages / time until the last chat got its reply.
+
+Usage:
+    uv run python benchmarks/webhook_bench.py [--messages 200] [--rate 100] [--rtt 0.05]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+from fakes import FakeSDK, FakeTelegramServer
+
+_OWNER_ID = 1
+_TOKEN = "123:fake"
+
+
+def _percentile(sorted_values: list[float], q: float) -> float:
+    return sorted_values[max(1, math.ceil(q * len(sorted_values))) - 1] if sorted_values else 0.0
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def _run_mode(mode: str, args, telegram: FakeTelegramServer) -> dict:
+    from nanoclaw import bot as nanoclaw_bot
+    from nanoclaw.__main__ import _prepare_runtime
+    from nanoclaw.webhook import run_webhook
+
+    app = nanoclaw_bot.setup_bot(prepare=_prepare_runtime)
+    stop = asyncio.Event()
+    if mode == "webhook":
+        runner = asyncio.create_task(run_webhook(app, stop))
+        while telegram.webhook_url is None:
+            await asyncio.sleep(0.01)
+    else:
+        await app.initialize()
+        await app.post_init(app)
+        await app.updater.start_polling(poll_interval=0.0, timeout=10)
+        await app.start()
+
+    chats = [10_000 * (mode == "webhook") + 1000 + i for i in range(args.messages)]
+    start = time.perf_counter()
+    for chat_id in chats:
+        telegram.push(_OWNER_ID, chat_id, f"hello from chat {chat_id}")
+        if args.rate:
+            await asyncio.sleep(1 / args.rate)
+    while not all(c in telegram.first_send_at for c in chats):
+        if time.perf_counter() - start > args.timeout:
+            raise TimeoutError(f"{mode}: {sum(c in telegram.first_send_at for c in chats)}/{len(chats)} chats answered")
+        await asyncio.sleep(0.01)
+    seconds = max(telegram.first_send_at[c] for c in chats) - start
+
+    if mode == "webhook":
+        stop.set()
+        await runner
+    else:
+        await app.updater.stop()
+        await app.stop()
+        await app.shutdown()
+        await app.post_shutdown(app)
+
+    def summary(done_at: dict[int, float]) -> dict:
+        ms = sorted((done_at[c] - telegram.pushed_at[c]) * 1000 for c in chats)
+        return {"p50_ms": round(_percentile(ms, 0.5), 2), "p99_ms": round(_percentile(ms, 0.99), 2), "max_ms": round(ms[-1], 2)}
+
+    return {
+        "messages": len(chats),
+        "seconds": round(seconds, 3),
+        "throughput_per_s": round(len(chats) / seconds, 2),
+        "ingest": summary(telegram.first_call_at),
+        "reply": summary(telegram.first_send_at),
+    }
+
+
+async def main(args) -> dict:
+    telegram = FakeTelegramServer(_TOKEN, args.rtt, args.webhook_connections)
+    await telegram.start()
+    # nanoclaw reads its config at import, so the fake's address must be set first.
+    os.environ["TELEGRAM_BASE_URL"] = telegram.base_url
+    port = _free_port()
+    os.environ["WEBHOOK_URL"] = f"http://127.0.0.1:{port}/telegram"
+    os.environ["WEBHOOK_PORT"] = str(port)
+    try:
+        results = {}
+        for mode in ("polling", "webhook"):
+            results[mode] = await _run_mode(mode, args, telegram)
+            results[mode]["bot_api_calls"] = dict(telegram.calls)
+            telegram.calls.clear()
+        return results
+    finally:
+        await telegram.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=100, help="messages per second (0 = all at once)")
+    parser.add_argument("--rtt", type=float, default=0.05, help="simulated network round trip, seconds")
+    parser.add_argument("--webhook-connections", type=int, default=40)
+    parser.add_argument("--latency", type=float, default=0.05, help="fake model seconds per assistant message")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--out", help="also write the JSON here")
+    args = parser.parse_args()
+
+    base_dir = tempfile.mkdtemp(prefix="nanoclaw-webhook-bench-")
+    os.environ["NANOCLAW_BASE_DIR"] = base_dir
+    os.environ["OWNER_ID"] = str(_OWNER_ID)
+    os.environ["TELEGRAM_BOT_TOKEN"] = _TOKEN
+    for var, value in (
+        ("ANTHROPIC_API_KEY", "0"),
+        ("WEBHOOK_SECRET", "bench-secret"),
+        ("WEBHOOK_HOST", "127.0.0.1"),
+        ("WEBHOOK_MAX_CONNECTIONS", str(args.webhook_connections)),
+        ("MESSAGE_DEBOUNCE", "0"),
+        ("MAX_CONCURRENT_AGENTS", "1000"),
+        ("METRICS_PORT", "0"),
+        ("TELEGRAM_CHAT_RATE", "1000"),
+        ("TELEGRAM_GLOBAL_RATE", "1000"),
+    ):
+        os.environ.setdefault(var, value)
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+
+    sdk = FakeSDK(args.latency, text_blocks=1)
+    sdk.install()
+    try:
+        results = asyncio.run(main(args))
+    finally:
+        shutil.rmtree(base_dir, ignore_errors=True)
+    config = {k: v for k, v in vars(args).items() if k != "out"}
+    report = json.dumps({"config": config, "results": results}, indent=2)
+    print(report)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(report + "\n")
@@ -1,10 +1,11 @@
+import argparse
 import asyncio
 import logging
 
-from nanoclaw.bot import setup_bot
-from nanoclaw.config import ASSISTANT_NAME, DATA_DIR, DB_PATH, STORE_DIR, WORKSPACE_DIR
-from nanoclaw.db import init_db
-from nanoclaw.memory import ensure_workspace
+from nanoclaw.config import ASSISTANT_NAME, DATA_DIR, DB_MAX_OPEN, DB_PATH, OWNER_ID, STORE_DIR, WEBHOOK_URL, WORKSPACE_DIR, get_chat_db
+from nanoclaw.db import close_db, init_db, open_db
+from nanoclaw.memory import ensure_workspace, migrate_claude_md
+from nanoclaw.transcript import remove_stale_spills
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
@@ -18,23 +19,55 @@ async def _prepare_runtime() -> None:
     for d in (WORKSPACE_DIR, STORE_DIR, DATA_DIR):
         d.mkdir(parents=True, exist_ok=True)
 
-    # Initialize database
+    # Open the shared connection and initialize database
+    await open_db(str(DB_PATH), max_open=DB_MAX_OPEN)
     await init_db(str(DB_PATH))
     logger.info("Database initialized at %s", DB_PATH)
 
     # Ensure CLAUDE.md exists
     ensure_workspace()
+    # The shared workspace predates MULTI_CHAT, so its old facts are the owner's.
+    await migrate_claude_md(WORKSPACE_DIR, str(get_chat_db(OWNER_ID)), OWNER_ID)
     logger.info("Workspace ready at %s", WORKSPACE_DIR)
 
+    if removed := remove_stale_spills():
+        logger.info("Removed %d spill files left by unfinished runs", removed)
+
 
 def _run_bot() -> None:
-    app = setup_bot()
+    # Imported here so `reindex` doesn't pay for telegram and the scheduler.
+    from nanoclaw.bot import setup_bot
+
+    # Runtime prep and close_db run in the app's post_init/post_shutdown,
+    # on the bot's loop, instead of in separate asyncio.run() loops.
+    app = setup_bot(prepare=_prepare_runtime)
     logger.info("%s is starting...", ASSISTANT_NAME)
-    app.run_polling()
+    if WEBHOOK_URL:
+        from nanoclaw.webhook import run_webhook
+
+        asyncio.run(run_webhook(app))
+    else:
+        app.run_polling()
+
+
+async def _reindex() -> None:
+    from nanoclaw.conversations import reindex_conversations
+
+    await _prepare_runtime()
+    try:
+        count = await reindex_conversations(str(DB_PATH))
+        logger.info("Indexed %d archived exchanges", count)
+    finally:
+        await close_db()
 
 
 def main() -> None:
-    asyncio.run(_prepare_runtime())
+    parser = argparse.ArgumentParser(prog="nanoclaw")
+    parser.add_argument("command", nargs="?", choices=["run", "reindex"], default="run", help="run the bot (default) or rebuild the conversation search index")
+    if parser.parse_args().command == "reindex":
+        asyncio.run(_reindex())
+        return
+
     _run_bot()
 
 
@@ -1,117 +1,413 @@
 import asyncio
+import functools
 import json
 import logging
+import time
+import weakref
+from contextlib import AsyncExitStack, asynccontextmanager
 from datetime import datetime, timedelta, timezone
-from typing import Any, AsyncGenerator
-
-from claude_agent_sdk import (
-    AssistantMessage,
-    ClaudeAgentOptions,
-    ResultMessage,
-    TextBlock,
-    create_sdk_mcp_server,
-    query,
-    tool,
-)
+from typing import TYPE_CHECKING, Any, AsyncGenerator, AsyncIterator, Awaitable, Callable
+
 from croniter import croniter
 
-from nanoclaw import db
+from nanoclaw import db, memory, metrics, outbox, response_cache, task_reports, tracing
+from nanoclaw.transcript import TranscriptCollector
 from nanoclaw.config import (
+    AGENT_IDLE_TIMEOUT,
+    AGENT_PING_TIMEOUT,
+    AGENT_POOL_SIZE,
     ANTHROPIC_API_KEY,
     ANTHROPIC_BASE_URL,
     DATA_DIR,
+    DB_PATH,
+    MAX_CONCURRENT_AGENTS,
+    OWNER_ID,
+    MULTI_CHAT,
+    RUN_LOG_MAX_RESULT_CHARS,
+    SESSION_MAX_TOKENS,
+    SESSION_MAX_TURNS,
     STATE_FILE,
-    WORKSPACE_DIR,
+    TRANSCRIPT_MAX_CHARS,
+    get_chat_db,
 )
 
+# claude_agent_sdk takes over a second to import, so it (and the pool built
+# on it) is imported on the first agent turn rather than at bot startup.
+if TYPE_CHECKING:
+    from claude_agent_sdk import ClaudeAgentOptions
+
+    from nanoclaw.pool import AgentPool
+
 logger = logging.getLogger(__name__)
-_agent_lock = asyncio.Lock()
 
+# Turns within one chat run in order; different chats run in parallel, bounded
+# by a global cap on Claude SDK subprocesses (shared with scheduled tasks).
+_chat_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+_agent_semaphore = asyncio.Semaphore(MAX_CONCURRENT_AGENTS)
+_waiting_agents = 0
+_active_agents = 0
+
+metrics.Gauge("nanoclaw_agents_active", "Agent turns currently running", lambda: _active_agents)
+metrics.Gauge("nanoclaw_agents_waiting", "Agent turns waiting for a chat lock or slot", lambda: _waiting_agents)
+
+# Interactive turns reuse a connected CLI per chat (see pool.py). Scheduled
+# tasks must start from a clean context, so they keep using one-shot query().
+_pool: "AgentPool | None" = None
+metrics.Gauge("nanoclaw_agents_warm", "Connected warm agents", lambda: _pool.stats()["warm"] if _pool else 0)
+
+_SEARCH_LIMIT = 10
+_SEARCH_MAX_CHARS = 4000
+_RECALL_LIMIT = 10
+_TASK_PAGE_SIZE = 20
+
+# Session compaction: when a chat's session grows past SESSION_MAX_TOKENS
+# (input tokens of its last turn) or SESSION_MAX_TURNS, the session is asked
+# for a summary, which is saved as a memory; the next turn then starts a new
+# session with the summary in front of the user's message.
+_COMPACT_PROMPT = (
+    "This conversation is about to be restarted to keep it small. Write a summary of it for your future self: "
+    "who the user is and what they prefer, what we worked on and decided, open questions and pending work, "
+    "and any names, paths, numbers or links still needed. At most 400 words. Reply with the summary only."
+)
+_COMPACT_MEMORY_KEY = "session-summary"
+_COMPACT_MAX_CHARS = 4000
+
+
+def _get_pool() -> "AgentPool":
+    global _pool
+    if _pool is None:
+        from nanoclaw.pool import AgentPool
+
+        _pool = AgentPool(AGENT_POOL_SIZE, AGENT_IDLE_TIMEOUT, AGENT_PING_TIMEOUT)
+    return _pool
+
+
+def agent_stats() -> dict[str, int]:
+    """Agents currently running and waiting for a chat lock or a free slot."""
+    warm = _pool.stats()["warm"] if _pool else 0
+    return {"active": _active_agents, "waiting": _waiting_agents, "max": MAX_CONCURRENT_AGENTS, "warm": warm}
+
+
+@asynccontextmanager
+async def _agent_slot(chat_id: int, ordered: bool = True) -> AsyncIterator[None]:
+    """Hold the chat's lock (when `ordered`) and one global agent slot."""
+    global _waiting_agents, _active_agents
+    start = time.monotonic()
+    async with AsyncExitStack() as stack:
+        _waiting_agents += 1
+        try:
+            if ordered:
+                lock = _chat_locks.get(chat_id)
+                if lock is None:
+                    lock = _chat_locks[chat_id] = asyncio.Lock()
+                await stack.enter_async_context(lock)
+            await stack.enter_async_context(_agent_semaphore)
+        finally:
+            _waiting_agents -= 1
+
+        waited = time.monotonic() - start
+        metrics.AGENT_WAIT.observe(waited, kind="chat" if ordered else "task")
+        tracing.set_attr("wait_ms", round(waited * 1000, 1))
+        _active_agents += 1
+        if _pool is not None:
+            # Idle warm agents are CLI subprocesses too: keep them plus running turns within the cap.
+            _pool.trim(MAX_CONCURRENT_AGENTS - _active_agents, keep=(chat_id, "chat") if ordered else None)
+        logger.log(
+            logging.INFO if waited >= 1 else logging.DEBUG,
+            "Agent for chat %s started after %.2fs wait (%d active, %d waiting)",
+            chat_id,
+            waited,
+            _active_agents,
+            _waiting_agents,
+        )
+        try:
+            yield
+        finally:
+            _active_agents -= 1
+
+
+def _timed_tool(name: str, handler: Callable[[dict[str, Any]], Awaitable[dict[str, Any]]]) -> Callable[[dict[str, Any]], Awaitable[dict[str, Any]]]:
+    """Time a tool handler in the MCP_TOOL histogram and as an "mcp.<name>" span of the current trace."""
+
+    @functools.wraps(handler)
+    async def wrapper(args: dict[str, Any]) -> dict[str, Any]:
+        with metrics.MCP_TOOL.time(tool=name), tracing.span(f"mcp.{name}"):
+            return await handler(args)
+
+    return wrapper
+
+
+def _create_tools(bot: Any, chat_id: int, db_path: str, notify_state: dict[str, Any] | None = None) -> list:
+    from claude_agent_sdk import tool
+
+    # Tasks live in the main DB; memories and the conversation index in the chat's DB (a shard with DB_SHARDING).
+    chat_db = str(get_chat_db(chat_id))
 
-def _create_tools(bot: Any, chat_id: int, db_path: str, notify_state: dict[str, bool] | None = None) -> list:
     @tool("send_message", "Send a message to the user on Telegram", {"text": str})
     async def send_message(args: dict[str, Any]) -> dict[str, Any]:
-        await bot.send_message(chat_id=chat_id, text=args["text"])
+        await outbox.send(bot, chat_id, args["text"])
         if notify_state is not None:
             notify_state["sent"] = True
+            notify_state.setdefault("messages", []).append(args["text"])
         return {"content": [{"type": "text", "text": "Message sent."}]}
 
     @tool(
         "schedule_task",
-        "Schedule a task. schedule_type: 'cron', 'interval', or 'once'. schedule_value: cron expression, milliseconds, or ISO timestamp.",
-        {"prompt": str, "schedule_type": str, "schedule_value": str},
+        "Schedule a task. schedule_type: 'cron', 'interval', or 'once'. schedule_value: cron expression, milliseconds, or ISO 8601 timestamp "
+        "(UTC unless it has an offset, e.g. 2025-06-01T09:00:00+08:00). "
+        "misfire_policy says what to do with runs missed while the bot was down: 'skip' them, run 'once' (default), or replay 'all' (up to misfire_max). "
+        "For read-only prompts, cache_ttl (seconds) reuses the last result while the prompt and cache_inputs (workspace file paths or URLs) are unchanged.",
+        {
+            "type": "object",
+            "properties": {
+                "prompt": {"type": "string"},
+                "schedule_type": {"type": "string", "enum": ["cron", "interval", "once"]},
+                "schedule_value": {"type": "string"},
+                "misfire_policy": {"type": "string", "enum": list(db.MISFIRE_POLICIES)},
+                "misfire_max": {"type": "integer", "minimum": 1},
+                "cache_ttl": {"type": "integer", "minimum": 1},
+                "cache_inputs": {"type": "array", "items": {"type": "string"}},
+            },
+            "required": ["prompt", "schedule_type", "schedule_value"],
+        },
     )
     async def schedule_task(args: dict[str, Any]) -> dict[str, Any]:
         stype = args["schedule_type"]
         svalue = args["schedule_value"]
+        policy = args.get("misfire_policy") or "once"
+        misfire_max = int(args.get("misfire_max") or 10)
+        cache_ttl = int(args["cache_ttl"]) if args.get("cache_ttl") else None
+        cache_inputs = list(args.get("cache_inputs") or [])
         now = datetime.now(timezone.utc)
 
-        if stype == "cron":
-            next_run = croniter(svalue, now).get_next(datetime).isoformat()
-        elif stype == "interval":
-            next_run = (now + timedelta(milliseconds=int(svalue))).isoformat()
-        elif stype == "once":
-            next_run = svalue
-        else:
+        if policy not in db.MISFIRE_POLICIES or misfire_max < 1:
             return {
-                "content": [{"type": "text", "text": f"Unknown schedule_type: {stype}"}],
+                "content": [{"type": "text", "text": f"Invalid misfire settings: {policy}/{misfire_max}"}],
                 "is_error": True,
             }
 
-        task_id = await db.create_task(db_path, chat_id, args["prompt"], stype, svalue, next_run)
+        try:
+            if stype == "cron":
+                next_run = croniter(svalue, now).get_next(datetime)
+            elif stype == "interval":
+                if int(svalue) <= 0:
+                    raise ValueError("interval must be a positive number of milliseconds")
+                next_run = now + timedelta(milliseconds=int(svalue))
+            elif stype == "once":
+                next_run = db.parse_timestamp(svalue)
+                if next_run <= now:
+                    raise ValueError(f"{next_run.isoformat()} is in the past")
+                svalue = next_run.isoformat()
+            else:
+                return {
+                    "content": [{"type": "text", "text": f"Unknown schedule_type: {stype}"}],
+                    "is_error": True,
+                }
+        except ValueError as e:
+            return {
+                "content": [{"type": "text", "text": f"Invalid {stype} schedule_value {svalue!r}: {e}"}],
+                "is_error": True,
+            }
+
+        task_id = await db.create_task(db_path, chat_id, args["prompt"], stype, svalue, db.to_epoch_ms(next_run), policy, misfire_max, cache_ttl, cache_inputs)
         return {
             "content": [
                 {
                     "type": "text",
-                    "text": f"Task {task_id} scheduled. Next run: {next_run}",
+                    "text": f"Task {task_id} scheduled. Next run: {next_run.isoformat()}",
                 }
             ]
         }
 
-    @tool("list_tasks", "List all scheduled tasks", {})
+    @tool(
+        "list_tasks",
+        f"List scheduled tasks, {_TASK_PAGE_SIZE} per page, optionally only those with a status (active, paused, completed)",
+        {"type": "object", "properties": {"status": {"type": "string"}, "page": {"type": "integer", "minimum": 1}}},
+    )
     async def list_tasks(args: dict[str, Any]) -> dict[str, Any]:
-        tasks = await db.get_all_tasks(db_path)
+        page = max(1, int(args.get("page") or 1))
+        tasks, total = await db.list_tasks(db_path, chat_id, args.get("status") or None, limit=_TASK_PAGE_SIZE, offset=(page - 1) * _TASK_PAGE_SIZE)
         if not tasks:
-            return {"content": [{"type": "text", "text": "No scheduled tasks."}]}
-        lines = [f"- [{t['id']}] {t['status']} | {t['schedule_type']}({t['schedule_value']}) | {t['prompt'][:60]}" for t in tasks]
+            return {"content": [{"type": "text", "text": "No scheduled tasks." if page == 1 else f"No tasks on page {page} ({total} in total)."}]}
+        lines = []
+        for t in tasks:
+            cache = f" cache={t['cache_ttl']}s" if t["cache_ttl"] else ""
+            lines.append(f"- [{t['id']}] {t['status']} | {t['schedule_type']}({t['schedule_value']}) misfire={t['misfire_policy']}{cache} | {t['prompt']}")
+        pages = -(-total // _TASK_PAGE_SIZE)
+        if pages > 1:
+            lines.append(f"Page {page} of {pages} ({total} tasks)")
+        if any(t["cache_ttl"] for t in tasks):
+            stats = await response_cache.cache_stats()
+            lines.append(f"Response cache: {stats['entries']} entries, {stats['hits']} hits, ${stats['saved_usd']:.4f} saved")
         return {"content": [{"type": "text", "text": "\n".join(lines)}]}
 
+    @tool(
+        "task_stats",
+        "Run counts, error rates and duration percentiles per task (or for one task) over the last few days",
+        {"type": "object", "properties": {"task_id": {"type": "string"}, "days": {"type": "integer", "minimum": 1}}},
+    )
+    async def task_stats(args: dict[str, Any]) -> dict[str, Any]:
+        text = await task_reports.task_stats_text(db_path, chat_id, args.get("task_id") or None, int(args.get("days") or 7))
+        return {"content": [{"type": "text", "text": text[:_SEARCH_MAX_CHARS]}]}
+
+    @tool(
+        "task_history",
+        "Recent runs of a task, newest first. Pass the returned `before` value to page further back.",
+        {
+            "type": "object",
+            "properties": {"task_id": {"type": "string"}, "limit": {"type": "integer", "minimum": 1}, "before": {"type": "string"}},
+            "required": ["task_id"],
+        },
+    )
+    async def task_history(args: dict[str, Any]) -> dict[str, Any]:
+        text = await task_reports.task_history_text(db_path, chat_id, args["task_id"], int(args.get("limit") or 20), args.get("before") or None)
+        return {"content": [{"type": "text", "text": text[:_SEARCH_MAX_CHARS]}]}
+
     @tool("pause_task", "Pause a scheduled task", {"task_id": str})
     async def pause_task(args: dict[str, Any]) -> dict[str, Any]:
-        ok = await db.update_task_status(db_path, args["task_id"], "paused")
+        ok = await db.update_task_status(db_path, args["task_id"], "paused", chat_id)
         msg = f"Task {args['task_id']} paused." if ok else f"Task {args['task_id']} not found."
         return {"content": [{"type": "text", "text": msg}]}
 
     @tool("resume_task", "Resume a paused task", {"task_id": str})
     async def resume_task(args: dict[str, Any]) -> dict[str, Any]:
-        ok = await db.update_task_status(db_path, args["task_id"], "active")
+        ok = await db.update_task_status(db_path, args["task_id"], "active", chat_id)
         msg = f"Task {args['task_id']} resumed." if ok else f"Task {args['task_id']} not found."
         return {"content": [{"type": "text", "text": msg}]}
 
     @tool("cancel_task", "Cancel and delete a scheduled task", {"task_id": str})
     async def cancel_task(args: dict[str, Any]) -> dict[str, Any]:
-        ok = await db.delete_task(db_path, args["task_id"])
+        ok = await db.delete_task(db_path, args["task_id"], chat_id)
         msg = f"Task {args['task_id']} cancelled." if ok else f"Task {args['task_id']} not found."
         return {"content": [{"type": "text", "text": msg}]}
 
-    return [send_message, schedule_task, list_tasks, pause_task, resume_task, cancel_task]
+    @tool("search_conversations", "Full-text search past conversations. Returns the best matches with dates.", {"query": str})
+    async def search_conversations(args: dict[str, Any]) -> dict[str, Any]:
+        hits = await db.search_conversations(chat_db, args["query"], limit=_SEARCH_LIMIT, chat_id=chat_id if MULTI_CHAT else None)
+        if not hits:
+            return {"content": [{"type": "text", "text": "No matching conversations."}]}
+        lines = [f"- [{h['day']} {h['time']}] User: {h['user_snippet']} | Assistant: {h['assistant_snippet']}" for h in hits]
+        return {"content": [{"type": "text", "text": "\n".join(lines)[:_SEARCH_MAX_CHARS]}]}
 
+    @tool(
+        "remember",
+        "Save a memory under a short key, or replace the one already under that key. Pinned memories are always shown in CLAUDE.md.",
+        {
+            "type": "object",
+            "properties": {
+                "key": {"type": "string"},
+                "content": {"type": "string"},
+                "tags": {"type": "array", "items": {"type": "string"}},
+                "pinned": {"type": "boolean"},
+            },
+            "required": ["key", "content"],
+        },
+    )
+    async def remember(args: dict[str, Any]) -> dict[str, Any]:
+        key = args["key"].strip()
+        if not key:
+            return {"content": [{"type": "text", "text": "Memory key must not be empty."}], "is_error": True}
+        created = await db.upsert_memory(chat_db, chat_id, key, args["content"], args.get("tags") or [], bool(args.get("pinned")))
+        await memory.refresh_memory_summary(chat_db, chat_id)
+        return {"content": [{"type": "text", "text": f"Memory '{key}' {'saved' if created else 'updated'}."}]}
+
+    @tool(
+        "recall",
+        "Look up memories by key, full-text query and/or tag. With no arguments, returns the most recently updated ones.",
+        {
+            "type": "object",
+            "properties": {"key": {"type": "string"}, "query": {"type": "string"}, "tag": {"type": "string"}},
+        },
+    )
+    async def recall(args: dict[str, Any]) -> dict[str, Any]:
+        if args.get("key"):
+            found = await db.get_memory(chat_db, chat_id, args["key"].strip())
+            memories = [found] if found else []
+        else:
+            memories = await db.search_memories(chat_db, chat_id, args.get("query") or "", args.get("tag") or "", limit=_RECALL_LIMIT)
+        if not memories:
+            return {"content": [{"type": "text", "text": "No matching memories."}]}
+        lines = [f"- {m['key']} [{m['tags']}] (updated {m['updated_at'][:10]}): {m['content']}" for m in memories]
+        return {"content": [{"type": "text", "text": "\n".join(lines)[:_SEARCH_MAX_CHARS]}]}
+
+    @tool("forget", "Delete the memory stored under a key", {"key": str})
+    async def forget(args: dict[str, Any]) -> dict[str, Any]:
+        ok = await db.delete_memory(chat_db, chat_id, args["key"].strip())
+        if ok:
+            await memory.refresh_memory_summary(chat_db, chat_id)
+        msg = f"Memory '{args['key']}' deleted." if ok else f"Memory '{args['key']}' not found."
+        return {"content": [{"type": "text", "text": msg}]}
+
+    tools = [send_message, schedule_task, list_tasks, task_stats, task_history, pause_task, resume_task, cancel_task, search_conversations, remember, recall, forget]
+    for t in tools:
+        t.handler = _timed_tool(t.name, t.handler)
+    return tools
 
-def _load_session_id() -> str | None:
-    if STATE_FILE.exists():
-        data = json.loads(STATE_FILE.read_text())
-        return data.get("session_id")
-    return None
 
+def _load_state() -> dict:
+    if not STATE_FILE.exists():
+        return {"sessions": {}, "session_usage": {}}
+    data = json.loads(STATE_FILE.read_text())
+    sessions = data.setdefault("sessions", {})
+    # Older state files held one global session; it belonged to the owner's chat.
+    if "session_id" in data:
+        sessions.setdefault(str(OWNER_ID), data.pop("session_id"))
+    data.setdefault("session_usage", {})
+    return data
 
-def _save_session_id(session_id: str) -> None:
+
+def _save_state(state: dict) -> None:
     DATA_DIR.mkdir(parents=True, exist_ok=True)
-    STATE_FILE.write_text(json.dumps({"session_id": session_id}))
+    STATE_FILE.write_text(json.dumps(state))
+
+
+def _load_session_id(chat_id: int) -> str | None:
+    return _load_state()["sessions"].get(str(chat_id))
+
+
+def _turn_tokens(usage: dict | None) -> int:
+    """Input tokens a turn sent, cached or not: how big the session's context has grown."""
+    usage = usage or {}
+    return sum(usage.get(k) or 0 for k in ("input_tokens", "cache_read_input_tokens", "cache_creation_input_tokens"))
+
+
+def _record_turn(chat_id: int, session_id: str, tokens: int) -> None:
+    """Save the chat's session after a turn, with the turn count and size compaction looks at."""
+    state = _load_state()
+    state["sessions"][str(chat_id)] = session_id
+    usage = state["session_usage"].setdefault(str(chat_id), {"turns": 0, "tokens": 0})
+    usage["turns"] += 1
+    usage["tokens"] = tokens
+    if (before := usage.pop("compacted_from", None)) is not None:
+        logger.info("Chat %s restarted from a summary: %d -> %d input tokens per turn", chat_id, before, tokens)
+    _save_state(state)
+    metrics.SESSION_TURN_TOKENS.observe(tokens)
+
+
+def _compaction_reason(chat_id: int) -> str | None:
+    """Why the chat's session should be compacted before its next turn, if it should."""
+    state = _load_state()
+    usage = state["session_usage"].get(str(chat_id))
+    if usage is None or str(chat_id) not in state["sessions"]:
+        return None
+    if SESSION_MAX_TOKENS > 0 and usage["tokens"] >= SESSION_MAX_TOKENS:
+        return "tokens"
+    if SESSION_MAX_TURNS > 0 and usage["turns"] >= SESSION_MAX_TURNS:
+        return "turns"
+    return None
 
 
-def clear_session_id() -> None:
-    if STATE_FILE.exists():
-        STATE_FILE.unlink()
+def clear_session_id(chat_id: int, compacted_from: int | None = None) -> None:
+    """Forget the chat's session so its next turn starts a new one."""
+    if _pool is not None:
+        _pool.discard((chat_id, "chat"))
+    state = _load_state()
+    changed = state["sessions"].pop(str(chat_id), None) is not None
+    changed = state["session_usage"].pop(str(chat_id), None) is not None or changed
+    if compacted_from is not None:
+        state["session_usage"][str(chat_id)] = {"turns": 0, "tokens": 0, "compacted_from": compacted_from}
+    if changed or compacted_from is not None:
+        _save_state(state)
 
 
 async def _make_prompt(text: str) -> AsyncGenerator[dict, None]:
@@ -119,23 +415,18 @@ async def _make_prompt(text: str) -> AsyncGenerator[dict, None]:
     yield {"type": "user", "message": {"role": "user", "content": text}}
 
 
-async def run_agent(prompt: str, bot: Any, chat_id: int, db_path: str) -> str:
-    async with _agent_lock:
-        return await _run_agent_inner(prompt, bot, chat_id, db_path)
-
+def _build_options(bot: Any, chat_id: int, db_path: str, notify_state: dict[str, Any] | None = None, resume: str | None = None) -> "ClaudeAgentOptions":
+    from claude_agent_sdk import ClaudeAgentOptions, create_sdk_mcp_server
 
-async def _run_agent_inner(prompt: str, bot: Any, chat_id: int, db_path: str) -> str:
-    tools = _create_tools(bot, chat_id, db_path)
+    tools = _create_tools(bot, chat_id, db_path, notify_state)
     mcp_server = create_sdk_mcp_server(name="nanoclaw", tools=tools)
 
-    session_id = _load_session_id()
-
     env = {"ANTHROPIC_API_KEY": ANTHROPIC_API_KEY}
     if ANTHROPIC_BASE_URL:
         env["ANTHROPIC_BASE_URL"] = ANTHROPIC_BASE_URL
 
     options = ClaudeAgentOptions(
-        cwd=str(WORKSPACE_DIR),
+        cwd=str(memory.ensure_workspace(chat_id)),
         setting_sources=["project"],
         allowed_tools=[
             "Bash",
@@ -149,85 +440,195 @@ async def _run_agent_inner(prompt: str, bot: Any, chat_id: int, db_path: str) ->
             "mcp__nanoclaw__send_message",
             "mcp__nanoclaw__schedule_task",
             "mcp__nanoclaw__list_tasks",
+            "mcp__nanoclaw__task_stats",
+            "mcp__nanoclaw__task_history",
             "mcp__nanoclaw__pause_task",
             "mcp__nanoclaw__resume_task",
             "mcp__nanoclaw__cancel_task",
+            "mcp__nanoclaw__search_conversations",
+            "mcp__nanoclaw__remember",
+            "mcp__nanoclaw__recall",
+            "mcp__nanoclaw__forget",
         ],
         permission_mode="bypassPermissions",
         mcp_servers={"nanoclaw": mcp_server},
         env=env,
     )
-    if session_id:
-        options.resume = session_id
+    if resume:
+        options.resume = resume
+    return options
+
+
+async def close_agents() -> None:
+    """Disconnect every warm agent. Call on shutdown."""
+    if _pool is not None:
+        await _pool.close()
+
+
+async def run_agent(prompt: str, bot: Any, chat_id: int, db_path: str, on_text: Callable[[str], Awaitable[None]] | None = None) -> tuple[str, str]:
+    """Run one interactive turn. `on_text` is awaited with each TextBlock as it arrives.
+
+    Returns the full reply for the user, and the same reply capped at
+    TRANSCRIPT_MAX_CHARS (with a blob reference past that) for the archive.
+    """
+    with tracing.turn("chat", chat_id):
+        async with _agent_slot(chat_id):
+            with metrics.AGENT_TURN.time(kind="chat"):
+                return await _run_agent_inner(prompt, bot, chat_id, db_path, on_text)
+
+
+async def _traced(messages: AsyncIterator[Any]) -> AsyncIterator[Any]:
+    """Pass `messages` through, adding spans for the wait for the first one and for each tool call.
+
+    A tool call's span runs from its ToolUseBlock to the ToolResultBlock with
+    the same id, so it covers built-in tools (Bash, WebFetch, ...) as well as
+    nanoclaw's own.
+    """
+    from claude_agent_sdk import AssistantMessage, ToolResultBlock, ToolUseBlock, UserMessage
+
+    start = time.perf_counter()
+    first = True
+    pending: dict[str, tuple[str, float]] = {}
+    async for message in messages:
+        now = time.perf_counter()
+        if first:
+            tracing.add_span("sdk.first_message", start, now)
+            first = False
+        if isinstance(message, AssistantMessage):
+            for block in message.content:
+                if isinstance(block, ToolUseBlock):
+                    pending[block.id] = (block.name, now)
+        elif isinstance(message, UserMessage) and isinstance(message.content, list):
+            for block in message.content:
+                if isinstance(block, ToolResultBlock) and (use := pending.pop(block.tool_use_id, None)) is not None:
+                    tracing.add_span(f"tool:{use[0]}", use[1], now, error=bool(block.is_error))
+        yield message
+
+
+async def _chat_messages(prompt: str, bot: Any, chat_id: int, db_path: str) -> AsyncIterator[Any]:
+    """Run `prompt` in the chat's session, on its warm agent when pooling is on."""
+    from claude_agent_sdk import query
+
+    if AGENT_POOL_SIZE > 0:
+        with tracing.span("sdk.ping"):
+            agent = await _get_pool().get((chat_id, "chat"), lambda: _build_options(bot, chat_id, db_path, resume=_load_session_id(chat_id)))
+        messages = agent.run(prompt)
+    else:
+        tracing.set_attr("cold_start", True)
+        messages = query(prompt=_make_prompt(prompt), options=_build_options(bot, chat_id, db_path, resume=_load_session_id(chat_id)))
+    async for message in _traced(messages):
+        yield message
+
+
+async def _compact_session(bot: Any, chat_id: int, db_path: str, reason: str) -> str:
+    """Summarize the chat's session into its memories and drop the session. Returns the summary ("" if none)."""
+    from claude_agent_sdk import AssistantMessage, ResultMessage, TextBlock
+
+    before = _load_state()["session_usage"][str(chat_id)]["tokens"]
+    logger.info("Compacting session of chat %s (%s limit, %d input tokens last turn)", chat_id, reason, before)
+    transcript = TranscriptCollector(_COMPACT_MAX_CHARS)
+    try:
+        async for message in _chat_messages(_COMPACT_PROMPT, bot, chat_id, db_path):
+            if isinstance(message, AssistantMessage):
+                for block in message.content:
+                    if isinstance(block, TextBlock):
+                        await transcript.add(block.text)
+            elif isinstance(message, ResultMessage):
+                metrics.record_result("compaction", message)
+                await transcript.add_result(message.result)
+    except Exception:
+        # Start fresh anyway: the archive still has the conversation.
+        logger.warning("Could not summarize the session of chat %s; starting a new one without a summary", chat_id, exc_info=True)
+        transcript = TranscriptCollector(_COMPACT_MAX_CHARS)
+    summary = (await transcript.finish()).strip()
+    await _keep_blob(transcript, chat_id)
+    if summary:
+        chat_db = str(get_chat_db(chat_id))
+        await db.upsert_memory(chat_db, chat_id, _COMPACT_MEMORY_KEY, summary, ["session"])
+        await memory.refresh_memory_summary(chat_db, chat_id)
+    clear_session_id(chat_id, compacted_from=before)
+    metrics.SESSION_COMPACTIONS.inc(reason=reason)
+    return summary
+
+
+async def _keep_blob(transcript: TranscriptCollector, chat_id: int) -> None:
+    """Make the chat an owner of the blob a reply or summary spilled to: the archive and memories keep referencing it.
+
+    Owners live in DB_PATH even with DB_SHARDING, so retention never has to look in the shards.
+    """
+    if transcript.blob_digest is not None:
+        await db.add_blob_ref(str(DB_PATH), transcript.blob_digest, f"chat:{chat_id}")
 
-    response_parts: list[str] = []
+
+async def _run_agent_inner(prompt: str, bot: Any, chat_id: int, db_path: str, on_text: Callable[[str], Awaitable[None]] | None = None) -> tuple[str, str]:
+    from claude_agent_sdk import AssistantMessage, ResultMessage, TextBlock
+
+    if (reason := _compaction_reason(chat_id)) is not None:
+        tracing.set_attr("compacted", reason)
+        with tracing.span("session.compact"):
+            summary = await _compact_session(bot, chat_id, db_path, reason)
+        if summary:
+            prompt = f"[Summary of our conversation so far, written by you before it was restarted]\n{summary}\n\n[New message]\n{prompt}"
+
+    transcript = TranscriptCollector(TRANSCRIPT_MAX_CHARS)
 
     try:
-        async for message in query(prompt=_make_prompt(prompt), options=options):
+        async for message in _chat_messages(prompt, bot, chat_id, db_path):
             if isinstance(message, AssistantMessage):
                 for block in message.content:
                     if isinstance(block, TextBlock):
-                        response_parts.append(block.text)
+                        await transcript.add(block.text)
+                        if on_text is not None:
+                            await on_text(block.text)
             elif isinstance(message, ResultMessage):
-                _save_session_id(message.session_id)
-                if message.result:
-                    response_parts.append(message.result)
+                metrics.record_result("chat", message)
+                _record_turn(chat_id, message.session_id, _turn_tokens(message.usage))
+                await transcript.add_result(message.result)
     except Exception:
-        if not response_parts:
+        if not transcript.chars:
             logger.exception("Agent error")
-            return "Sorry, something went wrong while processing your request."
+            error = "Sorry, something went wrong while processing your request."
+            return error, error
         logger.debug("Ignoring query cleanup error", exc_info=True)
 
-    return "".join(response_parts) or "Done."
+    record = await transcript.finish() or "Done."
+    await _keep_blob(transcript, chat_id)
+    return await transcript.full_text() or record, record
 
 
-async def run_task_agent(prompt: str, bot: Any, chat_id: int, db_path: str, notify_state: dict[str, bool] | None = None) -> str:
-    """Run agent for scheduled tasks — no session resume."""
-    tools = _create_tools(bot, chat_id, db_path, notify_state)
-    mcp_server = create_sdk_mcp_server(name="nanoclaw", tools=tools)
+async def run_task_agent(prompt: str, bot: Any, chat_id: int, db_path: str, notify_state: dict[str, Any] | None = None) -> str:
+    """Run agent for scheduled tasks — no session resume.
 
-    env = {"ANTHROPIC_API_KEY": ANTHROPIC_API_KEY}
-    if ANTHROPIC_BASE_URL:
-        env["ANTHROPIC_BASE_URL"] = ANTHROPIC_BASE_URL
+    `notify_state` collects "sent"/"messages" from send_message and the run's "cost_usd".
+    """
+    with tracing.turn("task", chat_id):
+        async with _agent_slot(chat_id, ordered=False):
+            with metrics.AGENT_TURN.time(kind="task"):
+                return await _run_task_agent_inner(prompt, bot, chat_id, db_path, notify_state)
 
-    options = ClaudeAgentOptions(
-        cwd=str(WORKSPACE_DIR),
-        setting_sources=["project"],
-        allowed_tools=[
-            "Bash",
-            "Read",
-            "Write",
-            "Edit",
-            "Glob",
-            "Grep",
-            "WebSearch",
-            "WebFetch",
-            "mcp__nanoclaw__send_message",
-            "mcp__nanoclaw__schedule_task",
-            "mcp__nanoclaw__list_tasks",
-            "mcp__nanoclaw__pause_task",
-            "mcp__nanoclaw__resume_task",
-            "mcp__nanoclaw__cancel_task",
-        ],
-        permission_mode="bypassPermissions",
-        mcp_servers={"nanoclaw": mcp_server},
-        env=env,
-    )
 
-    response_parts: list[str] = []
+async def _run_task_agent_inner(prompt: str, bot: Any, chat_id: int, db_path: str, notify_state: dict[str, Any] | None) -> str:
+    from claude_agent_sdk import AssistantMessage, ResultMessage, TextBlock, query
+
+    options = _build_options(bot, chat_id, db_path, notify_state)
+
+    # A task's output only goes to the run log, so it is capped at what the log keeps.
+    transcript = TranscriptCollector(RUN_LOG_MAX_RESULT_CHARS)
     try:
-        async for message in query(prompt=_make_prompt(prompt), options=options):
+        async for message in _traced(query(prompt=_make_prompt(prompt), options=options)):
             if isinstance(message, AssistantMessage):
                 for block in message.content:
                     if isinstance(block, TextBlock):
-                        response_parts.append(block.text)
+                        await transcript.add(block.text)
             elif isinstance(message, ResultMessage):
-                if message.result:
-                    response_parts.append(message.result)
+                metrics.record_result("task", message)
+                if notify_state is not None:
+                    notify_state["cost_usd"] = message.total_cost_usd or 0.0
+                await transcript.add_result(message.result)
     except Exception:
-        if not response_parts:
+        if not transcript.chars:
             logger.exception("Task agent error")
             return "Task execution failed."
         logger.debug("Ignoring query cleanup error", exc_info=True)
 
-    return "".join(response_parts) or "Task completed."
+    return await transcript.finish() or "Task completed."
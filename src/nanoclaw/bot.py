@@ -1,69 +1,331 @@
+import asyncio
+import contextlib
+import functools
 import logging
+import time
+from typing import Awaitable, Callable
 
-from telegram import Update
+from telegram import Message, Update
 from telegram.constants import ChatAction
+from telegram.error import TelegramError
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
 
-from nanoclaw.agent import run_agent, clear_session_id
-from nanoclaw.conversations import archive_exchange
-from nanoclaw.config import ASSISTANT_NAME, DB_PATH, OWNER_ID, TELEGRAM_BOT_TOKEN
-from nanoclaw.scheduler import setup_scheduler
+from nanoclaw import metrics, outbox, task_reports, tracing
+from nanoclaw.agent import clear_session_id, close_agents, run_agent
+from nanoclaw.conversations import archive_exchange, close_archive
+from nanoclaw.config import (
+    ALLOWED_CHAT_IDS,
+    ASSISTANT_NAME,
+    DB_PATH,
+    MESSAGE_DEBOUNCE,
+    METRICS_HOST,
+    METRICS_PORT,
+    OWNER_ID,
+    STREAM_EDIT_INTERVAL,
+    STREAM_REPLIES,
+    TELEGRAM_BASE_URL,
+    TELEGRAM_BOT_TOKEN,
+    TRANSCRIPT_MAX_CHARS,
+)
+from nanoclaw.db import close_db
+from nanoclaw.response_cache import close_response_cache
+from nanoclaw.scheduler import setup_scheduler, start_maintenance, stop_scheduler
 
 logger = logging.getLogger(__name__)
 
-_TELEGRAM_MAX_LENGTH = 4096
+# Telegram shows a chat action for ~5s; refresh it a little sooner.
+_TYPING_REFRESH = 4.0
+# A chat that never goes quiet still gets its turn this many debounce windows after its first message.
+_DEBOUNCE_MAX_WINDOWS = 5
 
 
-def _is_owner(update: Update) -> bool:
-    return update.effective_user is not None and update.effective_user.id == OWNER_ID
+class _StreamingReply:
+    """Shows a reply while the agent is still producing it.
+
+    Text is accumulated and rendered into one or more Telegram messages: the
+    last message is edited in place (at most once per `edit_interval`), and
+    when it outgrows one Telegram message it is frozen and a new one started.
+    Sends and edits go through the outbox, so they share the chat's rate limit.
+    The preview stops growing at `max_chars`; `finish` shows the whole reply,
+    and deletes streamed messages the final text no longer needs.
+    """
+
+    def __init__(self, message: Message, edit_interval: float, max_chars: int) -> None:
+        self._message = message
+        self._edit_interval = edit_interval
+        self._max_chars = max_chars
+        self._text = ""
+        self._sent: list[tuple[Message, str]] = []
+        self._last_render = 0.0
+        self._pending: asyncio.Task | None = None
+        self._finished = False
+        self._lock = asyncio.Lock()
+
+    async def push(self, text: str) -> None:
+        if len(self._text) >= self._max_chars:
+            return
+        self._text = (self._text + text)[: self._max_chars]
+        wait = self._last_render + self._edit_interval - time.monotonic()
+        if wait <= 0:
+            await self._render(self._text)
+        elif self._pending is None or self._pending.done():
+            self._pending = asyncio.create_task(self._render_later(wait))
+
+    async def finish(self, text: str) -> None:
+        self._finished = True
+        if self._pending is not None:
+            # A render already under way still completes (the outbox sends its
+            # message regardless), and the lock makes the final render wait for it.
+            self._pending.cancel()
+        await self._render(text, final=True)
+
+    async def _render_later(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+        await asyncio.shield(self._render(self._text))
+
+    async def _render(self, text: str, final: bool = False) -> None:
+        async with self._lock:
+            if self._finished and not final:
+                return
+            self._last_render = time.monotonic()
+            chat_id = self._message.chat_id
+            chunks = outbox.split_message(text) if text else []
+            try:
+                for idx, chunk in enumerate(chunks):
+                    if idx < len(self._sent):
+                        sent, shown = self._sent[idx]
+                        if shown != chunk:
+                            await outbox.call(chat_id, "edit_message_text", lambda sent=sent, chunk=chunk: sent.edit_text(chunk))
+                            self._sent[idx] = (sent, chunk)
+                    else:
+                        sent = await outbox.call(chat_id, "send_message", lambda chunk=chunk: self._message.reply_text(chunk))
+                        self._sent.append((sent, chunk))
+                # The final text can be shorter than what was streamed, e.g. when the result replaced the streamed blocks.
+                while len(self._sent) > len(chunks):
+                    sent, _ = self._sent[-1]
+                    await outbox.call(chat_id, "delete_message", sent.delete)
+                    self._sent.pop()
+            except TelegramError:
+                logger.warning("Failed to update streaming reply", exc_info=True)
+
+
+async def _keep_typing(bot, chat_id: int) -> None:
+    while True:
+        try:
+            await bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+        except TelegramError:
+            logger.debug("Failed to send typing action", exc_info=True)
+        await asyncio.sleep(_TYPING_REFRESH)
+
+
+def _is_allowed(update: Update) -> bool:
+    """The owner, anywhere, or anyone in a chat listed in ALLOWED_CHAT_IDS."""
+    if update.effective_user is not None and update.effective_user.id == OWNER_ID:
+        return True
+    return update.effective_chat is not None and update.effective_chat.id in ALLOWED_CHAT_IDS
 
 
 async def _start(update: Update, context) -> None:
-    if not _is_owner(update):
+    if not _is_allowed(update):
         return
-    await update.message.reply_text(
+    await outbox.send(
+        context.bot,
+        update.effective_chat.id,
         f"Hi! I'm {ASSISTANT_NAME}, your personal AI assistant. Send me a message to get started.\n\n"
         "Commands:\n"
-        "/clear - Reset conversation session"
+        "/clear - Reset conversation session\n"
+        "/stats [task_id] [days] - Task run counts, error rates and durations\n"
+        "/history <task_id> [count] - Recent runs of a task\n"
+        "/profile [count] - Slowest recent turns and where their time went",
     )
 
 
 async def _clear(update: Update, context) -> None:
-    if not _is_owner(update):
+    if not _is_allowed(update):
         return
-    clear_session_id()
-    await update.message.reply_text("Session cleared. Starting fresh!")
+    clear_session_id(update.effective_chat.id)
+    await outbox.send(context.bot, update.effective_chat.id, "Session cleared. Starting fresh!")
+
+
+async def _stats(update: Update, context) -> None:
+    if not _is_allowed(update):
+        return
+    task_id, days = None, 7
+    for arg in context.args or []:
+        # Task IDs are 8 hex characters; a shorter number is a day count.
+        if arg.isdigit() and len(arg) < 8:
+            days = max(1, int(arg))
+        else:
+            task_id = arg
+    chat_id = update.effective_chat.id
+    await outbox.send(context.bot, chat_id, await task_reports.task_stats_text(str(DB_PATH), chat_id, task_id, days))
+
+
+async def _history(update: Update, context) -> None:
+    if not _is_allowed(update):
+        return
+    chat_id = update.effective_chat.id
+    args = context.args or []
+    if not args:
+        await outbox.send(context.bot, chat_id, "Usage: /history <task_id> [count]")
+        return
+    limit = int(args[1]) if len(args) > 1 and args[1].isdigit() else 10
+    await outbox.send(context.bot, chat_id, await task_reports.task_history_text(str(DB_PATH), chat_id, args[0], limit))
+
+
+async def _profile(update: Update, context) -> None:
+    if not _is_allowed(update):
+        return
+    args = context.args or []
+    limit = max(1, int(args[0])) if args and args[0].isdigit() else 5
+    chat_id = update.effective_chat.id
+    await outbox.send(context.bot, chat_id, tracing.profile_text(chat_id, limit))
+
+
+class _ChatInbox:
+    """Messages from one chat waiting for their agent turn.
+
+    Messages are held until the chat has been quiet for `debounce` seconds
+    (or _DEBOUNCE_MAX_WINDOWS windows after the first), and while the chat's
+    previous turn is still running. Everything held then goes to the agent as
+    one prompt, and is archived as one exchange.
+    """
+
+    def __init__(self, debounce: float) -> None:
+        self.debounce = debounce
+        self.pending: list[Update] = []
+        self.worker: asyncio.Task | None = None
+        self._first_at = 0.0
+        self._last_at = 0.0
+
+    def add(self, update: Update) -> None:
+        now = time.monotonic()
+        if not self.pending:
+            self._first_at = now
+        self._last_at = now
+        self.pending.append(update)
+
+    async def settle(self) -> None:
+        """Wait until the pending messages are due."""
+        while (wait := min(self._last_at + self.debounce, self._first_at + self.debounce * _DEBOUNCE_MAX_WINDOWS) - time.monotonic()) > 0:
+            await asyncio.sleep(wait)
+
+    def take(self) -> list[Update]:
+        updates, self.pending = self.pending, []
+        return updates
+
+
+_inboxes: dict[int, _ChatInbox] = {}
 
 
 async def _handle_message(update: Update, context) -> None:
-    if not _is_owner(update) or not update.message or not update.message.text:
+    if not _is_allowed(update) or not update.message or not update.message.text:
         return
 
+    # Only queue here: the turn runs in the chat's worker, so the next update
+    # (possibly more text for the same turn) is handled right away.
     chat_id = update.effective_chat.id
-    user_text = update.message.text
+    inbox = _inboxes.get(chat_id)
+    if inbox is None:
+        inbox = _inboxes[chat_id] = _ChatInbox(MESSAGE_DEBOUNCE)
+    inbox.add(update)
+    if inbox.worker is None or inbox.worker.done():
+        inbox.worker = asyncio.create_task(_drain_inbox(context.bot, chat_id, inbox))
+
+
+async def _drain_inbox(bot, chat_id: int, inbox: _ChatInbox) -> None:
+    try:
+        while inbox.pending:
+            await inbox.settle()
+            updates = inbox.take()
+            try:
+                await _run_turn(bot, chat_id, updates)
+            except Exception:
+                # One failed turn shouldn't drop the messages queued behind it.
+                logger.exception("Failed to handle %d messages for chat %s", len(updates), chat_id)
+                with contextlib.suppress(Exception):
+                    await outbox.send(bot, chat_id, "Sorry, something went wrong while processing your message.")
+    finally:
+        if _inboxes.get(chat_id) is inbox and not inbox.pending:
+            del _inboxes[chat_id]
+
+
+async def _run_turn(bot, chat_id: int, updates: list[Update]) -> None:
+    user_text = "\n\n".join(u.message.text for u in updates)
+    if len(updates) > 1:
+        metrics.MESSAGES_BATCHED.inc(len(updates) - 1)
+        logger.info("Merged %d messages from chat %s into one turn", len(updates), chat_id)
 
-    await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+    typing = asyncio.create_task(_keep_typing(bot, chat_id))
+    try:
+        if STREAM_REPLIES:
+            reply = _StreamingReply(updates[-1].message, STREAM_EDIT_INTERVAL, TRANSCRIPT_MAX_CHARS)
+            response, record = await run_agent(user_text, bot, chat_id, str(DB_PATH), on_text=reply.push)
+        else:
+            response, record = await run_agent(user_text, bot, chat_id, str(DB_PATH))
+    finally:
+        typing.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await typing
 
-    response = await run_agent(user_text, context.bot, chat_id, str(DB_PATH))
+    # Archive to conversations/ for long-term memory; a very long reply is archived as its head plus a blob reference.
+    await archive_exchange(user_text, record, chat_id)
+
+    if STREAM_REPLIES:
+        await reply.finish(response)
+        return
+
+    # The outbox splits long replies at paragraph/line boundaries.
+    await outbox.send(bot, chat_id, response)
 
-    # Archive to conversations/ for long-term memory
-    await archive_exchange(user_text, response, chat_id)
 
-    # Split long messages
-    for i in range(0, len(response), _TELEGRAM_MAX_LENGTH):
-        chunk = response[i : i + _TELEGRAM_MAX_LENGTH]
-        await update.message.reply_text(chunk)
+async def _close_inboxes() -> None:
+    """Cancel running turns; messages still waiting for one are dropped."""
+    workers = [inbox.worker for inbox in _inboxes.values() if inbox.worker is not None]
+    dropped = sum(len(inbox.pending) for inbox in _inboxes.values())
+    if dropped:
+        logger.warning("Dropping %d unanswered messages on shutdown", dropped)
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    _inboxes.clear()
 
 
-async def _post_init(application: Application) -> None:
+async def _post_init(application: Application, prepare: Callable[[], Awaitable[None]] | None = None) -> None:
+    # Runs on the bot's loop (polling or webhook), so the DB connection and
+    # every task started here live on the same loop as the handlers.
+    if prepare is not None:
+        await prepare()
     scheduler = setup_scheduler(application.bot, str(DB_PATH))
     scheduler.start()
+    start_maintenance(str(DB_PATH))
     logger.info("Scheduler started")
+    if METRICS_PORT:
+        application.bot_data["metrics_server"] = await metrics.start_metrics_server(METRICS_HOST, METRICS_PORT)
+
+
+async def _post_shutdown(application: Application) -> None:
+    if server := application.bot_data.get("metrics_server"):
+        server.close()
+    await _close_inboxes()
+    await stop_scheduler()
+    await close_agents()
+    await outbox.close_outbox()
+    await close_archive()
+    await close_response_cache()
+    await close_db()
 
 
-def setup_bot() -> Application:
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).post_init(_post_init).build()
+def setup_bot(prepare: Callable[[], Awaitable[None]] | None = None) -> Application:
+    """Build the application. `prepare` is awaited on the bot's loop before the scheduler starts."""
+    builder = Application.builder().token(TELEGRAM_BOT_TOKEN).post_init(functools.partial(_post_init, prepare=prepare)).post_shutdown(_post_shutdown)
+    if TELEGRAM_BASE_URL:
+        builder = builder.base_url(TELEGRAM_BASE_URL)
+    app = builder.build()
     app.add_handler(CommandHandler("start", _start))
     app.add_handler(CommandHandler("clear", _clear))
+    app.add_handler(CommandHandler("stats", _stats))
+    app.add_handler(CommandHandler("history", _history))
+    app.add_handler(CommandHandler("profile", _profile))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, _handle_message))
     return app
@@ -1,10 +1,19 @@
 import os
+import socket
 from pathlib import Path
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
+
+def _positive_float(name: str, default: str) -> float:
+    value = float(os.getenv(name, default))
+    if not value > 0:
+        raise ValueError(f"{name} must be greater than 0, got {value}")
+    return value
+
+
 # Required
 TELEGRAM_BOT_TOKEN = os.environ["TELEGRAM_BOT_TOKEN"]
 OWNER_ID = int(os.environ["OWNER_ID"])
@@ -13,24 +22,67 @@ ANTHROPIC_API_KEY = os.environ["ANTHROPIC_API_KEY"]
 # Optional
 ANTHROPIC_BASE_URL = os.getenv("ANTHROPIC_BASE_URL")
 ASSISTANT_NAME = os.getenv("ASSISTANT_NAME", "Ape")
+ALLOWED_CHAT_IDS = {int(c) for c in os.getenv("ALLOWED_CHAT_IDS", "").replace(",", " ").split()}
+MULTI_CHAT = os.getenv("MULTI_CHAT", "false").lower() in ("1", "true", "yes")
+DB_SHARDING = os.getenv("DB_SHARDING", "false").lower() in ("1", "true", "yes")
+DB_MAX_OPEN = int(os.getenv("DB_MAX_OPEN", "64"))
 SCHEDULER_INTERVAL = int(os.getenv("SCHEDULER_INTERVAL", "60"))
+SCHEDULER_CONCURRENCY = int(os.getenv("SCHEDULER_CONCURRENCY", "3"))
+MISFIRE_GRACE = float(os.getenv("MISFIRE_GRACE", "300"))
+MISFIRE_JITTER = float(os.getenv("MISFIRE_JITTER", "30"))
+SCHEDULER_ID = os.getenv("SCHEDULER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+TASK_LEASE_SECONDS = float(os.getenv("TASK_LEASE_SECONDS", "300"))
+TASK_MAX_ATTEMPTS = int(os.getenv("TASK_MAX_ATTEMPTS", "3"))
+RUN_LOG_MAX_AGE_DAYS = int(os.getenv("RUN_LOG_MAX_AGE_DAYS", "30"))
+RUN_LOG_MAX_ROWS_PER_TASK = int(os.getenv("RUN_LOG_MAX_ROWS_PER_TASK", "1000"))
+RUN_LOG_MAX_RESULT_CHARS = int(os.getenv("RUN_LOG_MAX_RESULT_CHARS", "4000"))
+RETENTION_INTERVAL = int(os.getenv("RETENTION_INTERVAL", "3600"))
+MAX_CONCURRENT_AGENTS = int(os.getenv("MAX_CONCURRENT_AGENTS", "4"))
+AGENT_POOL_SIZE = int(os.getenv("AGENT_POOL_SIZE", "4"))
+AGENT_IDLE_TIMEOUT = float(os.getenv("AGENT_IDLE_TIMEOUT", "600"))
+AGENT_PING_TIMEOUT = float(os.getenv("AGENT_PING_TIMEOUT", "5"))
+ARCHIVE_FLUSH_INTERVAL = float(os.getenv("ARCHIVE_FLUSH_INTERVAL", "1"))
+ARCHIVE_FSYNC_INTERVAL = float(os.getenv("ARCHIVE_FSYNC_INTERVAL", "5"))
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "true").lower() in ("1", "true", "yes")
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+MESSAGE_DEBOUNCE = float(os.getenv("MESSAGE_DEBOUNCE", "1.0"))
+SESSION_MAX_TOKENS = int(os.getenv("SESSION_MAX_TOKENS", "100000"))
+SESSION_MAX_TURNS = int(os.getenv("SESSION_MAX_TURNS", "0"))
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL")
+TELEGRAM_GLOBAL_RATE = _positive_float("TELEGRAM_GLOBAL_RATE", "25")
+TELEGRAM_CHAT_RATE = _positive_float("TELEGRAM_CHAT_RATE", "1")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+MEMORY_SUMMARY_CHARS = int(os.getenv("MEMORY_SUMMARY_CHARS", "2000"))
+TRANSCRIPT_MAX_CHARS = int(os.getenv("TRANSCRIPT_MAX_CHARS", "32000"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "256"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+TRACE_SLOW_SECONDS = float(os.getenv("TRACE_SLOW_SECONDS", "30"))
+TRACE_MAX_BYTES = int(os.getenv("TRACE_MAX_BYTES", str(10 * 1024 * 1024)))
+TRACE_BACKUPS = int(os.getenv("TRACE_BACKUPS", "3"))
 
 # Paths
-BASE_DIR = Path(__file__).resolve().parent.parent.parent
+BASE_DIR = Path(os.getenv("NANOCLAW_BASE_DIR") or Path(__file__).resolve().parent.parent.parent)
 WORKSPACE_DIR = BASE_DIR / "workspace"
 STORE_DIR = BASE_DIR / "store"
 DATA_DIR = BASE_DIR / "data"
 DB_PATH = STORE_DIR / "nanoclaw.db"
+RESPONSE_CACHE_PATH = STORE_DIR / "response_cache.db"
+BLOB_DIR = STORE_DIR / "blobs"
 STATE_FILE = DATA_DIR / "state.json"
+TRACE_FILE = DATA_DIR / "traces.jsonl"
 
 
 def get_chat_workspace(chat_id: int) -> Path:
     """Get workspace directory for a specific chat.
 
-    Currently all chats share the same workspace (single-user mode).
-    Future: Each chat can have isolated workspace for multi-user/group support.
-
-    Example future structure:
+    In single-user mode all chats share WORKSPACE_DIR. With MULTI_CHAT each
+    chat gets its own directory, with its own CLAUDE.md and conversations:
         workspace/
         └── chats/
             ├── 123456/       # user chat
@@ -40,10 +92,18 @@ def get_chat_workspace(chat_id: int) -> Path:
                 ├── CLAUDE.md
                 └── conversations/
     """
-    # Single-user mode: all chats use the same workspace
-    return WORKSPACE_DIR
+    if not MULTI_CHAT:
+        return WORKSPACE_DIR
+    return WORKSPACE_DIR / "chats" / str(chat_id)
 
-    # Future multi-user mode (uncomment when needed):
-    # chat_dir = WORKSPACE_DIR / "chats" / str(chat_id)
-    # chat_dir.mkdir(parents=True, exist_ok=True)
-    # return chat_dir
+
+def get_chat_db(chat_id: int | None) -> Path:
+    """SQLite file holding a chat's memories and conversation index.
+
+    Scheduled tasks always stay in DB_PATH so one scheduler sees them all.
+    With MULTI_CHAT and DB_SHARDING each chat's own data goes to
+    store/chats/<chat_id>.db.
+    """
+    if not (MULTI_CHAT and DB_SHARDING) or chat_id is None:
+        return DB_PATH
+    return STORE_DIR / "chats" / f"{chat_id}.db"
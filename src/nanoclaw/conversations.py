@@ -1,25 +1,152 @@
-"""Conversation archiving for long-term memory."""
+"""Conversation archiving for long-term memory.
 
+Exchanges are appended to one markdown file per UTC day. Writes are buffered
+and flushed off the event loop in batches, so archiving costs the same per
+message no matter how large today's file already is. A process crash loses at
+most ARCHIVE_FLUSH_INTERVAL seconds of entries; a power loss at most
+ARCHIVE_FSYNC_INTERVAL seconds.
+"""
+
+import asyncio
 import logging
+import os
+import re
+import time
+from collections import OrderedDict
 from datetime import datetime, timezone
 from pathlib import Path
+from typing import TextIO
 
-from nanoclaw.config import WORKSPACE_DIR
+from nanoclaw import db
+from nanoclaw.config import ARCHIVE_FLUSH_INTERVAL, ARCHIVE_FSYNC_INTERVAL, DB_MAX_OPEN, MULTI_CHAT, WORKSPACE_DIR, get_chat_db, get_chat_workspace
 
 logger = logging.getLogger(__name__)
 
 CONVERSATIONS_DIR = WORKSPACE_DIR / "conversations"
 
+# Flush right away once this many entries are buffered.
+_MAX_PENDING = 100
+
+# An entry ends at the "---" followed by the next entry's header or the end of
+# the file, so a reply containing its own "---" rule isn't cut short.
+_ENTRY_RE = re.compile(
+    r"^## (\d\d:\d\d:\d\d) UTC\n\n\*\*User\*\*: (.*?)\n\n\*\*Ape\*\*: (.*?)\n\n---\n+(?=## \d\d:\d\d:\d\d UTC\n\n\*\*User\*\*: |\Z)",
+    re.MULTILINE | re.DOTALL,
+)
 
-def ensure_conversations_dir() -> None:
-    """Create conversations directory if it doesn't exist."""
-    CONVERSATIONS_DIR.mkdir(parents=True, exist_ok=True)
 
+class ArchiveWriter:
+    """Buffered, append-only writer for the daily conversation files.
+
+    Entries carry their own UTC date, so a batch that straddles midnight is
+    split across both days' files. The current day's file stays open in
+    append mode and is rotated when an entry for a new date arrives.
+    """
 
-def _get_today_file() -> Path:
-    """Get the conversation file for today."""
-    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-    return CONVERSATIONS_DIR / f"{today}.md"
+    def __init__(self, directory: Path, flush_interval: float, fsync_interval: float) -> None:
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self._pending: list[tuple[str, str]] = []
+        self._flush_task: asyncio.Task | None = None
+        self._fsync_task: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+        self._file: TextIO | None = None
+        self._file_date: str | None = None
+        self._last_fsync = 0.0
+        self._unsynced = False
+
+    def append(self, date_str: str, entry: str) -> None:
+        self._pending.append((date_str, entry))
+        if len(self._pending) >= _MAX_PENDING or self.flush_interval <= 0:
+            self._flush_task = asyncio.create_task(self._flush_after(0))
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_after(self.flush_interval))
+
+    async def _flush_after(self, delay: float) -> None:
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await self.flush()
+
+    async def flush(self) -> None:
+        async with self._lock:
+            batch, self._pending = self._pending, []
+            if not batch:
+                return
+            try:
+                await asyncio.to_thread(self._write, batch)
+            except Exception:
+                logger.exception(f"Failed to archive {len(batch)} exchanges to {self.directory}")
+            # The fsync was skipped as too soon: make sure it happens even if no more entries come.
+            if self._unsynced and (self._fsync_task is None or self._fsync_task.done()):
+                self._fsync_task = asyncio.create_task(self._fsync_after(self._last_fsync + self.fsync_interval - time.monotonic()))
+
+    async def _fsync_after(self, delay: float) -> None:
+        await asyncio.sleep(max(0.0, delay))
+        async with self._lock:
+            await asyncio.to_thread(self._fsync)
+
+    async def close(self) -> None:
+        await self.flush()
+        async with self._lock:
+            # Holding the lock, the deferred fsync is asleep or waiting for it; closing the file fsyncs anyway.
+            if self._fsync_task is not None:
+                self._fsync_task.cancel()
+            await asyncio.to_thread(self._close_file)
+
+    def _write(self, batch: list[tuple[str, str]]) -> None:
+        for date_str, entry in batch:
+            if date_str != self._file_date:
+                self._rotate(date_str)
+            self._file.write(entry)
+        self._file.flush()
+        self._unsynced = True
+        if time.monotonic() - self._last_fsync >= self.fsync_interval:
+            self._fsync()
+        logger.debug(f"Archived {len(batch)} exchanges to {self.directory}")
+
+    def _fsync(self) -> None:
+        if self._file is not None and self._unsynced:
+            os.fsync(self._file.fileno())
+        self._unsynced = False
+        self._last_fsync = time.monotonic()
+
+    def _rotate(self, date_str: str) -> None:
+        self._close_file()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.directory / f"{date_str}.md", "a", encoding="utf-8")
+        self._file_date = date_str
+        if self._file.tell() == 0:
+            self._file.write(f"# Conversations - {date_str}\n\n")
+
+    def _close_file(self) -> None:
+        if self._file is None:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file, self._file_date = None, None
+        self._unsynced = False
+
+
+# One writer per conversations/ directory (one per chat with MULTI_CHAT). Each
+# holds an open file, so only the most recently used DB_MAX_OPEN are kept.
+_writers: OrderedDict[Path, ArchiveWriter] = OrderedDict()
+# Evicted writers still closing; close_archive waits for them.
+_closing: set[asyncio.Task] = set()
+
+
+def _get_writer(directory: Path) -> ArchiveWriter:
+    writer = _writers.get(directory)
+    if writer is None:
+        writer = _writers[directory] = ArchiveWriter(directory, ARCHIVE_FLUSH_INTERVAL, ARCHIVE_FSYNC_INTERVAL)
+    _writers.move_to_end(directory)
+    while len(_writers) > max(1, DB_MAX_OPEN):
+        _, evicted = _writers.popitem(last=False)
+        task = asyncio.create_task(evicted.close())
+        _closing.add(task)
+        task.add_done_callback(_closing.discard)
+    return writer
 
 
 async def archive_exchange(user_message: str, assistant_response: str, chat_id: int) -> None:
@@ -34,10 +161,8 @@ async def archive_exchange(user_message: str, assistant_response: str, chat_id:
 
     ---
     """
-    ensure_conversations_dir()
-
-    filepath = _get_today_file()
-    timestamp = datetime.now(timezone.utc).strftime("%H:%M:%S UTC")
+    now = datetime.now(timezone.utc)
+    timestamp = now.strftime("%H:%M:%S UTC")
 
     # Build the exchange entry
     entry = f"""## {timestamp}
@@ -50,17 +175,54 @@ async def archive_exchange(user_message: str, assistant_response: str, chat_id:
 
 """
 
-    # Append to file (create if doesn't exist)
+    day = now.strftime("%Y-%m-%d")
+    _get_writer(get_chat_workspace(chat_id) / "conversations").append(day, entry)
+
     try:
-        if filepath.exists():
-            content = filepath.read_text(encoding="utf-8")
-        else:
-            # Create file with header
-            date_str = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-            content = f"# Conversations - {date_str}\n\n"
-
-        content += entry
-        filepath.write_text(content, encoding="utf-8")
-        logger.debug(f"Archived exchange to {filepath}")
+        await db.index_exchanges(str(get_chat_db(chat_id)), [(day, now.strftime("%H:%M:%S"), chat_id, user_message, assistant_response)])
     except Exception:
-        logger.exception(f"Failed to archive exchange to {filepath}")
+        logger.exception("Failed to index exchange for search")
+
+
+async def close_archive() -> None:
+    """Flush buffered exchanges and close open files. Call on shutdown."""
+    writers = list(_writers.values())
+    _writers.clear()
+    await asyncio.gather(*(w.close() for w in writers), *_closing)
+
+
+def parse_archive(path: Path) -> list[tuple[str, str, str]]:
+    """(time, user_message, assistant_response) for each exchange in a daily file."""
+    return _ENTRY_RE.findall(path.read_text(encoding="utf-8"))
+
+
+def _archive_dirs() -> list[tuple[int | None, Path]]:
+    """(chat_id, conversations dir) for every archive; chat_id is None for the shared one."""
+    dirs: list[tuple[int | None, Path]] = [(None, CONVERSATIONS_DIR)]
+    if MULTI_CHAT:
+        for chat_dir in sorted((WORKSPACE_DIR / "chats").glob("*")):
+            if chat_dir.name.lstrip("-").isdigit():
+                dirs.append((int(chat_dir.name), chat_dir / "conversations"))
+    return dirs
+
+
+async def reindex_conversations(db_path: str) -> int:
+    """Rebuild the search index(es) from every archive file. Returns exchange count.
+
+    The shared archive goes to `db_path`; per-chat archives to their chat's DB.
+    """
+    by_db: dict[str, list[tuple[int | None, Path]]] = {}
+    for chat_id, directory in _archive_dirs():
+        target = db_path if chat_id is None else str(get_chat_db(chat_id))
+        by_db.setdefault(target, []).append((chat_id, directory))
+
+    total = 0
+    for target, dirs in by_db.items():
+        async with db.transaction(target):
+            await db.clear_conversation_index(target)
+            for chat_id, directory in dirs:
+                for path in sorted(directory.glob("????-??-??.md")):
+                    exchanges = [(path.stem, t, chat_id, user, assistant) for t, user, assistant in await asyncio.to_thread(parse_archive, path)]
+                    await db.index_exchanges(target, exchanges)
+                    total += len(exchanges)
+    return total
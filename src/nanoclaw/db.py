@@ -1,15 +1,48 @@
 """Database operations for scheduled tasks.
 
 Note: Message history is stored in conversations/ folder (not in DB).
-The DB is only used for structured data that needs querying (scheduled tasks).
+The DB holds structured data that needs querying (scheduled tasks, the
+agent's memories) plus a full-text index over the conversation archive, which
+stays the source of truth.
+
+A single long-lived connection is opened by `open_db()` at startup and shared by
+every call below. It runs in WAL mode so readers never block the writer, and
+because it stays open, sqlite3's per-connection statement cache lets repeated
+queries skip re-preparing. Per-chat shard files (see config.get_chat_db) are
+created on first use and kept open in a bounded LRU. Functions fall back to a
+short-lived connection when `open_db()` has not been called (scripts,
+benchmarks).
+
+The schema is versioned (PRAGMA user_version); opening a DB applies any
+pending migrations in place.
 """
 
+import asyncio
+import functools
+import json
+import logging
+import math
+import sqlite3
+import time
 import uuid
-from datetime import datetime, timezone
+import weakref
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import AsyncIterator, Awaitable, Callable, Iterable, TypeVar
 
 import aiosqlite
 
-_CREATE_TABLES = """
+from nanoclaw import tracing
+from nanoclaw.metrics import DB_CALL
+
+logger = logging.getLogger(__name__)
+
+# The schema as it stood when versioning was introduced (migration 1). Frozen:
+# later changes go in their own migration below.
+_SCHEMA_V1 = """
 CREATE TABLE IF NOT EXISTS scheduled_tasks (
     id TEXT PRIMARY KEY,
     chat_id INTEGER NOT NULL,
@@ -20,10 +53,18 @@ CREATE TABLE IF NOT EXISTS scheduled_tasks (
     last_run TEXT,
     last_result TEXT,
     status TEXT DEFAULT 'active',
-    created_at TEXT NOT NULL
+    created_at TEXT NOT NULL,
+    misfire_policy TEXT NOT NULL DEFAULT 'once',
+    misfire_max INTEGER NOT NULL DEFAULT 10,
+    cache_ttl INTEGER,
+    cache_inputs TEXT,
+    lease_owner TEXT,
+    lease_expires TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0
 );
 CREATE INDEX IF NOT EXISTS idx_scheduled_tasks_next_run ON scheduled_tasks(next_run);
 CREATE INDEX IF NOT EXISTS idx_scheduled_tasks_status ON scheduled_tasks(status);
+CREATE INDEX IF NOT EXISTS idx_scheduled_tasks_chat ON scheduled_tasks(chat_id, status);
 
 CREATE TABLE IF NOT EXISTS task_run_logs (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -35,80 +76,935 @@ CREATE TABLE IF NOT EXISTS task_run_logs (
     error TEXT,
     FOREIGN KEY (task_id) REFERENCES scheduled_tasks(id)
 );
-CREATE INDEX IF NOT EXISTS idx_task_run_logs_task_id ON task_run_logs(task_id);
+-- History and stats read one task's runs by time; this also serves lookups by task_id alone.
+DROP INDEX IF EXISTS idx_task_run_logs_task_id;
+CREATE INDEX IF NOT EXISTS idx_task_run_logs_task_run_at ON task_run_logs(task_id, run_at);
+
+CREATE TABLE IF NOT EXISTS task_run_rollups (
+    task_id TEXT NOT NULL,
+    day TEXT NOT NULL,
+    run_count INTEGER NOT NULL,
+    error_count INTEGER NOT NULL,
+    p50_ms INTEGER NOT NULL,
+    p95_ms INTEGER NOT NULL,
+    PRIMARY KEY (task_id, day)
+);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS conversation_index USING fts5(
+    user_message,
+    assistant_response,
+    day UNINDEXED,
+    time UNINDEXED,
+    chat_id UNINDEXED,
+    tokenize = 'porter unicode61'
+);
+
+CREATE TABLE IF NOT EXISTS memories (
+    id INTEGER PRIMARY KEY,
+    chat_id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    content TEXT NOT NULL,
+    tags TEXT NOT NULL DEFAULT '',
+    pinned INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    UNIQUE (chat_id, key)
+);
+CREATE INDEX IF NOT EXISTS idx_memories_summary ON memories(chat_id, pinned DESC, updated_at DESC);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS memory_index USING fts5(
+    key,
+    content,
+    tags,
+    content = 'memories',
+    content_rowid = 'id',
+    tokenize = 'porter unicode61'
+);
+CREATE TRIGGER IF NOT EXISTS memories_ai AFTER INSERT ON memories BEGIN
+    INSERT INTO memory_index (rowid, key, content, tags) VALUES (new.id, new.key, new.content, new.tags);
+END;
+CREATE TRIGGER IF NOT EXISTS memories_ad AFTER DELETE ON memories BEGIN
+    INSERT INTO memory_index (memory_index, rowid, key, content, tags) VALUES ('delete', old.id, old.key, old.content, old.tags);
+END;
+CREATE TRIGGER IF NOT EXISTS memories_au AFTER UPDATE ON memories BEGIN
+    INSERT INTO memory_index (memory_index, rowid, key, content, tags) VALUES ('delete', old.id, old.key, old.content, old.tags);
+    INSERT INTO memory_index (rowid, key, content, tags) VALUES (new.id, new.key, new.content, new.tags);
+END;
 """
 
+# Columns added to scheduled_tasks before versioning; migration 1 adds any missing.
+_V1_ADDED_TASK_COLUMNS = {
+    "misfire_policy": "TEXT NOT NULL DEFAULT 'once'",
+    "misfire_max": "INTEGER NOT NULL DEFAULT 10",
+    "cache_ttl": "INTEGER",
+    "cache_inputs": "TEXT",
+    "lease_owner": "TEXT",
+    "lease_expires": "TEXT",
+    "attempts": "INTEGER NOT NULL DEFAULT 0",
+}
 
-async def init_db(db_path: str) -> None:
-    async with aiosqlite.connect(db_path) as db:
-        await db.executescript(_CREATE_TABLES)
+# Migration 2: next_run and lease_expires become UTC epoch milliseconds
+# (INTEGER), so they compare numerically whatever offset the input had. The
+# scheduler only ever looks up active tasks by time, hence the partial index.
+_TASK_COLUMNS_V2 = (
+    "id, chat_id, prompt, schedule_type, schedule_value, next_run, last_run, last_result, status, created_at, "
+    "misfire_policy, misfire_max, cache_ttl, cache_inputs, lease_owner, lease_expires, attempts"
+)
+_SCHEMA_V2 = f"""
+CREATE TABLE scheduled_tasks_v2 (
+    id TEXT PRIMARY KEY,
+    chat_id INTEGER NOT NULL,
+    prompt TEXT NOT NULL,
+    schedule_type TEXT NOT NULL,
+    schedule_value TEXT NOT NULL,
+    next_run INTEGER,
+    last_run TEXT,
+    last_result TEXT,
+    status TEXT DEFAULT 'active',
+    created_at TEXT NOT NULL,
+    misfire_policy TEXT NOT NULL DEFAULT 'once',
+    misfire_max INTEGER NOT NULL DEFAULT 10,
+    cache_ttl INTEGER,
+    cache_inputs TEXT,
+    lease_owner TEXT,
+    lease_expires INTEGER,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+INSERT INTO scheduled_tasks_v2 ({_TASK_COLUMNS_V2}) SELECT {_TASK_COLUMNS_V2} FROM scheduled_tasks;
+DROP TABLE scheduled_tasks;
+ALTER TABLE scheduled_tasks_v2 RENAME TO scheduled_tasks;
+CREATE INDEX idx_scheduled_tasks_chat ON scheduled_tasks(chat_id, status);
+CREATE INDEX idx_scheduled_tasks_due ON scheduled_tasks(next_run) WHERE status = 'active';
+"""
+
+# Migration 3: rollups count skipped misfires separately and leave them out of
+# the duration percentiles, as get_task_stats does. A day with only skipped
+# runs has no percentiles.
+_SCHEMA_V3 = """
+CREATE TABLE task_run_rollups_v3 (
+    task_id TEXT NOT NULL,
+    day TEXT NOT NULL,
+    run_count INTEGER NOT NULL,
+    error_count INTEGER NOT NULL,
+    skipped_count INTEGER NOT NULL DEFAULT 0,
+    p50_ms INTEGER,
+    p95_ms INTEGER,
+    PRIMARY KEY (task_id, day)
+);
+INSERT INTO task_run_rollups_v3 (task_id, day, run_count, error_count, p50_ms, p95_ms)
+    SELECT task_id, day, run_count, error_count, p50_ms, p95_ms FROM task_run_rollups;
+DROP TABLE task_run_rollups;
+ALTER TABLE task_run_rollups_v3 RENAME TO task_run_rollups;
+"""
+
+# Migration 4: blobs (agent output spilled to store/blobs) are referenced by
+# owner: 'run:<task_run_logs.id>' or 'chat:<chat_id>' for chat replies and
+# session summaries, which the archive keeps for good. Retention deletes a blob
+# once pruning removed its last owner, without scanning any text. Blobs from
+# before this migration have no owners and are never deleted.
+_SCHEMA_V4 = """
+CREATE TABLE blob_refs (
+    digest TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    PRIMARY KEY (digest, owner)
+) WITHOUT ROWID;
+CREATE INDEX idx_blob_refs_owner ON blob_refs(owner);
+"""
+
+# What to do with a task whose slot passed while the bot was down.
+MISFIRE_POLICIES = ("skip", "once", "all")
+
+# Applied to every connection. WAL + synchronous=NORMAL is durable across app
+# crashes and only risks the last commits on power loss, which is fine here.
+_PRAGMAS = """
+PRAGMA journal_mode = WAL;
+PRAGMA synchronous = NORMAL;
+PRAGMA busy_timeout = 5000;
+PRAGMA temp_store = MEMORY;
+PRAGMA cache_size = -8000;
+"""
+
+_STATEMENT_CACHE_SIZE = 256
+
+# Open connections by path. The main DB (from open_db) is never evicted; other
+# files (per-chat shards) are opened on first use and the least recently used
+# idle ones are closed beyond `_max_open`.
+_conns: "OrderedDict[str, aiosqlite.Connection]" = OrderedDict()
+_conn_users: dict[str, int] = {}
+_main_path: str | None = None
+_max_open = 64
+_open_lock = asyncio.Lock()
+_write_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+# Path of the DB whose transaction() the current task is inside, if any.
+_in_transaction: ContextVar[str | None] = ContextVar("nanoclaw_db_in_transaction", default=None)
+
+# Called with (task_id, next_run) whenever a task's schedule changes; next_run is
+# None when the task can no longer fire (paused, completed, deleted).
+TaskListener = Callable[[str, int | None], None]
+_task_listeners: list[TaskListener] = []
+
+
+def add_task_listener(listener: TaskListener) -> None:
+    _task_listeners.append(listener)
+
+
+def _notify(task_id: str, next_run: int | None) -> None:
+    for listener in _task_listeners:
+        listener(task_id, next_run)
+
+
+# --- Timestamps ---
+#
+# next_run and lease_expires are stored as UTC epoch milliseconds; everything
+# else (created_at, last_run, run_at, ...) stays ISO 8601 text.
+
+
+def to_epoch_ms(when: datetime) -> int:
+    """Epoch milliseconds for `when`; naive datetimes are taken as UTC."""
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return round(when.timestamp() * 1000)
+
+
+def from_epoch_ms(ms: int) -> datetime:
+    return datetime.fromtimestamp(ms / 1000, timezone.utc)
+
+
+def now_ms() -> int:
+    return round(time.time() * 1000)
+
+
+def parse_timestamp(value: str) -> datetime:
+    """Parse an ISO 8601 timestamp into an aware UTC datetime; naive ones are taken as UTC.
+
+    Raises ValueError for anything else.
+    """
+    parsed = datetime.fromisoformat(value.strip())
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+
+_F = TypeVar("_F", bound=Callable[..., Awaitable])
+
+
+def _timed(fn: _F) -> _F:
+    """Record the call's latency in the DB_CALL histogram, labelled by function name, and as a span of the current trace."""
+    span = f"db.{fn.__name__}"
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            end = time.perf_counter()
+            DB_CALL.observe(end - start, op=fn.__name__)
+            tracing.add_span(span, start, end)
+
+    return wrapper  # type: ignore[return-value]
+
+
+async def _connect(db_path: str) -> aiosqlite.Connection:
+    conn = await aiosqlite.connect(db_path, cached_statements=_STATEMENT_CACHE_SIZE)
+    conn.row_factory = aiosqlite.Row
+    await conn.executescript(_PRAGMAS)
+    return conn
+
+
+async def open_db(db_path: str, max_open: int = 64) -> None:
+    """Open the shared connection for `db_path`. Call once at startup.
+
+    Other paths used afterwards (shards) are kept open too, at most `max_open`.
+    """
+    global _main_path, _max_open
+    if _main_path == db_path:
+        return
+    await close_db()
+    _conns[db_path] = await _connect(db_path)
+    _main_path, _max_open = db_path, max_open
+
+
+async def close_db() -> None:
+    """Close every open connection. Safe to call when none is open."""
+    global _main_path
+    _main_path = None
+    while _conns:
+        _, conn = _conns.popitem()
+        await conn.close()
+    _conn_users.clear()
+
+
+async def _open_shard(db_path: str) -> aiosqlite.Connection:
+    """Open (creating if needed) a non-main DB file and keep it in the LRU."""
+    async with _open_lock:
+        if (conn := _conns.get(db_path)) is not None:
+            return conn
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        conn = await _connect(db_path)
+        await _init_schema(conn)
+        await conn.commit()
+        _conns[db_path] = conn
+        # Close idle shards past the cap; busy ones are skipped and retried next time.
+        idle = [p for p in _conns if p not in (_main_path, db_path) and not _conn_users.get(p)]
+        for path in idle[: max(0, len(_conns) - 1 - _max_open)]:
+            await _conns.pop(path).close()
+        return conn
+
+
+@asynccontextmanager
+async def _connection(db_path: str) -> AsyncIterator[aiosqlite.Connection]:
+    conn = _conns.get(db_path)
+    if conn is None and _main_path is None:
+        # No shared connection (scripts, benchmarks): use a short-lived one.
+        conn = await _connect(db_path)
+        try:
+            yield conn
+        finally:
+            await conn.close()
+        return
+    if conn is None:
+        conn = await _open_shard(db_path)
+    _conns.move_to_end(db_path)
+    _conn_users[db_path] = _conn_users.get(db_path, 0) + 1
+    try:
+        yield conn
+    finally:
+        _conn_users[db_path] -= 1
+        if not _conn_users[db_path]:
+            del _conn_users[db_path]
+
+
+def _write_lock(db_path: str) -> asyncio.Lock:
+    lock = _write_locks.get(db_path)
+    if lock is None:
+        lock = _write_locks[db_path] = asyncio.Lock()
+    return lock
+
+
+@asynccontextmanager
+async def _write(db_path: str) -> AsyncIterator[aiosqlite.Connection]:
+    """Run one write and commit it, unless an outer `transaction()` owns the commit."""
+    if _in_transaction.get() == db_path:
+        async with _connection(db_path) as conn:
+            yield conn
+        return
+    async with _write_lock(db_path), _connection(db_path) as conn:
+        yield conn
+        await conn.commit()
+
+
+@asynccontextmanager
+async def transaction(db_path: str) -> AsyncIterator[None]:
+    """Batch several write calls into a single commit.
+
+    Usage:
+        async with db.transaction(db_path):
+            await db.log_task_run(...)
+            await db.update_task_after_run(...)
+    """
+    if _in_transaction.get() == db_path:
+        yield
+        return
+    async with _write_lock(db_path), _connection(db_path) as conn:
+        token = _in_transaction.set(db_path)
+        try:
+            await conn.execute("BEGIN")
+            yield
+        except BaseException:
+            await conn.rollback()
+            raise
+        else:
+            await conn.commit()
+        finally:
+            _in_transaction.reset(token)
+
+
+# --- Schema migrations ---
+#
+# PRAGMA user_version holds the number of migrations applied. Each pending
+# migration runs in its own transaction together with the version bump, so a
+# DB is always at some exact version. Never edit a shipped migration; append.
+
+
+def _statements(script: str) -> list[str]:
+    """Split a SQL script into statements (executescript would commit the open transaction)."""
+    statements, buf = [], ""
+    for line in script.splitlines(keepends=True):
+        buf += line
+        if sqlite3.complete_statement(buf):
+            statements.append(buf.strip())
+            buf = ""
+    return statements
+
+
+async def _migrate_v1(db: aiosqlite.Connection) -> None:
+    """Baseline: create the pre-versioning schema, or finish one from an earlier release."""
+    for statement in _statements(_SCHEMA_V1):
+        await db.execute(statement)
+    # CREATE TABLE IF NOT EXISTS won't add columns to an existing table.
+    columns = {r["name"] for r in await db.execute_fetchall("PRAGMA table_info(scheduled_tasks)")}
+    for name, ddl in _V1_ADDED_TASK_COLUMNS.items():
+        if name not in columns:
+            await db.execute(f"ALTER TABLE scheduled_tasks ADD COLUMN {name} {ddl}")
+
+
+def _iso_to_ms(value: str | None) -> int | None:
+    try:
+        return to_epoch_ms(parse_timestamp(value)) if value else None
+    except ValueError:
+        return None
+
+
+async def _migrate_v2(db: aiosqlite.Connection) -> None:
+    """ISO text next_run/lease_expires -> epoch ms, with a partial index on active tasks."""
+    rows = await db.execute_fetchall("SELECT id, status, next_run, lease_expires FROM scheduled_tasks")
+    for statement in _statements(_SCHEMA_V2):
+        await db.execute(statement)
+    updates = []
+    for r in rows:
+        next_run, status = _iso_to_ms(r["next_run"]), r["status"]
+        if next_run is None and r["next_run"] and status in ("active", "running"):
+            # e.g. a "once" task stored with free-form text: it could never fire.
+            logger.warning("Task %s has unparseable next_run %r; marking it failed", r["id"], r["next_run"])
+            status = "failed"
+        updates.append((next_run, _iso_to_ms(r["lease_expires"]), status, r["id"]))
+    await db.executemany("UPDATE scheduled_tasks SET next_run = ?, lease_expires = ?, status = ? WHERE id = ?", updates)
+
+
+async def _migrate_v3(db: aiosqlite.Connection) -> None:
+    """Rollups with a skipped count; recompute those whose day's raw runs are all still there."""
+    for statement in _statements(_SCHEMA_V3):
+        await db.execute(statement)
+    rows = await db.execute_fetchall(
+        "SELECT l.task_id, substr(l.run_at, 1, 10) AS day, l.duration_ms, l.status FROM task_run_logs l "
+        "JOIN task_run_rollups r ON r.task_id = l.task_id AND r.day = substr(l.run_at, 1, 10)"
+    )
+    counts = {(r["task_id"], r["day"]): r["run_count"] for r in await db.execute_fetchall("SELECT task_id, day, run_count FROM task_run_rollups")}
+    updates = [(*_rollup(runs), task_id, day) for (task_id, day), runs in _group_runs(rows).items() if len(runs) == counts[(task_id, day)]]
+    await db.executemany("UPDATE task_run_rollups SET run_count = ?, error_count = ?, skipped_count = ?, p50_ms = ?, p95_ms = ? WHERE task_id = ? AND day = ?", updates)
+
+
+async def _migrate_v4(db: aiosqlite.Connection) -> None:
+    """Blob references by owner."""
+    for statement in _statements(_SCHEMA_V4):
+        await db.execute(statement)
+
+
+_MIGRATIONS: list[Callable[[aiosqlite.Connection], Awaitable[None]]] = [_migrate_v1, _migrate_v2, _migrate_v3, _migrate_v4]
+SCHEMA_VERSION = len(_MIGRATIONS)
+
+
+async def _migrate(db: aiosqlite.Connection) -> None:
+    version = (await db.execute_fetchall("PRAGMA user_version"))[0][0]
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f"Database schema version {version} is newer than this nanoclaw supports ({SCHEMA_VERSION})")
+    for target in range(version + 1, SCHEMA_VERSION + 1):
+        await db.commit()
+        await db.execute("BEGIN")
+        try:
+            await _MIGRATIONS[target - 1](db)
+            await db.execute(f"PRAGMA user_version = {target}")
+        except BaseException:
+            await db.rollback()
+            raise
         await db.commit()
+    if version < SCHEMA_VERSION:
+        logger.info("Database schema migrated from version %d to %d", version, SCHEMA_VERSION)
+
+
+async def _init_schema(db: aiosqlite.Connection) -> None:
+    # Incremental auto-vacuum lets retention hand freed pages back to the OS.
+    # Switching an existing DB over needs one full VACUUM.
+    rows = await db.execute_fetchall("PRAGMA auto_vacuum")
+    if rows[0][0] != 2:
+        await db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        await db.execute("VACUUM")
+    await _migrate(db)
+
+
+async def init_db(db_path: str) -> None:
+    async with _write(db_path) as db:
+        await _init_schema(db)
 
 
 # --- Task CRUD ---
 
-async def create_task(db_path: str, chat_id: int, prompt: str, schedule_type: str, schedule_value: str, next_run: str) -> str:
+@_timed
+async def create_task(
+    db_path: str,
+    chat_id: int,
+    prompt: str,
+    schedule_type: str,
+    schedule_value: str,
+    next_run: int,
+    misfire_policy: str = "once",
+    misfire_max: int = 10,
+    cache_ttl: int | None = None,
+    cache_inputs: list[str] | None = None,
+) -> str:
     task_id = uuid.uuid4().hex[:8]
-    async with aiosqlite.connect(db_path) as db:
+    created_at = datetime.now(timezone.utc).isoformat()
+    inputs_json = json.dumps(cache_inputs) if cache_inputs else None
+    async with _write(db_path) as db:
         await db.execute(
-            "INSERT INTO scheduled_tasks (id, chat_id, prompt, schedule_type, schedule_value, next_run, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (task_id, chat_id, prompt, schedule_type, schedule_value, next_run, datetime.now(timezone.utc).isoformat()),
+            "INSERT INTO scheduled_tasks (id, chat_id, prompt, schedule_type, schedule_value, next_run, created_at, misfire_policy, misfire_max, cache_ttl, cache_inputs) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (task_id, chat_id, prompt, schedule_type, schedule_value, next_run, created_at, misfire_policy, misfire_max, cache_ttl, inputs_json),
         )
-        await db.commit()
+    _notify(task_id, next_run)
     return task_id
 
 
-async def get_all_tasks(db_path: str) -> list[dict]:
-    async with aiosqlite.connect(db_path) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute("SELECT * FROM scheduled_tasks")
-        rows = await cursor.fetchall()
+# Columns for task listings: everything but last_result, with the prompt cut to a preview.
+_TASK_LIST_COLUMNS = (
+    "id, chat_id, substr(prompt, 1, ?) AS prompt, schedule_type, schedule_value, next_run, last_run, status, created_at, misfire_policy, cache_ttl"
+)
+
+
+@_timed
+async def list_tasks(
+    db_path: str, chat_id: int | None = None, status: str | None = None, limit: int = 20, offset: int = 0, prompt_chars: int = 60
+) -> tuple[list[dict], int]:
+    """One page of tasks (oldest first), optionally only `chat_id`'s and/or with `status`, and the total matching count."""
+    clauses, params = [], []
+    if chat_id is not None:
+        clauses.append("chat_id = ?")
+        params.append(chat_id)
+    if status is not None:
+        clauses.append("status = ?")
+        params.append(status)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    async with _connection(db_path) as db:
+        rows = await db.execute_fetchall(
+            f"SELECT {_TASK_LIST_COLUMNS} FROM scheduled_tasks {where} ORDER BY created_at, id LIMIT ? OFFSET ?", (prompt_chars, *params, limit, offset)
+        )
+        total = await db.execute_fetchall(f"SELECT COUNT(*) FROM scheduled_tasks {where}", params)
+        return [dict(r) for r in rows], total[0][0]
+
+
+@_timed
+async def count_tasks_by_status(db_path: str, chat_id: int) -> dict[str, int]:
+    async with _connection(db_path) as db:
+        rows = await db.execute_fetchall("SELECT status, COUNT(*) FROM scheduled_tasks WHERE chat_id = ? GROUP BY status", (chat_id,))
+        return {r[0]: r[1] for r in rows}
+
+
+@_timed
+async def get_tasks(db_path: str, task_ids: list[str]) -> list[dict]:
+    if not task_ids:
+        return []
+    placeholders = ", ".join("?" * len(task_ids))
+    async with _connection(db_path) as db:
+        rows = await db.execute_fetchall(f"SELECT * FROM scheduled_tasks WHERE id IN ({placeholders})", task_ids)
         return [dict(r) for r in rows]
 
 
+@_timed
+async def get_active_schedule(db_path: str, before: int | None = None) -> list[tuple[str, int]]:
+    """(task_id, next_run) for every task that can still fire, or only those due before `before` (epoch ms)."""
+    sql, params = "SELECT id, next_run FROM scheduled_tasks WHERE status = 'active' AND next_run IS NOT NULL", ()
+    if before is not None:
+        sql, params = sql + " AND next_run < ?", (before,)
+    async with _connection(db_path) as db:
+        rows = await db.execute_fetchall(sql, params)
+        return [(r["id"], r["next_run"]) for r in rows]
+
+
+@_timed
 async def get_due_tasks(db_path: str) -> list[dict]:
-    now = datetime.now(timezone.utc).isoformat()
-    async with aiosqlite.connect(db_path) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute(
+    async with _connection(db_path) as db:
+        rows = await db.execute_fetchall(
             "SELECT * FROM scheduled_tasks WHERE status = 'active' AND next_run <= ?",
-            (now,),
+            (now_ms(),),
         )
-        rows = await cursor.fetchall()
         return [dict(r) for r in rows]
 
 
-async def update_task_status(db_path: str, task_id: str, status: str) -> bool:
-    async with aiosqlite.connect(db_path) as db:
-        cursor = await db.execute(
-            "UPDATE scheduled_tasks SET status = ? WHERE id = ?",
-            (status, task_id),
+@_timed
+async def update_task_status(db_path: str, task_id: str, status: str, chat_id: int | None = None) -> bool:
+    """Set a task's status; with `chat_id`, only if the task belongs to that chat."""
+    async with _write(db_path) as db:
+        rows = await db.execute_fetchall(
+            "UPDATE scheduled_tasks SET status = ? WHERE id = ? AND (? IS NULL OR chat_id = ?) RETURNING next_run",
+            (status, task_id, chat_id, chat_id),
         )
-        await db.commit()
-        return cursor.rowcount > 0
+    if not rows:
+        return False
+    _notify(task_id, rows[0]["next_run"] if status == "active" else None)
+    return True
 
 
-async def delete_task(db_path: str, task_id: str) -> bool:
-    async with aiosqlite.connect(db_path) as db:
-        cursor = await db.execute("DELETE FROM scheduled_tasks WHERE id = ?", (task_id,))
-        await db.commit()
-        return cursor.rowcount > 0
+@_timed
+async def set_task_next_run(db_path: str, task_id: str, next_run: int | None, status: str = "active") -> None:
+    """Move an active task's next_run without recording a run (misfire skip / catch-up cap / given-up run)."""
+    async with _write(db_path) as db:
+        cursor = await db.execute("UPDATE scheduled_tasks SET next_run = ?, status = ?, attempts = 0 WHERE id = ? AND status = 'active'", (next_run, status, task_id))
+    if cursor.rowcount > 0:
+        _notify(task_id, next_run if status == "active" else None)
 
 
-async def update_task_after_run(db_path: str, task_id: str, last_result: str, next_run: str | None, status: str = "active") -> None:
+@_timed
+async def delete_task(db_path: str, task_id: str, chat_id: int | None = None) -> bool:
+    async with _write(db_path) as db:
+        cursor = await db.execute("DELETE FROM scheduled_tasks WHERE id = ? AND (? IS NULL OR chat_id = ?)", (task_id, chat_id, chat_id))
+    if cursor.rowcount <= 0:
+        return False
+    _notify(task_id, None)
+    return True
+
+
+@_timed
+async def update_task_after_run(
+    db_path: str, task_id: str, last_result: str, next_run: int | None, status: str = "active", lease_owner: str | None = None
+) -> bool:
+    """Record a finished run, advance the task and release its lease.
+
+    With `lease_owner`, nothing is written unless that owner still holds the
+    lease (another scheduler may have taken the task over). A task paused
+    while running stays paused. Returns whether the task was updated.
+    """
     now = datetime.now(timezone.utc).isoformat()
-    async with aiosqlite.connect(db_path) as db:
-        await db.execute(
-            "UPDATE scheduled_tasks SET last_run = ?, last_result = ?, next_run = ?, status = ? WHERE id = ?",
-            (now, last_result, next_run, status, task_id),
+    async with _write(db_path) as db:
+        rows = await db.execute_fetchall(
+            "UPDATE scheduled_tasks SET last_run = ?, last_result = ?, next_run = ?, status = CASE status WHEN 'paused' THEN 'paused' ELSE ? END, "
+            "lease_owner = NULL, lease_expires = NULL, attempts = 0 WHERE id = ? AND (? IS NULL OR lease_owner = ?) RETURNING status",
+            (now, last_result, next_run, status, task_id, lease_owner, lease_owner),
         )
-        await db.commit()
+    if not rows:
+        return False
+    _notify(task_id, next_run if rows[0]["status"] == "active" else None)
+    return True
 
 
-async def log_task_run(db_path: str, task_id: str, duration_ms: int, status: str, result: str | None = None, error: str | None = None) -> None:
-    async with aiosqlite.connect(db_path) as db:
-        await db.execute(
-            "INSERT INTO task_run_logs (task_id, run_at, duration_ms, status, result, error) VALUES (?, ?, ?, ?, ?, ?)",
+# --- Leases ---
+#
+# A scheduler claims a due task before running it: the row moves to status
+# 'running' with lease_owner/lease_expires set and attempts bumped, in one
+# UPDATE ... RETURNING, so of several schedulers sharing the DB exactly one
+# wins. The owner renews the lease while the run lasts; if it dies, the lease
+# runs out and expire_leases() makes the task due again.
+
+
+def _lease_until(lease_seconds: float) -> int:
+    return now_ms() + round(lease_seconds * 1000)
+
+
+@_timed
+async def claim_tasks(db_path: str, task_ids: list[str], owner: str, lease_seconds: float) -> list[dict]:
+    """Lease those of `task_ids` that are still active, due and unleased. Returns the claimed rows."""
+    if not task_ids:
+        return []
+    now = now_ms()
+    placeholders = ", ".join("?" * len(task_ids))
+    async with _write(db_path) as db:
+        rows = await db.execute_fetchall(
+            "UPDATE scheduled_tasks SET status = 'running', lease_owner = ?, lease_expires = ?, attempts = attempts + 1 "
+            f"WHERE id IN ({placeholders}) AND status = 'active' AND next_run <= ? AND (lease_expires IS NULL OR lease_expires < ?) RETURNING *",
+            (owner, _lease_until(lease_seconds), *task_ids, now, now),
+        )
+        return [dict(r) for r in rows]
+
+
+@_timed
+async def renew_lease(db_path: str, task_id: str, owner: str, lease_seconds: float) -> bool:
+    """Extend `owner`'s lease on a task. False if the lease has been lost."""
+    async with _write(db_path) as db:
+        rows = await db.execute_fetchall(
+            "UPDATE scheduled_tasks SET lease_expires = ? WHERE id = ? AND lease_owner = ? RETURNING id", (_lease_until(lease_seconds), task_id, owner)
+        )
+        return bool(rows)
+
+
+async def _clear_leases(db_path: str, where: str, params: tuple, attempt_delta: int) -> list[dict]:
+    async with _write(db_path) as db:
+        rows = await db.execute_fetchall(
+            "UPDATE scheduled_tasks SET status = CASE status WHEN 'running' THEN 'active' ELSE status END, "
+            f"lease_owner = NULL, lease_expires = NULL, attempts = max(0, attempts + ?) WHERE {where} RETURNING *",
+            (attempt_delta, *params),
+        )
+    tasks = [dict(r) for r in rows]
+    for task in tasks:
+        _notify(task["id"], task["next_run"] if task["status"] == "active" else None)
+    return tasks
+
+
+@_timed
+async def release_leases(db_path: str, owner: str) -> list[dict]:
+    """Hand back every lease `owner` holds (shutdown); the interrupted runs don't count as attempts."""
+    return await _clear_leases(db_path, "lease_owner = ?", (owner,), -1)
+
+
+@_timed
+async def expire_leases(db_path: str) -> list[dict]:
+    """Make tasks whose lease ran out (their scheduler died mid-run) due again. Returns them."""
+    return await _clear_leases(db_path, "lease_expires < ?", (now_ms(),), 0)
+
+
+@_timed
+async def log_task_run(
+    db_path: str, task_id: str, duration_ms: int, status: str, result: str | None = None, error: str | None = None, blobs: Iterable[str] = ()
+) -> None:
+    """Record a run; `blobs` are the digests of blobs its result references, owned by the run until it is pruned."""
+    async with _write(db_path) as db:
+        rows = await db.execute_fetchall(
+            "INSERT INTO task_run_logs (task_id, run_at, duration_ms, status, result, error) VALUES (?, ?, ?, ?, ?, ?) RETURNING id",
             (task_id, datetime.now(timezone.utc).isoformat(), duration_ms, status, result, error),
         )
-        await db.commit()
+        await db.executemany("INSERT OR IGNORE INTO blob_refs (digest, owner) VALUES (?, ?)", [(digest, f"run:{rows[0][0]}") for digest in blobs])
+
+
+@_timed
+async def add_blob_ref(db_path: str, digest: str, owner: str) -> None:
+    async with _write(db_path) as db:
+        await db.execute("INSERT OR IGNORE INTO blob_refs (digest, owner) VALUES (?, ?)", (digest, owner))
+
+
+# --- Run history and stats ---
+
+@_timed
+async def get_task_runs(db_path: str, task_id: str, chat_id: int | None = None, limit: int = 20, before: str | None = None) -> list[dict]:
+    """A task's runs, newest first, starting before the `before` run_at when given (pass the last row's run_at to page)."""
+    async with _connection(db_path) as db:
+        rows = await db.execute_fetchall(
+            "SELECT l.run_at, l.duration_ms, l.status, substr(l.error, 1, 200) AS error FROM task_run_logs l "
+            "WHERE l.task_id = ? AND l.run_at < ? "
+            "AND EXISTS (SELECT 1 FROM scheduled_tasks t WHERE t.id = l.task_id AND (? IS NULL OR t.chat_id = ?)) "
+            "ORDER BY l.run_at DESC LIMIT ?",
+            (task_id, before or "9999", chat_id, chat_id, limit),
+        )
+        return [dict(r) for r in rows]
+
+
+@_timed
+async def get_task_stats(db_path: str, since: str, chat_id: int | None = None, task_id: str | None = None) -> list[dict]:
+    """Per-task run counts, error counts and duration percentiles for runs since `since`.
+
+    Skipped misfires are counted but left out of the durations. Percentiles
+    are nearest-rank, computed in SQL so only one row per task comes back.
+    """
+    clauses, params = ["l.run_at >= ?"], [since]
+    if chat_id is not None:
+        clauses.append("l.task_id IN (SELECT id FROM scheduled_tasks WHERE chat_id = ?)")
+        params.append(chat_id)
+    if task_id is not None:
+        clauses.append("l.task_id = ?")
+        params.append(task_id)
+    async with _connection(db_path) as db:
+        rows = await db.execute_fetchall(
+            "WITH runs AS ("
+            "  SELECT task_id, status, duration_ms, run_at, "
+            "  ROW_NUMBER() OVER (PARTITION BY task_id ORDER BY status = 'skipped', duration_ms) AS rn, "
+            "  SUM(status != 'skipped') OVER (PARTITION BY task_id) AS n "
+            f"  FROM task_run_logs l WHERE {' AND '.join(clauses)}"
+            ") "
+            "SELECT task_id, COUNT(*) AS runs, SUM(status = 'error') AS errors, SUM(status = 'skipped') AS skipped, SUM(status = 'cached') AS cached, "
+            "MAX(CASE WHEN rn = (n * 50 + 99) / 100 THEN duration_ms END) AS p50_ms, "
+            "MAX(CASE WHEN rn = (n * 95 + 99) / 100 THEN duration_ms END) AS p95_ms, "
+            "MAX(CASE WHEN rn <= n THEN duration_ms END) AS max_ms, MAX(run_at) AS last_run_at "
+            "FROM runs GROUP BY task_id ORDER BY task_id",
+            params,
+        )
+        return [dict(r) for r in rows]
+
+
+# --- Run log retention ---
+
+def _percentile(sorted_values: list[int], q: float) -> int | None:
+    """Nearest-rank percentile of an ascending list (None if it is empty)."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(q * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def _group_runs(rows) -> dict[tuple[str, str], list]:
+    groups: dict[tuple[str, str], list] = {}
+    for r in rows:
+        groups.setdefault((r["task_id"], r["day"]), []).append(r)
+    return groups
+
+
+def _rollup(runs: list) -> tuple[int, int, int, int | None, int | None]:
+    """(run_count, error_count, skipped_count, p50_ms, p95_ms) of one day's runs, counted like get_task_stats."""
+    durations = sorted(r["duration_ms"] for r in runs if r["status"] != "skipped")
+    return (
+        len(runs),
+        sum(r["status"] == "error" for r in runs),
+        len(runs) - len(durations),
+        _percentile(durations, 0.50),
+        _percentile(durations, 0.95),
+    )
+
+
+@_timed
+async def rollup_task_runs(db_path: str, before_day: str) -> int:
+    """Write daily rollups for every (task, day) before `before_day` that has none yet.
+
+    Only closed days are rolled up, and retention never deletes raw rows from
+    a day before it has been rolled up, so each rollup reflects the full day.
+    Returns the number of rollup rows written.
+    """
+    async with _write(db_path) as db:
+        rows = await db.execute_fetchall(
+            "SELECT l.task_id, substr(l.run_at, 1, 10) AS day, l.duration_ms, l.status FROM task_run_logs l "
+            "WHERE substr(l.run_at, 1, 10) < ? AND NOT EXISTS ("
+            "  SELECT 1 FROM task_run_rollups r WHERE r.task_id = l.task_id AND r.day = substr(l.run_at, 1, 10)"
+            ")",
+            (before_day,),
+        )
+        groups = _group_runs(rows)
+        await db.executemany(
+            "INSERT INTO task_run_rollups (task_id, day, run_count, error_count, skipped_count, p50_ms, p95_ms) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(task_id, day, *_rollup(runs)) for (task_id, day), runs in groups.items()],
+        )
+        return len(groups)
+
+
+@_timed
+async def get_task_rollups(db_path: str, task_id: str) -> list[dict]:
+    async with _connection(db_path) as db:
+        rows = await db.execute_fetchall("SELECT * FROM task_run_rollups WHERE task_id = ? ORDER BY day", (task_id,))
+        return [dict(r) for r in rows]
+
+
+@_timed
+async def prune_task_runs(db_path: str, before_day: str, max_age_days: int, max_rows_per_task: int) -> tuple[int, list[str]]:
+    """Delete raw run logs past the age or per-task row cap.
+
+    Rows from `before_day` onwards (today) are always kept; roll up first.
+    Returns the rows deleted, and the digests of blobs nothing references any
+    more (for the caller to delete).
+    """
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=max_age_days)).isoformat()
+    async with _write(db_path) as db:
+        by_age = await db.execute_fetchall("DELETE FROM task_run_logs WHERE run_at < ? AND substr(run_at, 1, 10) < ? RETURNING id", (cutoff, before_day))
+        by_count = await db.execute_fetchall(
+            "DELETE FROM task_run_logs WHERE substr(run_at, 1, 10) < ? AND id IN ("
+            "  SELECT id FROM (SELECT id, ROW_NUMBER() OVER (PARTITION BY task_id ORDER BY id DESC) AS rn FROM task_run_logs) WHERE rn > ?"
+            ") RETURNING id",
+            (before_day, max_rows_per_task),
+        )
+        owners = [f"run:{r[0]}" for r in [*by_age, *by_count]]
+        if not owners:
+            return 0, []
+        released = await db.execute_fetchall("DELETE FROM blob_refs WHERE owner IN (SELECT value FROM json_each(?)) RETURNING digest", (json.dumps(owners),))
+        # A task's last_result isn't an owner, but it is one row per task: check it directly.
+        orphans = await db.execute_fetchall(
+            "SELECT DISTINCT d.value FROM json_each(?) d WHERE NOT EXISTS (SELECT 1 FROM blob_refs r WHERE r.digest = d.value) "
+            "AND NOT EXISTS (SELECT 1 FROM scheduled_tasks t WHERE instr(t.last_result, d.value) > 0)",
+            (json.dumps([r[0] for r in released]),),
+        )
+        return len(owners), [r[0] for r in orphans]
+
+
+@_timed
+async def incremental_vacuum(db_path: str, pages: int = 1000) -> None:
+    """Return up to `pages` free pages to the filesystem."""
+    async with _write(db_path) as db:
+        await db.execute_fetchall(f"PRAGMA incremental_vacuum({int(pages)})")
+
+
+# --- Conversation search ---
+
+@_timed
+async def index_exchanges(db_path: str, exchanges: list[tuple[str, str, int | None, str, str]]) -> None:
+    """Add (day, time, chat_id, user_message, assistant_response) rows to the search index."""
+    async with _write(db_path) as db:
+        await db.executemany(
+            "INSERT INTO conversation_index (day, time, chat_id, user_message, assistant_response) VALUES (?, ?, ?, ?, ?)",
+            exchanges,
+        )
+
+
+@_timed
+async def clear_conversation_index(db_path: str) -> None:
+    async with _write(db_path) as db:
+        await db.execute("DELETE FROM conversation_index")
+
+
+def _fts_query(text: str) -> str:
+    # Quote every term so user text can't trip FTS5 query syntax; terms are ANDed.
+    return " ".join('"' + term.replace('"', '""') + '"' for term in text.split())
+
+
+@_timed
+async def search_conversations(db_path: str, text: str, limit: int = 10, snippet_tokens: int = 24, chat_id: int | None = None) -> list[dict]:
+    """Best-matching exchanges for `text`, with short highlighted snippets; only `chat_id`'s when given."""
+    query = _fts_query(text)
+    if not query:
+        return []
+    async with _connection(db_path) as db:
+        rows = await db.execute_fetchall(
+            "SELECT day, time, chat_id, "
+            "snippet(conversation_index, 0, '**', '**', '…', ?) AS user_snippet, "
+            "snippet(conversation_index, 1, '**', '**', '…', ?) AS assistant_snippet "
+            "FROM conversation_index WHERE conversation_index MATCH ? AND (? IS NULL OR chat_id = ?) ORDER BY rank LIMIT ?",
+            (snippet_tokens, snippet_tokens, query, chat_id, chat_id, limit),
+        )
+        return [dict(r) for r in rows]
+
+
+# --- Structured memory ---
+
+def normalize_tags(tags: list[str]) -> str:
+    """Lowercased, de-duplicated, space-separated tags."""
+    cleaned = ("-".join(t.strip().lstrip("#").lower().split()) for t in tags)
+    return " ".join(sorted({t for t in cleaned if t}))
+
+
+@_timed
+async def upsert_memory(db_path: str, chat_id: int, key: str, content: str, tags: list[str], pinned: bool = False) -> bool:
+    """Add or replace the memory `key`. Returns True if it was new."""
+    now = datetime.now(timezone.utc).isoformat()
+    async with _write(db_path) as db:
+        rows = await db.execute_fetchall(
+            "INSERT INTO memories (chat_id, key, content, tags, pinned, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (chat_id, key) DO UPDATE SET content = excluded.content, tags = excluded.tags, pinned = excluded.pinned, updated_at = excluded.updated_at "
+            "RETURNING created_at = updated_at",
+            (chat_id, key, content, normalize_tags(tags), int(pinned), now, now),
+        )
+        return bool(rows[0][0])
+
+
+@_timed
+async def delete_memory(db_path: str, chat_id: int, key: str) -> bool:
+    async with _write(db_path) as db:
+        cursor = await db.execute("DELETE FROM memories WHERE chat_id = ? AND key = ?", (chat_id, key))
+        return cursor.rowcount > 0
+
+
+@_timed
+async def get_memory(db_path: str, chat_id: int, key: str) -> dict | None:
+    async with _connection(db_path) as db:
+        rows = await db.execute_fetchall("SELECT * FROM memories WHERE chat_id = ? AND key = ?", (chat_id, key))
+        return dict(rows[0]) if rows else None
+
+
+@_timed
+async def search_memories(db_path: str, chat_id: int, text: str = "", tag: str = "", limit: int = 10) -> list[dict]:
+    """Memories matching `text` and/or `tag`, best first; the most recently updated when both are empty."""
+    query = _fts_query(text)
+    if tag:
+        query = f"tags : {_fts_query(normalize_tags([tag]))} {query}".strip()
+    async with _connection(db_path) as db:
+        if not query:
+            rows = await db.execute_fetchall("SELECT * FROM memories WHERE chat_id = ? ORDER BY updated_at DESC LIMIT ?", (chat_id, limit))
+        else:
+            rows = await db.execute_fetchall(
+                "SELECT m.* FROM memory_index JOIN memories m ON m.id = memory_index.rowid "
+                "WHERE memory_index MATCH ? AND m.chat_id = ? ORDER BY rank LIMIT ?",
+                (query, chat_id, limit),
+            )
+        return [dict(r) for r in rows]
+
+
+@_timed
+async def get_memory_summary_rows(db_path: str, chat_id: int, limit: int) -> tuple[list[dict], int]:
+    """Up to `limit` memories in summary order (pinned, then most recent), and the total count."""
+    async with _connection(db_path) as db:
+        rows = await db.execute_fetchall(
+            "SELECT key, content, tags, pinned, updated_at FROM memories WHERE chat_id = ? ORDER BY pinned DESC, updated_at DESC LIMIT ?", (chat_id, limit)
+        )
+        total = await db.execute_fetchall("SELECT COUNT(*) FROM memories WHERE chat_id = ?", (chat_id,))
+        return [dict(r) for r in rows], total[0][0]
@@ -1,5 +1,35 @@
-from nanoclaw.config import ASSISTANT_NAME, WORKSPACE_DIR
-from nanoclaw.conversations import ensure_conversations_dir
+"""The agent's long-term memory.
+
+Memories live in the `memories` table and are read on demand with the
+recall tool. CLAUDE.md, which is loaded into every turn, only carries a
+generated summary of them, capped at MEMORY_SUMMARY_CHARS, so its size
+stays flat however much the agent remembers.
+"""
+
+import asyncio
+import logging
+import os
+import re
+import tempfile
+from pathlib import Path
+
+from nanoclaw import db
+from nanoclaw.config import ASSISTANT_NAME, MEMORY_SUMMARY_CHARS, WORKSPACE_DIR, get_chat_workspace
+
+logger = logging.getLogger(__name__)
+
+_SUMMARY_START = "<!-- nanoclaw:memory-summary:start (generated from the memory store; edits are overwritten) -->"
+_SUMMARY_END = "<!-- nanoclaw:memory-summary:end -->"
+_SUMMARY_ITEM_CHARS = 200
+# Rows read per refresh; far more than a summary budget can ever show.
+_SUMMARY_SCAN = 500
+
+# CLAUDE.md from before the memory store told the agent to keep facts in the
+# file itself. Sections other than these template ones hold those facts.
+_LEGACY_INSTRUCTION = "Update this file anytime using Write/Edit tools"
+_LEGACY_TEMPLATE_SECTIONS = {"Your Capabilities", "Task Scheduling", "Memory", "Conversation History", "Remembered"}
+_LEGACY_PLACEHOLDER = "(Add user preferences as you learn them)"
+_LEGACY_MEMORY_KEY = "claude-md-notes"
 
 _INITIAL_CLAUDE_MD = f"""# {ASSISTANT_NAME} - Personal AI Assistant
 
@@ -12,33 +42,137 @@ You are {ASSISTANT_NAME}, a personal AI assistant running on Telegram.
 - You can send messages to the user via `mcp__nanoclaw__send_message`
 - You can schedule tasks via `mcp__nanoclaw__schedule_task`
 - You can manage tasks via `mcp__nanoclaw__list_tasks`, `mcp__nanoclaw__pause_task`, `mcp__nanoclaw__resume_task`, `mcp__nanoclaw__cancel_task`
+- You can search past conversations via `mcp__nanoclaw__search_conversations`
 
 ## Task Scheduling
 When the user asks you to schedule or remind something:
 - Use `schedule_task` with schedule_type "cron" for recurring patterns (e.g. "0 9 * * 1" = every Monday 9am)
 - Use `schedule_task` with schedule_type "interval" for periodic tasks (value in milliseconds, e.g. "3600000" = every hour)
 - Use `schedule_task` with schedule_type "once" for one-time tasks (value is ISO 8601 timestamp)
+- Set misfire_policy "skip" for tasks that are pointless when late (e.g. a morning briefing), or "all" when every missed run matters
 
 ## Memory
-- This file (CLAUDE.md) is your long-term memory for preferences and important facts
+- Save preferences and important facts with `mcp__nanoclaw__remember` (key, content, tags); reuse a key to update it, set pinned for what matters in every conversation
+- Look memories up with `mcp__nanoclaw__recall` (query and/or tag) and delete stale ones with `mcp__nanoclaw__forget`
+- The "Remembered" section below is a size-limited summary generated from those memories; don't edit it or add facts to this file
 - The `conversations/` folder contains your chat history, organized by date (YYYY-MM-DD.md)
-- You can search conversations/ to recall past discussions
-- Update this file anytime using Write/Edit tools to remember important information
+- Use `search_conversations` to recall past discussions
 
 ## Conversation History
 Your conversation history is stored in `conversations/` folder:
 - Each file is named by date (e.g., `2024-01-15.md`)
-- Use Glob and Grep to search past conversations
-- Example: `Grep pattern="weather" path="conversations/"` to find weather-related chats
+- Use `search_conversations` first: it returns ranked, dated snippets from an index
+- Example: `search_conversations query="weather forecast"` to find weather-related chats
+- Open a day's file with Read only when you need the full exchange
 
-## User Preferences
-(Add user preferences as you learn them)
+## Remembered
+{_SUMMARY_START}
+(nothing yet)
+{_SUMMARY_END}
 """
 
 
-def ensure_workspace() -> None:
-    WORKSPACE_DIR.mkdir(parents=True, exist_ok=True)
-    ensure_conversations_dir()
-    claude_md = WORKSPACE_DIR / "CLAUDE.md"
+def render_summary(memories: list[dict], total: int, budget: int) -> str:
+    """Bullet list of `memories` (already in priority order), cut off at `budget` characters."""
+    lines: list[str] = []
+    used = 0
+    for m in memories:
+        content = " ".join(m["content"].split())
+        if len(content) > _SUMMARY_ITEM_CHARS:
+            content = content[: _SUMMARY_ITEM_CHARS - 1] + "…"
+        tags = f" ({m['tags']})" if m["tags"] else ""
+        line = f"- {'📌 ' if m['pinned'] else ''}**{m['key']}**{tags}: {content}"
+        if used + len(line) + 1 > budget:
+            break
+        lines.append(line)
+        used += len(line) + 1
+    if not lines:
+        return "(nothing yet)" if total == 0 else f"{total} memories; use recall to look them up."
+    if total > len(lines):
+        lines.append(f"_{total - len(lines)} more memories; use recall to look them up._")
+    return "\n".join(lines)
+
+
+def _write_summary(claude_md: Path, summary: str) -> None:
+    text = claude_md.read_text() if claude_md.exists() else ""
+    block = f"{_SUMMARY_START}\n{summary}\n{_SUMMARY_END}"
+    start, end = text.find(_SUMMARY_START), text.find(_SUMMARY_END)
+    if start != -1 and end > start:
+        text = text[:start] + block + text[end + len(_SUMMARY_END) :]
+    else:
+        # CLAUDE.md from before the memory store: append the section once.
+        text = text.rstrip() + f"\n\n## Remembered\n{block}\n"
+    _replace_file(claude_md, text)
+
+
+def _replace_file(path: Path, text: str) -> None:
+    """Write `text` to `path` atomically, through a temp file of its own so concurrent writers don't collide."""
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        os.replace(tmp, path)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+
+
+async def refresh_memory_summary(db_path: str, chat_id: int) -> None:
+    """Regenerate the summary section of the chat's CLAUDE.md from the memory store."""
+    memories, total = await db.get_memory_summary_rows(db_path, chat_id, _SUMMARY_SCAN)
+    summary = render_summary(memories, total, MEMORY_SUMMARY_CHARS)
+    await asyncio.to_thread(_write_summary, get_chat_workspace(chat_id) / "CLAUDE.md", summary)
+    logger.debug("Memory summary for chat %s: %d memories, %d chars", chat_id, total, len(summary))
+
+
+def legacy_notes(text: str) -> str:
+    """The free-form facts of a CLAUDE.md from before the memory store: its sections that aren't part of the template."""
+    sections = re.split(r"^## ", text, flags=re.MULTILINE)[1:]
+    notes = []
+    for section in sections:
+        heading, _, body = section.partition("\n")
+        body = body.replace(_LEGACY_PLACEHOLDER, "").strip()
+        if heading.strip() not in _LEGACY_TEMPLATE_SECTIONS and body:
+            notes.append(f"## {heading.strip()}\n{body}")
+    return "\n\n".join(notes)
+
+
+def _take_legacy_claude_md(claude_md: Path) -> str | None:
+    """Back up and reset a CLAUDE.md from before the memory store. Returns its old text, or None if there was nothing to migrate."""
+    if not claude_md.exists():
+        return None
+    text = claude_md.read_text()
+    if _SUMMARY_START in text and _LEGACY_INSTRUCTION not in text:
+        return None
+    claude_md.with_name("CLAUDE.md.pre-memory").write_text(text)
+    _replace_file(claude_md, _INITIAL_CLAUDE_MD)
+    return text
+
+
+async def migrate_claude_md(workspace: Path, db_path: str, chat_id: int) -> bool:
+    """Move the facts of a CLAUDE.md from before the memory store into it, once, and reset the file to the current template.
+
+    The old file is kept as CLAUDE.md.pre-memory. Returns True if it migrated.
+    """
+    text = await asyncio.to_thread(_take_legacy_claude_md, workspace / "CLAUDE.md")
+    if text is None:
+        return False
+    notes = legacy_notes(text)
+    if notes:
+        # These were loaded into every turn before, so keep them in the summary.
+        await db.upsert_memory(db_path, chat_id, _LEGACY_MEMORY_KEY, notes, ["claude-md"], pinned=True)
+    # With MULTI_CHAT the summary goes to the chat's own workspace, which may not exist yet.
+    await asyncio.to_thread(ensure_workspace, chat_id)
+    await refresh_memory_summary(db_path, chat_id)
+    logger.info("Migrated %s/CLAUDE.md into the memory store (%d chars of notes)", workspace, len(notes))
+    return True
+
+
+def ensure_workspace(chat_id: int | None = None) -> Path:
+    """Create the workspace (the chat's own one with MULTI_CHAT) and its CLAUDE.md. Returns its path."""
+    workspace = WORKSPACE_DIR if chat_id is None else get_chat_workspace(chat_id)
+    (workspace / "conversations").mkdir(parents=True, exist_ok=True)
+    claude_md = workspace / "CLAUDE.md"
     if not claude_md.exists():
         claude_md.write_text(_INITIAL_CLAUDE_MD)
+    return workspace
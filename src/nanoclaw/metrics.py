@@ -0,0 +1,196 @@
+"""In-process metrics served in Prometheus text format.
+
+Counters and histograms are plain Python objects updated on the event loop,
+so recording costs a dict lookup and a bisect. `start_metrics_server` exposes
+them at http://METRICS_HOST:METRICS_PORT/metrics.
+"""
+
+import asyncio
+import bisect
+import logging
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+_registry: list["_Metric"] = []
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        _registry.append(self)
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labels)
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", *self._samples()]
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()) -> None:
+        super().__init__(name, help_text, labels)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self) -> list[str]:
+        return [f"{self.name}{_format_labels(self.labels, k)} {v}" for k, v in self._values.items()]
+
+
+class Gauge(_Metric):
+    """A value read from `fn` at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, fn: Callable[[], float]) -> None:
+        super().__init__(name, help_text)
+        self._fn = fn
+
+    def _samples(self) -> list[str]:
+        try:
+            return [f"{self.name} {self._fn()}"]
+        except Exception:
+            logger.debug("Gauge %s failed", self.name, exc_info=True)
+            return []
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = _DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+        # Per label set: [per-bucket counts..., +Inf count], sum
+        self._values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1][0] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self) -> list[str]:
+        lines = []
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total[0]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+def render() -> str:
+    return "\n".join(line for metric in _registry for line in metric.render()) + "\n"
+
+
+# --- Metrics recorded across nanoclaw ---
+
+AGENT_TURN = Histogram("nanoclaw_agent_turn_seconds", "Agent turn duration", ("kind",))
+AGENT_WAIT = Histogram("nanoclaw_agent_wait_seconds", "Time waiting for the chat lock and a free agent slot", ("kind",))
+MCP_TOOL = Histogram("nanoclaw_mcp_tool_seconds", "nanoclaw MCP tool handler duration", ("tool",))
+SCHEDULER_LAG = Histogram("nanoclaw_scheduler_lag_seconds", "Task start time minus its next_run")
+DB_CALL = Histogram("nanoclaw_db_call_seconds", "Database call latency", ("op",), buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1))
+TELEGRAM_SEND = Histogram("nanoclaw_telegram_send_seconds", "Telegram send/edit latency", ("method",))
+TELEGRAM_ERRORS = Counter("nanoclaw_telegram_errors_total", "Failed Telegram sends", ("method",))
+SESSION_TURN_TOKENS = Histogram(
+    "nanoclaw_session_turn_input_tokens", "Input tokens (including cached) per chat turn", buckets=(1000, 5000, 10000, 25000, 50000, 100000, 150000, 200000)
+)
+OUTBOX_WAIT = Histogram("nanoclaw_outbox_wait_seconds", "Time an outbound message spent queued before its send started")
+OUTBOX_RETRIES = Counter("nanoclaw_outbox_retries_total", "Outbound Telegram calls retried", ("reason",))
+OUTBOX_DROPPED = Counter("nanoclaw_outbox_dropped_total", "Outbound Telegram messages given up on", ("reason",))
+OUTBOX_COALESCED = Counter("nanoclaw_outbox_coalesced_total", "Outbound messages merged into a preceding message")
+SDK_COST = Counter("nanoclaw_sdk_cost_usd_total", "Claude SDK cost reported by ResultMessage", ("kind",))
+SDK_TOKENS = Counter("nanoclaw_sdk_tokens_total", "Claude SDK token usage reported by ResultMessage", ("kind", "type"))
+CACHE_LOOKUPS = Counter("nanoclaw_response_cache_lookups_total", "Scheduled task response cache lookups", ("result",))
+CACHE_SAVED_USD = Counter("nanoclaw_response_cache_saved_usd_total", "Claude SDK cost avoided by response cache hits")
+MESSAGES_BATCHED = Counter("nanoclaw_messages_batched_total", "Incoming messages merged into another message's agent turn")
+SESSION_COMPACTIONS = Counter("nanoclaw_session_compactions_total", "Chat sessions summarized and restarted for size", ("reason",))
+WEBHOOK_REQUESTS = Counter("nanoclaw_webhook_requests_total", "Webhook requests by response status", ("status",))
+TASK_RUNS = Counter("nanoclaw_task_runs_total", "Scheduled task runs", ("status",))
+TRANSCRIPT_RESULTS_DEDUPED = Counter("nanoclaw_transcript_results_deduped_total", "Final agent results dropped because they repeated the streamed text")
+TRANSCRIPT_SPILLED_CHARS = Counter("nanoclaw_transcript_spilled_chars_total", "Characters of agent output spilled to the blob store")
+
+_USAGE_TYPES = ("input_tokens", "output_tokens", "cache_read_input_tokens", "cache_creation_input_tokens")
+
+
+@contextmanager
+def telegram_call(method: str) -> Iterator[None]:
+    """Time a Telegram API call and count it as an error if it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        TELEGRAM_ERRORS.inc(method=method)
+        raise
+    finally:
+        TELEGRAM_SEND.observe(time.perf_counter() - start, method=method)
+
+
+def record_result(kind: str, message) -> None:
+    """Record cost and token usage from a ResultMessage."""
+    if message.total_cost_usd:
+        SDK_COST.inc(message.total_cost_usd, kind=kind)
+    for usage_type in _USAGE_TYPES:
+        tokens = (message.usage or {}).get(usage_type)
+        if tokens:
+            SDK_TOKENS.inc(tokens, kind=kind, type=usage_type)
+
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host: str, port: int) -> asyncio.Server:
+    server = await asyncio.start_server(_handle, host, port)
+    logger.info("Metrics at http://%s:%d/metrics", host, port)
+    return server
@@ -0,0 +1,230 @@
+"""Single outbound path for Telegram messages.
+
+Every send and edit goes through a per-chat queue, so messages to one chat
+keep their order. Each send takes a token from the chat's bucket and from a
+global bucket, which keeps the bot under Telegram's flood limits instead of
+collecting 429s. When Telegram does answer RetryAfter, the chat's worker
+waits as told and retries. Short texts queued back to back for the same chat
+are merged into one message, and long texts are split at paragraph, line or
+word boundaries.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import timedelta
+from typing import Any, Awaitable, Callable
+
+from telegram import Message
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+from nanoclaw import metrics, tracing
+from nanoclaw.config import TELEGRAM_CHAT_RATE, TELEGRAM_GLOBAL_RATE
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_MAX_LENGTH = 4096
+_CHAT_BURST = 3
+_MAX_ATTEMPTS = 4
+_COALESCE_SEPARATOR = "\n\n"
+
+
+def split_message(text: str, limit: int = TELEGRAM_MAX_LENGTH) -> list[str]:
+    """Split `text` into chunks of at most `limit` chars, preferring paragraph, line, then word breaks."""
+    chunks = []
+    while len(text) > limit:
+        window = text[:limit]
+        for sep in ("\n\n", "\n", " "):
+            cut = window.rfind(sep)
+            if cut > limit // 2:
+                chunks.append(text[:cut])
+                text = text[cut + len(sep) :]
+                break
+        else:
+            chunks.append(window)
+            text = text[limit:]
+    if text or not chunks:
+        chunks.append(text)
+    return chunks
+
+
+class TokenBucket:
+    """`rate` tokens per second, holding at most `burst`."""
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._stamp = time.monotonic()
+
+    def full(self) -> bool:
+        """Whether the bucket has refilled, i.e. is as good as a new one."""
+        return self._tokens + (time.monotonic() - self._stamp) * self.rate >= self.burst
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+@dataclass
+class _Item:
+    method: str
+    future: asyncio.Future
+    text: str | None = None
+    bot: Any = None
+    call: Callable[[], Awaitable[Any]] | None = None
+    enqueued: float = field(default_factory=time.monotonic)
+
+
+class Outbox:
+    """Per-chat ordered queues drained by one worker task per busy chat."""
+
+    def __init__(self, global_rate: float, chat_rate: float) -> None:
+        self._global = TokenBucket(global_rate, max(1.0, global_rate))
+        self._chat_rate = chat_rate
+        self._buckets: dict[int, TokenBucket] = {}
+        self._queues: dict[int, deque[_Item]] = {}
+        self._workers: dict[int, asyncio.Task] = {}
+
+    async def send(self, bot, chat_id: int, text: str) -> list[Message]:
+        """Queue `text` for `chat_id` and wait until it is delivered.
+
+        May be merged with neighbouring sends; returns the message(s) that
+        carried it.
+        """
+        if not text:
+            return []
+        return await self._enqueue(chat_id, _Item("send_message", asyncio.get_running_loop().create_future(), text=text, bot=bot))
+
+    async def call(self, chat_id: int, method: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Run a Telegram call in `chat_id`'s queue, rate-limited and retried, and return its result."""
+        return await self._enqueue(chat_id, _Item(method, asyncio.get_running_loop().create_future(), call=fn))
+
+    def stats(self) -> dict[str, int]:
+        return {"queued": sum(len(q) for q in self._queues.values()), "chats": len(self._workers)}
+
+    async def close(self, timeout: float = 5.0) -> None:
+        """Give queued messages `timeout` seconds to go out, then drop the rest."""
+        workers = list(self._workers.values())
+        if workers:
+            await asyncio.wait(workers, timeout=timeout)
+        for chat_id, queue in self._queues.items():
+            for item in queue:
+                metrics.OUTBOX_DROPPED.inc(reason="shutdown")
+                if not item.future.done():
+                    item.future.set_exception(RuntimeError(f"Outbox closed before sending to chat {chat_id}"))
+            queue.clear()
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    def _enqueue(self, chat_id: int, item: _Item) -> asyncio.Future:
+        self._queues.setdefault(chat_id, deque()).append(item)
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._drain(chat_id))
+        return item.future
+
+    def _take(self, queue: deque[_Item]) -> list[_Item]:
+        """Pop the next item, plus any following sends small enough to share its message."""
+        items = [queue.popleft()]
+        if items[0].text is None or len(items[0].text) > TELEGRAM_MAX_LENGTH:
+            return items
+        size = len(items[0].text)
+        while queue and queue[0].text is not None and queue[0].bot is items[0].bot:
+            size += len(_COALESCE_SEPARATOR) + len(queue[0].text)
+            if size > TELEGRAM_MAX_LENGTH:
+                break
+            items.append(queue.popleft())
+        if len(items) > 1:
+            metrics.OUTBOX_COALESCED.inc(len(items) - 1)
+        return items
+
+    async def _drain(self, chat_id: int) -> None:
+        queue = self._queues[chat_id]
+        try:
+            while queue:
+                items = self._take(queue)
+                for item in items:
+                    metrics.OUTBOX_WAIT.observe(time.monotonic() - item.enqueued)
+                try:
+                    if items[0].call is not None:
+                        result = await self._attempt(chat_id, items[0].method, items[0].call)
+                    else:
+                        text = _COALESCE_SEPARATOR.join(i.text for i in items)
+                        bot = items[0].bot
+                        result = [
+                            await self._attempt(chat_id, "send_message", lambda chunk=chunk: bot.send_message(chat_id=chat_id, text=chunk))
+                            for chunk in split_message(text)
+                        ]
+                except Exception as e:
+                    metrics.OUTBOX_DROPPED.inc(len(items), reason=type(e).__name__)
+                    logger.warning("Dropped %d outbound message(s) to chat %s: %s", len(items), chat_id, e)
+                    for item in items:
+                        if not item.future.done():
+                            item.future.set_exception(e)
+                    continue
+                for item in items:
+                    if not item.future.done():
+                        item.future.set_result(result)
+        finally:
+            del self._workers[chat_id]
+            if not queue:
+                self._queues.pop(chat_id, None)
+            self._evict_buckets()
+
+    def _evict_buckets(self) -> None:
+        """Drop the buckets of idle chats that have refilled; a fresh one is created on their next send."""
+        for chat_id in [c for c, b in self._buckets.items() if c not in self._workers and b.full()]:
+            del self._buckets[chat_id]
+
+    async def _attempt(self, chat_id: int, method: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self._chat_rate, _CHAT_BURST)
+        for attempt in range(1, _MAX_ATTEMPTS + 1):
+            await bucket.acquire()
+            await self._global.acquire()
+            try:
+                with metrics.telegram_call(method):
+                    return await fn()
+            except RetryAfter as e:
+                if attempt == _MAX_ATTEMPTS:
+                    raise
+                delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+                metrics.OUTBOX_RETRIES.inc(reason="retry_after")
+                logger.info("Telegram flood limit for chat %s; retrying in %.0fs", chat_id, delay)
+                await asyncio.sleep(delay)
+            except BadRequest:
+                raise
+            except NetworkError:
+                if attempt == _MAX_ATTEMPTS:
+                    raise
+                metrics.OUTBOX_RETRIES.inc(reason="network")
+                await asyncio.sleep(2 ** (attempt - 1))
+
+
+_outbox = Outbox(TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE)
+metrics.Gauge("nanoclaw_outbox_queued", "Outbound Telegram messages waiting to be sent", lambda: _outbox.stats()["queued"])
+
+
+# The chat workers don't run in the sender's trace, so the span is taken here: queueing, pacing and retries included.
+async def send(bot, chat_id: int, text: str) -> list[Message]:
+    with tracing.span("telegram.send_message"):
+        return await _outbox.send(bot, chat_id, text)
+
+
+async def call(chat_id: int, method: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+    with tracing.span(f"telegram.{method}"):
+        return await _outbox.call(chat_id, method, fn)
+
+
+async def close_outbox() -> None:
+    await _outbox.close()
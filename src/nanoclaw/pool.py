@@ -0,0 +1,198 @@
+"""Warm Claude SDK clients, kept connected between turns.
+
+Starting a turn with `query()` spawns the Claude Code CLI, connects the MCP
+server and resumes the session from disk every time. A `WarmAgent` pays that
+once and then feeds follow-up prompts to the same subprocess. Agents are
+pooled by (chat_id, purpose), closed after `idle_timeout` seconds without a
+turn, and the least recently used one is closed when the pool is full.
+
+Before an agent that has already served a turn is handed out again, its CLI
+must answer a control request within `ping_timeout` seconds; a wedged or
+dead subprocess is closed and replaced by a fresh agent.
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Callable
+
+from claude_agent_sdk import ClaudeAgentOptions, ClaudeSDKClient, CLIConnectionError, Message
+
+from nanoclaw import tracing
+
+logger = logging.getLogger(__name__)
+
+_TURN_END = object()
+_PING = object()
+
+
+class WarmAgent:
+    """One connected ClaudeSDKClient serving turns in order.
+
+    The SDK requires a client to be used from the task that connected it, so
+    a background task owns the client and runs the turns sent to `run()`.
+    The agent closes itself after a failed turn; the pool replaces it on the
+    next request. Spans recorded while serving a turn (the MCP tools run in
+    the client's tasks) go to the trace of the caller of `run()`.
+    """
+
+    def __init__(self, key: tuple[int, str], options: ClaudeAgentOptions, idle_timeout: float, ping_timeout: float = 5.0) -> None:
+        self.key = key
+        self.idle_timeout = idle_timeout
+        self.ping_timeout = ping_timeout
+        self.last_used = time.monotonic()
+        self.turns = 0
+        # Turns handed to run() and not finished yet.
+        self.in_use = 0
+        self._options = options
+        self._requests: asyncio.Queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._serve())
+
+    @property
+    def alive(self) -> bool:
+        return not self._task.done()
+
+    async def run(self, prompt: str) -> AsyncIterator[Message]:
+        """Send `prompt` and yield messages up to and including the ResultMessage."""
+        if not self.alive:
+            raise CLIConnectionError(f"Warm agent {self.key} is closed")
+        self.last_used = time.monotonic()
+        out: asyncio.Queue = asyncio.Queue()
+        self._requests.put_nowait((prompt, out, tracing.current()))
+        self.in_use += 1
+        try:
+            while (item := await out.get()) is not _TURN_END:
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            self.in_use -= 1
+
+    async def ping(self, timeout: float) -> bool:
+        """Whether the CLI answers a control request within `timeout` seconds.
+
+        An agent that hasn't served a turn yet is still connecting (connect()
+        fails on its own if the CLI doesn't come up), so it isn't pinged.
+        """
+        if not self.alive:
+            return False
+        if self.turns == 0:
+            return True
+        out: asyncio.Queue = asyncio.Queue()
+        self._requests.put_nowait((_PING, out, None))
+        try:
+            return await asyncio.wait_for(out.get(), timeout) is True
+        except TimeoutError:
+            return False
+
+    def close(self) -> None:
+        self._requests.put_nowait(None)
+
+    async def wait_closed(self) -> None:
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _serve(self) -> None:
+        # Before connecting, so the client's tasks share the slot each turn's trace is put in.
+        slot = tracing.new_slot()
+        client = ClaudeSDKClient(options=self._options)
+        error: BaseException = CLIConnectionError(f"Warm agent {self.key} is closed")
+        try:
+            connect_start = time.perf_counter()
+            await client.connect()
+            connected = time.perf_counter()
+            logger.info("Warm agent %s connected", self.key)
+            while True:
+                try:
+                    request = await asyncio.wait_for(self._requests.get(), timeout=self.idle_timeout)
+                except TimeoutError:
+                    logger.info("Closing idle warm agent %s after %d turns", self.key, self.turns)
+                    return
+                if request is None:
+                    return
+                prompt, out, trace = request
+                if prompt is _PING:
+                    try:
+                        await asyncio.wait_for(client.get_mcp_status(), self.ping_timeout)
+                    except Exception as e:
+                        out.put_nowait(e)
+                        raise
+                    out.put_nowait(True)
+                    continue
+                slot.trace = trace
+                if slot.trace is not None:
+                    slot.trace.attrs["cold_start"] = self.turns == 0
+                    if self.turns == 0:
+                        slot.trace.add("sdk.connect", connect_start, connected)
+                try:
+                    await client.query(prompt)
+                    async for message in client.receive_response():
+                        out.put_nowait(message)
+                except Exception as e:
+                    out.put_nowait(e)
+                    raise
+                finally:
+                    slot.trace = None
+                out.put_nowait(_TURN_END)
+                self.turns += 1
+                self.last_used = time.monotonic()
+        except Exception as e:
+            logger.warning("Warm agent %s failed; it will be replaced", self.key, exc_info=True)
+            error = e
+        finally:
+            try:
+                await client.disconnect()
+            except Exception:
+                logger.debug("Ignoring warm agent disconnect error", exc_info=True)
+            # Fail anything that was queued while we were shutting down.
+            while not self._requests.empty():
+                request = self._requests.get_nowait()
+                if request is not None:
+                    request[1].put_nowait(error)
+
+
+class AgentPool:
+    """Warm agents keyed by (chat_id, purpose), bounded in size and idle time."""
+
+    def __init__(self, max_size: int, idle_timeout: float, ping_timeout: float = 5.0) -> None:
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.ping_timeout = ping_timeout
+        self._agents: OrderedDict[tuple[int, str], WarmAgent] = OrderedDict()
+
+    async def get(self, key: tuple[int, str], make_options: Callable[[], ClaudeAgentOptions]) -> WarmAgent:
+        """Return a live, responsive agent for `key`, connecting a new one if needed."""
+        agent = self._agents.get(key)
+        if agent is not None and agent.alive and not await agent.ping(self.ping_timeout):
+            logger.warning("Warm agent %s did not answer a ping within %.0fs; replacing it", key, self.ping_timeout)
+            agent.close()
+            agent = None
+        if agent is None or not agent.alive:
+            agent = self._agents[key] = WarmAgent(key, make_options(), self.idle_timeout, self.ping_timeout)
+        self._agents.move_to_end(key)
+        while len(self._agents) > self.max_size:
+            _, evicted = self._agents.popitem(last=False)
+            evicted.close()
+        return agent
+
+    def discard(self, key: tuple[int, str]) -> None:
+        """Close the agent for `key` so the next turn starts a fresh one."""
+        agent = self._agents.pop(key, None)
+        if agent is not None:
+            agent.close()
+
+    def trim(self, max_idle: int, keep: tuple[int, str] | None = None) -> None:
+        """Close least recently used idle agents (other than `keep`) until at most `max_idle` remain."""
+        idle = [key for key, agent in self._agents.items() if key != keep and agent.alive and not agent.in_use]
+        for key in idle[: max(0, len(idle) - max_idle)]:
+            self.discard(key)
+
+    def stats(self) -> dict[str, int]:
+        return {"warm": sum(a.alive for a in self._agents.values()), "max": self.max_size}
+
+    async def close(self) -> None:
+        agents = list(self._agents.values())
+        self._agents.clear()
+        for agent in agents:
+            agent.close()
+        await asyncio.gather(*(a.wait_closed() for a in agents))
@@ -0,0 +1,162 @@
+"""Opt-in result cache for scheduled tasks.
+
+A task created with `cache_ttl` reuses its last delivered messages while its
+prompt and declared inputs are unchanged, instead of starting an agent. Each
+input is a workspace file (fingerprinted by SHA-256 of its contents) or a URL
+(fingerprinted by its ETag or Last-Modified header). A URL with neither
+cannot be checked, so the task runs normally. Entries belong to the chat that
+stored them: another chat with the same prompt never gets them.
+
+Entries live in their own SQLite file next to nanoclaw.db, expire after the
+task's TTL, and the least recently used ones are evicted past
+RESPONSE_CACHE_MAX_ENTRIES.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import time
+import urllib.request
+from pathlib import Path
+
+import aiosqlite
+
+from nanoclaw import metrics
+from nanoclaw.config import RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_PATH
+
+logger = logging.getLogger(__name__)
+
+_CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS response_cache (
+    key TEXT PRIMARY KEY,
+    chat_id INTEGER NOT NULL,
+    task_id TEXT NOT NULL,
+    messages TEXT NOT NULL,
+    cost_usd REAL NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    expires_at REAL NOT NULL,
+    last_used REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_response_cache_last_used ON response_cache(last_used);
+"""
+
+_URL_TIMEOUT = 10
+
+
+def _file_fingerprint(path: Path) -> str:
+    try:
+        return hashlib.sha256(path.read_bytes()).hexdigest()
+    except FileNotFoundError:
+        return "missing"
+
+
+def _url_fingerprint(url: str) -> str | None:
+    request = urllib.request.Request(url, method="HEAD")
+    with urllib.request.urlopen(request, timeout=_URL_TIMEOUT) as response:
+        validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+    return f"{response.status}:{validator}" if validator else None
+
+
+async def cache_key(chat_id: int, prompt: str, inputs: list[str], workspace: Path) -> str | None:
+    """Key for `prompt` in `chat_id` with the current state of `inputs` (files relative to the chat's `workspace`), or None if one can't be fingerprinted."""
+    fingerprints = []
+    for source in sorted(inputs):
+        try:
+            if source.startswith(("http://", "https://")):
+                fingerprint = await asyncio.to_thread(_url_fingerprint, source)
+            else:
+                fingerprint = await asyncio.to_thread(_file_fingerprint, workspace / source)
+        except Exception as e:
+            logger.info("Cannot fingerprint cache input %s: %s", source, e)
+            return None
+        if fingerprint is None:
+            logger.info("Cache input %s has no ETag or Last-Modified; not caching", source)
+            return None
+        fingerprints.append([source, fingerprint])
+    return hashlib.sha256(json.dumps([chat_id, str(workspace), prompt, fingerprints]).encode()).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path: Path, max_entries: int) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self._conn: aiosqlite.Connection | None = None
+        self._lock = asyncio.Lock()
+
+    async def _db(self) -> aiosqlite.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = await aiosqlite.connect(self.path)
+            columns = [row[1] for row in await conn.execute_fetchall("PRAGMA table_info(response_cache)")]
+            if columns and "chat_id" not in columns:
+                # Entries from before they were scoped to a chat; a cache can just start over.
+                await conn.execute("DROP TABLE response_cache")
+            await conn.executescript("PRAGMA journal_mode = WAL;\nPRAGMA synchronous = NORMAL;\n" + _CREATE_TABLE)
+            self._conn = conn
+        return self._conn
+
+    async def get(self, key: str, chat_id: int) -> tuple[list[str], float] | None:
+        """The cached (messages, cost_usd) `chat_id` stored under `key`, counting the hit; None on a miss or expiry."""
+        now = time.time()
+        async with self._lock:
+            db = await self._db()
+            rows = await db.execute_fetchall(
+                "UPDATE response_cache SET last_used = ?, hits = hits + 1 WHERE key = ? AND chat_id = ? AND expires_at > ? RETURNING messages, cost_usd",
+                (now, key, chat_id, now),
+            )
+            await db.commit()
+        if not rows:
+            metrics.CACHE_LOOKUPS.inc(result="miss")
+            return None
+        metrics.CACHE_LOOKUPS.inc(result="hit")
+        metrics.CACHE_SAVED_USD.inc(rows[0][1])
+        return json.loads(rows[0][0]), rows[0][1]
+
+    async def put(self, key: str, chat_id: int, task_id: str, messages: list[str], cost_usd: float, ttl: float) -> None:
+        now = time.time()
+        async with self._lock:
+            db = await self._db()
+            await db.execute(
+                "INSERT OR REPLACE INTO response_cache (key, chat_id, task_id, messages, cost_usd, created_at, expires_at, last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, chat_id, task_id, json.dumps(messages), cost_usd, now, now + ttl, now),
+            )
+            # Expired entries first, then the least recently used beyond the cap.
+            await db.execute("DELETE FROM response_cache WHERE expires_at <= ?", (now,))
+            await db.execute(
+                "DELETE FROM response_cache WHERE key IN (SELECT key FROM response_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,)
+            )
+            await db.commit()
+
+    async def stats(self) -> dict[str, float]:
+        """Entries, lifetime hits and USD saved by hits, over the entries still cached."""
+        async with self._lock:
+            db = await self._db()
+            rows = await db.execute_fetchall("SELECT COUNT(*), COALESCE(SUM(hits), 0), COALESCE(SUM(hits * cost_usd), 0) FROM response_cache")
+        entries, hits, saved = rows[0]
+        return {"entries": entries, "hits": hits, "saved_usd": saved}
+
+    async def close(self) -> None:
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            await conn.close()
+
+
+_cache = ResponseCache(RESPONSE_CACHE_PATH, RESPONSE_CACHE_MAX_ENTRIES)
+
+
+async def get_cached(key: str, chat_id: int) -> tuple[list[str], float] | None:
+    return await _cache.get(key, chat_id)
+
+
+async def store(key: str, chat_id: int, task_id: str, messages: list[str], cost_usd: float, ttl: float) -> None:
+    await _cache.put(key, chat_id, task_id, messages, cost_usd, ttl)
+
+
+async def cache_stats() -> dict[str, float]:
+    return await _cache.stats()
+
+
+async def close_response_cache() -> None:
+    await _cache.close()
@@ -1,83 +1,515 @@
+import asyncio
+import heapq
+import json
 import logging
+import random
 import time
+from collections import deque
 from datetime import datetime, timedelta, timezone
 
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from croniter import croniter
 
-from nanoclaw import db
+from nanoclaw import db, metrics, outbox, response_cache, transcript
 from nanoclaw.agent import run_task_agent
-from nanoclaw.config import SCHEDULER_INTERVAL
+from nanoclaw.config import (
+    MISFIRE_GRACE,
+    MISFIRE_JITTER,
+    RETENTION_INTERVAL,
+    RUN_LOG_MAX_AGE_DAYS,
+    RUN_LOG_MAX_RESULT_CHARS,
+    RUN_LOG_MAX_ROWS_PER_TASK,
+    SCHEDULER_CONCURRENCY,
+    SCHEDULER_ID,
+    SCHEDULER_INTERVAL,
+    TASK_LEASE_SECONDS,
+    TASK_MAX_ATTEMPTS,
+    get_chat_workspace,
+)
 
 logger = logging.getLogger(__name__)
 
-_scheduler: AsyncIOScheduler | None = None
+# Upper bound on cron occurrences walked when counting missed runs.
+_MAX_CRON_SCAN = 100_000
 
+_scheduler: "NextRunTimer | None" = None
+_executor: "TaskExecutor | None" = None
+_maintenance: asyncio.Task | None = None
 
-def setup_scheduler(bot, db_path: str) -> AsyncIOScheduler:
-    global _scheduler
-    _scheduler = AsyncIOScheduler()
-    _scheduler.add_job(
-        _check_tasks,
-        "interval",
-        seconds=SCHEDULER_INTERVAL,
-        args=[bot, db_path],
-        id="check_tasks",
-        replace_existing=True,
-    )
-    return _scheduler
 
+class TaskExecutor:
+    """Runs due tasks concurrently, up to `concurrency` agents at a time.
 
-async def _check_tasks(bot, db_path: str) -> None:
-    try:
-        tasks = await db.get_due_tasks(db_path)
-    except Exception:
-        logger.exception("Failed to query due tasks")
-        return
+    Due tasks wait in one queue per chat and are started round-robin across
+    chats, so a chat with many tasks cannot starve the others. Submitted
+    tasks have been leased to `owner` (see db.claim_tasks); a task stays "in
+    flight" from the moment it is queued until its next_run has been written
+    back, and its lease is renewed all that time. A task whose lease is lost
+    while still queued is dropped, since another scheduler now owns it.
+    """
+
+    def __init__(self, bot, db_path: str, concurrency: int, owner: str = SCHEDULER_ID, lease_seconds: float = TASK_LEASE_SECONDS) -> None:
+        self.bot = bot
+        self.db_path = db_path
+        self.concurrency = max(1, concurrency)
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self._queues: dict[int, deque[dict]] = {}
+        self._order: deque[int] = deque()
+        self._in_flight: set[str] = set()
+        self._lost: set[str] = set()
+        self._running: set[asyncio.Task] = set()
+        self._renewer: asyncio.Task | None = None
+
+    def submit(self, task: dict) -> bool:
+        """Queue a claimed task. Returns False if it is already queued or running."""
+        if task["id"] in self._in_flight:
+            return False
+        self._in_flight.add(task["id"])
+        if self._renewer is None:
+            self._renewer = asyncio.create_task(self._renew_leases())
+        chat_id = task["chat_id"]
+        if chat_id not in self._queues:
+            self._queues[chat_id] = deque()
+            self._order.append(chat_id)
+        self._queues[chat_id].append(task)
+        self._dispatch()
+        return True
+
+    def stats(self) -> dict:
+        """Queue depth, running count and the lag of the oldest queued task."""
+        now = datetime.now(timezone.utc)
+        lags = [_lag_seconds(t, now) for q in self._queues.values() for t in q]
+        return {
+            "queued": sum(len(q) for q in self._queues.values()),
+            "running": len(self._running),
+            "max_lag_s": max(lags, default=0.0),
+        }
 
-    for task in tasks:
+    def _next(self) -> dict | None:
+        if not self._order:
+            return None
+        chat_id = self._order.popleft()
+        queue = self._queues[chat_id]
+        task = queue.popleft()
+        if queue:
+            self._order.append(chat_id)
+        else:
+            del self._queues[chat_id]
+        return task
+
+    def _dispatch(self) -> None:
+        while len(self._running) < self.concurrency:
+            task = self._next()
+            if task is None:
+                return
+            if task["id"] in self._lost:
+                self._lost.discard(task["id"])
+                self._in_flight.discard(task["id"])
+                continue
+            lag = _lag_seconds(task, datetime.now(timezone.utc))
+            metrics.SCHEDULER_LAG.observe(lag)
+            logger.info("Starting task %s (lag %.1fs)", task["id"], lag)
+            running = asyncio.create_task(self._run(task))
+            self._running.add(running)
+            running.add_done_callback(self._on_done)
+
+    async def _run(self, task: dict) -> None:
         try:
-            await _execute_task(task, bot, db_path)
+            await _execute_task(task, self.bot, self.db_path, self.owner)
         except Exception:
             logger.exception("Failed to execute task %s", task["id"])
+        finally:
+            self._in_flight.discard(task["id"])
+            self._lost.discard(task["id"])
+
+    async def _renew_leases(self) -> None:
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            for task_id in list(self._in_flight - self._lost):
+                try:
+                    # A run can finish (releasing its lease) while the renewal is in flight.
+                    if not await db.renew_lease(self.db_path, task_id, self.owner, self.lease_seconds) and task_id in self._in_flight:
+                        logger.warning("Lost the lease on task %s; another scheduler may run it", task_id)
+                        self._lost.add(task_id)
+                except Exception:
+                    logger.exception("Failed to renew the lease on task %s", task_id)
+
+    def _on_done(self, running: asyncio.Task) -> None:
+        self._running.discard(running)
+        self._dispatch()
+
+    async def stop(self) -> None:
+        """Drop queued tasks, cancel running ones and hand back their leases; they fire again after restart."""
+        self._queues.clear()
+        self._order.clear()
+        running = list(self._running)
+        if self._renewer is not None:
+            running.append(self._renewer)
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        released = await db.release_leases(self.db_path, self.owner)
+        if released:
+            logger.info("Released leases on %d tasks", len(released))
+
+
+class NextRunTimer:
+    """Fires tasks at their next_run without polling the DB.
+
+    Keeps a min-heap of (next_run, task_id) loaded once at start and kept
+    current through `db.add_task_listener`. The loop sleeps until the
+    earliest deadline (at most `max_sleep` seconds, to ride out wall-clock
+    jumps) and is woken early when a sooner deadline arrives. Superseded
+    heap entries are dropped lazily when they reach the top.
+
+    A task firing more than MISFIRE_GRACE seconds late (e.g. after downtime)
+    is handled by its misfire_policy: "skip" moves it to its next future
+    slot, "once" runs it once, and "all" replays up to misfire_max missed
+    slots. Late runs are delayed by a random 0..MISFIRE_JITTER seconds so a
+    restart doesn't start every overdue task at the same instant.
+
+    Due tasks are claimed (leased) before they are queued, so several
+    schedulers can share one DB and each run happens once. Every `max_sleep`
+    seconds the timer also sweeps: tasks whose lease ran out are made due
+    again (given up after TASK_MAX_ATTEMPTS lost leases in a row), and tasks
+    due before the next sweep are read from the DB, which picks up tasks
+    scheduled or rescheduled by other processes.
+    """
+
+    def __init__(self, executor: TaskExecutor, max_sleep: float) -> None:
+        self.executor = executor
+        self.max_sleep = max_sleep
+        self._heap: list[tuple[datetime, str]] = []
+        self._deadlines: dict[str, datetime] = {}
+        self._wake = asyncio.Event()
+        self._loop_task: asyncio.Task | None = None
+        self._jittered: set[str] = set()
+        self._next_sweep = 0.0
+
+    def start(self) -> None:
+        self._loop_task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            await asyncio.gather(self._loop_task, return_exceptions=True)
+
+    def update(self, task_id: str, next_run: int | None) -> None:
+        """db task listener: (re)schedule `task_id`, or forget it when next_run is None."""
+        # A jitter delay was for the slot being replaced (or the task was paused or deleted).
+        self._jittered.discard(task_id)
+        if next_run is None:
+            self._deadlines.pop(task_id, None)
+            return
+        self._push(task_id, db.from_epoch_ms(next_run))
+
+    def _push(self, task_id: str, deadline: datetime) -> None:
+        self._deadlines[task_id] = deadline
+        heapq.heappush(self._heap, (deadline, task_id))
+        if self._heap[0] == (deadline, task_id):
+            self._wake.set()
+
+    def _peek(self) -> datetime | None:
+        while self._heap:
+            deadline, task_id = self._heap[0]
+            if self._deadlines.get(task_id) == deadline:
+                return deadline
+            heapq.heappop(self._heap)
+        return None
+
+    def _pop_due(self, now: datetime) -> list[str]:
+        due = []
+        while (deadline := self._peek()) is not None and deadline <= now:
+            _, task_id = heapq.heappop(self._heap)
+            del self._deadlines[task_id]
+            due.append(task_id)
+        return due
+
+    async def _run(self) -> None:
+        # Leases still held under our name are from a previous life of this process (stable SCHEDULER_ID).
+        await db.release_leases(self.executor.db_path, self.executor.owner)
+        for task_id, next_run in await db.get_active_schedule(self.executor.db_path):
+            self.update(task_id, next_run)
+        logger.info("Scheduler loaded %d active tasks", len(self._deadlines))
+
+        while True:
+            self._wake.clear()
+            if time.monotonic() >= self._next_sweep:
+                self._next_sweep = time.monotonic() + self.max_sleep
+                try:
+                    await self._sweep(datetime.now(timezone.utc))
+                except Exception:
+                    logger.exception("Scheduler sweep failed")
+            due = self._pop_due(datetime.now(timezone.utc))
+            if due:
+                await self._fire(due)
+
+            deadline = self._peek()
+            delay = self.max_sleep
+            if deadline is not None:
+                delay = min(delay, max(0.0, (deadline - datetime.now(timezone.utc)).total_seconds()))
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=delay)
+            except TimeoutError:
+                pass
+
+    async def _fire(self, task_ids: list[str]) -> None:
+        now = datetime.now(timezone.utc)
+        try:
+            tasks = await db.get_tasks(self.executor.db_path, task_ids)
+        except Exception:
+            logger.exception("Failed to load due tasks; retrying in %ss", self.max_sleep)
+            for task_id in task_ids:
+                self._push(task_id, now + timedelta(seconds=self.max_sleep))
+            return
+
+        runnable = []
+        for task in tasks:
+            if task["status"] != "active":
+                continue
+            # The heap may be ahead of the DB (e.g. a rolled-back update); trust the row.
+            deadline = _next_run(task)
+            if deadline is not None and deadline > now:
+                self._push(task["id"], deadline)
+                continue
+            if _lag_seconds(task, now) > MISFIRE_GRACE and not await self._handle_misfire(task, now):
+                continue
+            runnable.append(task["id"])
+
+        try:
+            claimed = await db.claim_tasks(self.executor.db_path, runnable, self.executor.owner, self.executor.lease_seconds)
+        except Exception:
+            logger.exception("Failed to claim due tasks; retrying in %ss", self.max_sleep)
+            for task_id in runnable:
+                self._push(task_id, now + timedelta(seconds=self.max_sleep))
+            return
+        if len(claimed) < len(runnable):
+            logger.info("Scheduler: %d due tasks already claimed elsewhere", len(runnable) - len(claimed))
+        queued = sum(self.executor.submit(task) for task in claimed)
+
+        stats = self.executor.stats()
+        logger.info("Scheduler: %d newly due, %d queued, %d running, max lag %.1fs", queued, stats["queued"], stats["running"], stats["max_lag_s"])
+
+    async def _sweep(self, now: datetime) -> None:
+        """Recover expired leases and load tasks due before the next sweep."""
+        db_path = self.executor.db_path
+        for task in await db.expire_leases(db_path):
+            if task["status"] != "active":
+                continue
+            if task["attempts"] >= TASK_MAX_ATTEMPTS:
+                next_run = _next_future_slot(task, now)
+                logger.error("Task %s lost its lease %d times in a row; giving up this run, next at %s", task["id"], task["attempts"], next_run)
+                async with db.transaction(db_path):
+                    await db.log_task_run(db_path, task["id"], 0, "error", error=f"Abandoned after {task['attempts']} interrupted attempts")
+                    await db.set_task_next_run(db_path, task["id"], _epoch_ms(next_run), "active" if next_run else "failed")
+            else:
+                logger.warning("Lease on task %s expired (attempt %d); it will run again", task["id"], task["attempts"])
+
+        horizon = db.to_epoch_ms(now + timedelta(seconds=self.max_sleep))
+        for task_id, next_run in await db.get_active_schedule(db_path, before=horizon):
+            deadline = db.from_epoch_ms(next_run)
+            if task_id not in self._jittered and self._deadlines.get(task_id) != deadline:
+                self._push(task_id, deadline)
 
+    async def _handle_misfire(self, task: dict, now: datetime) -> bool:
+        """Apply the task's misfire policy. Returns True if it should run now."""
+        task_id = task["id"]
+        if task_id in self._jittered:
+            self._jittered.discard(task_id)
+            return True
 
-async def _execute_task(task: dict, bot, db_path: str) -> None:
+        policy = task.get("misfire_policy") or "once"
+        if policy == "skip":
+            next_run = _next_future_slot(task, now)
+            logger.info("Task %s missed its slot; skipping to %s", task_id, next_run)
+            async with db.transaction(self.executor.db_path):
+                await db.log_task_run(self.executor.db_path, task_id, 0, "skipped")
+                await db.set_task_next_run(self.executor.db_path, task_id, _epoch_ms(next_run), "active" if next_run else "missed")
+            return False
+
+        if policy == "all" and (start := _catch_up_start(task, now)) is not None:
+            logger.info("Task %s missed more than %d slots; replaying from %s", task_id, task["misfire_max"], start.isoformat())
+            task["next_run"] = db.to_epoch_ms(start)
+            await db.set_task_next_run(self.executor.db_path, task_id, task["next_run"])
+
+        if MISFIRE_JITTER <= 0:
+            return True
+        self._jittered.add(task_id)
+        self._push(task_id, now + timedelta(seconds=random.uniform(0, MISFIRE_JITTER)))
+        return False
+
+
+def _next_occurrence(task: dict, after: datetime) -> datetime | None:
+    """The task's next slot strictly after `after`, or None for one-off tasks."""
+    if task["schedule_type"] == "cron":
+        return croniter(task["schedule_value"], after).get_next(datetime)
+    if task["schedule_type"] == "interval":
+        return after + timedelta(milliseconds=int(task["schedule_value"]))
+    return None
+
+
+def _next_future_slot(task: dict, now: datetime) -> datetime | None:
+    """Next slot after `now`; interval tasks keep their original phase."""
+    scheduled = _next_run(task) or now
+    if task["schedule_type"] == "interval":
+        step = timedelta(milliseconds=int(task["schedule_value"]))
+        return scheduled + step * ((now - scheduled) // step + 1)
+    return _next_occurrence(task, now)
+
+
+def _catch_up_start(task: dict, now: datetime) -> datetime | None:
+    """For "all": the missed slot to replay from so at most misfire_max runs remain.
+
+    Returns None when the backlog is already within the cap.
+    """
+    scheduled = _next_run(task)
+    cap = max(1, int(task.get("misfire_max") or 1))
+    if scheduled is None:
+        return None
+    if task["schedule_type"] == "interval":
+        step = timedelta(milliseconds=int(task["schedule_value"]))
+        missed = (now - scheduled) // step + 1
+        return scheduled + step * (missed - cap) if missed > cap else None
+    if task["schedule_type"] == "cron":
+        recent = deque([scheduled], maxlen=cap)
+        missed = 1
+        it = croniter(task["schedule_value"], scheduled)
+        while missed < _MAX_CRON_SCAN and (slot := it.get_next(datetime)) <= now:
+            recent.append(slot)
+            missed += 1
+        return recent[0] if missed > cap else None
+    return None
+
+
+metrics.Gauge("nanoclaw_scheduler_queued", "Due tasks waiting for a worker", lambda: _executor.stats()["queued"] if _executor else 0)
+metrics.Gauge("nanoclaw_scheduler_running", "Scheduled tasks running", lambda: _executor.stats()["running"] if _executor else 0)
+metrics.Gauge("nanoclaw_scheduler_tasks", "Active tasks waiting in the next-run timer", lambda: len(_scheduler._deadlines) if _scheduler else 0)
+
+
+def _next_run(task: dict) -> datetime | None:
+    return db.from_epoch_ms(task["next_run"]) if task["next_run"] is not None else None
+
+
+def _epoch_ms(when: datetime | None) -> int | None:
+    return db.to_epoch_ms(when) if when is not None else None
+
+
+def _lag_seconds(task: dict, now: datetime) -> float:
+    next_run = _next_run(task)
+    return max(0.0, (now - next_run).total_seconds()) if next_run else 0.0
+
+
+def _truncate(text: str | None, limit: int) -> str | None:
+    if text is None or len(text) <= limit:
+        return text
+    return text[:limit] + f"\n…[truncated {len(text) - limit} chars]"
+
+
+async def run_retention(db_path: str) -> None:
+    """Roll up closed days, prune raw run logs and the blobs only they referenced, then vacuum freed pages."""
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    rolled = await db.rollup_task_runs(db_path, today)
+    pruned, orphans = await db.prune_task_runs(db_path, today, RUN_LOG_MAX_AGE_DAYS, RUN_LOG_MAX_ROWS_PER_TASK)
+    blobs = 0
+    for digest in orphans:
+        blobs += await asyncio.to_thread(transcript.delete_blob, digest)
+    await db.incremental_vacuum(db_path)
+    if rolled or pruned:
+        logger.info("Run log retention: %d day rollups written, %d raw rows pruned, %d blobs deleted", rolled, pruned, blobs)
+
+
+async def _maintenance_loop(db_path: str) -> None:
+    while True:
+        try:
+            await run_retention(db_path)
+        except Exception:
+            logger.exception("Run log retention failed")
+        await asyncio.sleep(RETENTION_INTERVAL)
+
+
+def start_maintenance(db_path: str) -> None:
+    global _maintenance
+    _maintenance = asyncio.create_task(_maintenance_loop(db_path))
+
+
+async def stop_scheduler() -> None:
+    """Stop the timer, running tasks and maintenance. Call on shutdown, before close_db()."""
+    if _scheduler is not None:
+        await _scheduler.stop()
+    if _executor is not None:
+        await _executor.stop()
+    if _maintenance is not None:
+        _maintenance.cancel()
+        await asyncio.gather(_maintenance, return_exceptions=True)
+
+
+def setup_scheduler(bot, db_path: str) -> NextRunTimer:
+    global _scheduler, _executor
+    _executor = TaskExecutor(bot, db_path, SCHEDULER_CONCURRENCY)
+    _scheduler = NextRunTimer(_executor, SCHEDULER_INTERVAL)
+    db.add_task_listener(_scheduler.update)
+    return _scheduler
+
+
+async def _execute_task(task: dict, bot, db_path: str, lease_owner: str | None = None) -> None:
     task_id = task["id"]
     task_chat_id = task["chat_id"]  # Use chat_id from task, not global OWNER_ID
     prompt = task["prompt"]
     logger.info("Executing task %s for chat %s: %s", task_id, task_chat_id, prompt[:80])
 
     wrapped_prompt = f"You are executing a scheduled task. You MUST use the send_message tool to notify the user in Telegram. Task: {prompt}"
-    notify_state = {"sent": False}
+    notify_state: dict = {"sent": False}
 
     start = time.monotonic()
+    error: str | None = None
+    cached = None
     try:
-        result = await run_task_agent(wrapped_prompt, bot, task_chat_id, db_path, notify_state)
+        cache_key = None
+        if task.get("cache_ttl"):
+            cache_key = await response_cache.cache_key(task_chat_id, prompt, json.loads(task.get("cache_inputs") or "[]"), get_chat_workspace(task_chat_id))
+            cached = await response_cache.get_cached(cache_key, task_chat_id) if cache_key else None
 
-        # Fallback to avoid silent runs when the model forgets to call send_message.
-        if not notify_state["sent"]:
-            await bot.send_message(chat_id=task_chat_id, text=f"⏰ 定时提醒：{prompt}")
+        if cached is not None:
+            messages, saved = cached
+            logger.info("Task %s served from the response cache (saved $%.4f)", task_id, saved)
+            for text in messages:
+                await outbox.send(bot, task_chat_id, text)
+            result = "\n\n".join(messages)
+        else:
+            result = await run_task_agent(wrapped_prompt, bot, task_chat_id, db_path, notify_state)
 
-        duration_ms = int((time.monotonic() - start) * 1000)
-        await db.log_task_run(db_path, task_id, duration_ms, "success", result=result)
+            # Fallback to avoid silent runs when the model forgets to call send_message.
+            if not notify_state["sent"]:
+                await outbox.send(bot, task_chat_id, f"⏰ 定时提醒：{prompt}")
+            elif cache_key:
+                await response_cache.store(cache_key, task_chat_id, task_id, notify_state["messages"], notify_state.get("cost_usd", 0.0), task["cache_ttl"])
     except Exception as e:
-        duration_ms = int((time.monotonic() - start) * 1000)
-        await db.log_task_run(db_path, task_id, duration_ms, "error", error=str(e))
+        error = _truncate(str(e), RUN_LOG_MAX_RESULT_CHARS)
         result = f"Error: {e}"
+    duration_ms = int((time.monotonic() - start) * 1000)
+    run_status = "error" if error is not None else "cached" if cached is not None else "success"
+    metrics.TASK_RUNS.inc(status=run_status)
+    result = _truncate(result, RUN_LOG_MAX_RESULT_CHARS)
+    run_result = result if error is None else None
 
-    # Calculate next_run
+    # Calculate next_run. "all" replays every missed slot, so it steps from the
+    # slot that fired; everything else steps from now.
     stype = task["schedule_type"]
-    svalue = task["schedule_value"]
     now = datetime.now(timezone.utc)
+    base = now
+    if task.get("misfire_policy") == "all":
+        base = min(now, _next_run(task) or now)
 
-    if stype == "cron":
-        next_run = croniter(svalue, now).get_next(datetime).isoformat()
-        await db.update_task_after_run(db_path, task_id, result, next_run, "active")
-    elif stype == "interval":
-        next_run = (now + timedelta(milliseconds=int(svalue))).isoformat()
-        await db.update_task_after_run(db_path, task_id, result, next_run, "active")
+    if stype in ("cron", "interval"):
+        next_run, status = db.to_epoch_ms(_next_occurrence(task, base)), "active"
     elif stype == "once":
-        await db.update_task_after_run(db_path, task_id, result, None, "completed")
+        next_run, status = None, "completed"
     else:
         logger.warning("Unknown schedule_type %s for task %s", stype, task_id)
+        next_run, status = None, "failed"
+
+    # Log the run and advance the task (releasing its lease) in one commit.
+    async with db.transaction(db_path):
+        await db.log_task_run(db_path, task_id, duration_ms, run_status, result=run_result, error=error, blobs=transcript.blob_refs([run_result or ""]))
+        if not await db.update_task_after_run(db_path, task_id, result, next_run, status, lease_owner):
+            logger.warning("Task %s finished after its lease was lost or it was deleted; not advancing it", task_id)
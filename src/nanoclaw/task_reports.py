@@ -0,0 +1,51 @@
+"""Plain-text task stats and run history, shared by the MCP tools and the bot commands."""
+
+from datetime import datetime, timedelta, timezone
+
+from nanoclaw import db
+
+HISTORY_MAX_LIMIT = 50
+
+
+def _seconds(ms: int | None) -> str:
+    if ms is None:
+        return "-"
+    return f"{ms}ms" if ms < 1000 else f"{ms / 1000:.1f}s"
+
+
+async def task_stats_text(db_path: str, chat_id: int, task_id: str | None = None, days: int = 7) -> str:
+    """Error rate and duration percentiles per task over the last `days` days."""
+    since = (datetime.now(timezone.utc) - timedelta(days=days)).isoformat()
+    stats = await db.get_task_stats(db_path, since, chat_id, task_id)
+    lines = []
+    if task_id is None:
+        counts = await db.count_tasks_by_status(db_path, chat_id)
+        lines.append("Tasks: " + (", ".join(f"{n} {status}" for status, n in sorted(counts.items())) or "none"))
+    if not stats:
+        lines.append(f"No runs in the last {days} days.")
+        return "\n".join(lines)
+    lines.append(f"Runs in the last {days} days:")
+    for s in stats:
+        timed = s["runs"] - s["skipped"]
+        error_rate = s["errors"] / timed * 100 if timed else 0.0
+        extra = "".join(f", {s[k]} {k}" for k in ("cached", "skipped") if s[k])
+        lines.append(
+            f"- [{s['task_id']}] {s['runs']} runs, {s['errors']} errors ({error_rate:.1f}%){extra} | "
+            f"p50 {_seconds(s['p50_ms'])}, p95 {_seconds(s['p95_ms'])}, max {_seconds(s['max_ms'])} | last {s['last_run_at'][:19]}"
+        )
+    return "\n".join(lines)
+
+
+async def task_history_text(db_path: str, chat_id: int, task_id: str, limit: int = 20, before: str | None = None) -> str:
+    """The task's most recent runs, newest first, with a cursor for the next page."""
+    limit = max(1, min(limit, HISTORY_MAX_LIMIT))
+    runs = await db.get_task_runs(db_path, task_id, chat_id, limit, before)
+    if not runs:
+        return f"No {'earlier ' if before else ''}runs of task {task_id}."
+    lines = [f"Runs of task {task_id}, newest first:"]
+    for r in runs:
+        error = f": {r['error']}" if r["error"] else ""
+        lines.append(f"- {r['run_at'][:19]} {r['status']} {_seconds(r['duration_ms'])}{error}")
+    if len(runs) == limit:
+        lines.append(f"Older runs: before={runs[-1]['run_at']}")
+    return "\n".join(lines)
@@ -0,0 +1,191 @@
+"""Per-turn trace spans: where an agent turn spends its time.
+
+Each agent turn (chat, scheduled task) is a trace. While it runs, spans
+are added for waiting for an agent slot, the SDK's time to first message
+(CLI start and connect on a cold start), each tool call from ToolUseBlock
+to its ToolResultBlock (Bash, WebFetch, nanoclaw's MCP tools, ...), the
+nanoclaw tool handlers themselves, DB calls and Telegram sends. Code just
+calls `span()`; outside a trace it does nothing.
+
+Finished traces go to a ring of recent turns (for /profile) and, sampled
+at TRACE_SAMPLE_RATE, to TRACE_FILE as JSON lines, rotated at
+TRACE_MAX_BYTES. Turns slower than TRACE_SLOW_SECONDS are always written.
+"""
+
+import json
+import logging
+import logging.handlers
+import random
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Iterator
+
+logger = logging.getLogger(__name__)
+
+# Spans kept per trace; a tool-heavy turn makes thousands of DB calls.
+_MAX_SPANS = 500
+_RECENT_TRACES = 200
+
+
+class Trace:
+    def __init__(self, kind: str, chat_id: int) -> None:
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.chat_id = chat_id
+        self.started_at = datetime.now(timezone.utc)
+        self.duration_ms = 0.0
+        self.attrs: dict[str, Any] = {}
+        self.spans: list[dict[str, Any]] = []
+        self.dropped = 0
+        self._t0 = time.perf_counter()
+
+    def add(self, name: str, start: float, end: float, **attrs: Any) -> None:
+        """Record a span from perf_counter() readings `start` to `end`."""
+        if len(self.spans) >= _MAX_SPANS:
+            self.dropped += 1
+            return
+        self.spans.append({"name": name, "start_ms": round((start - self._t0) * 1000, 1), "ms": round((end - start) * 1000, 1), **attrs})
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "chat_id": self.chat_id,
+            "started_at": self.started_at.isoformat(),
+            "ms": round(self.duration_ms, 1),
+            **self.attrs,
+            "spans": self.spans,
+            "dropped_spans": self.dropped,
+        }
+
+
+class _Slot:
+    """The trace code in a context reports to; mutable so long-lived tasks can be pointed at each new turn."""
+
+    def __init__(self, trace: Trace | None = None) -> None:
+        self.trace = trace
+
+
+_slot: ContextVar[_Slot | None] = ContextVar("nanoclaw_trace", default=None)
+_recent: deque[Trace] = deque(maxlen=_RECENT_TRACES)
+_writer: logging.Logger | None = None
+
+
+def current() -> Trace | None:
+    slot = _slot.get()
+    return slot.trace if slot is not None else None
+
+
+def new_slot() -> _Slot:
+    """Give the current task (and tasks it starts from now on) a slot of its own.
+
+    For long-lived workers serving many turns, like a warm agent: set
+    `slot.trace` to the turn being served.
+    """
+    slot = _Slot()
+    _slot.set(slot)
+    return slot
+
+
+@contextmanager
+def turn(kind: str, chat_id: int) -> Iterator[Trace]:
+    """Trace one agent turn; spans recorded in this context (and tasks started from it) join it."""
+    trace = Trace(kind, chat_id)
+    token = _slot.set(_Slot(trace))
+    try:
+        yield trace
+    finally:
+        _slot.reset(token)
+        trace.duration_ms = (time.perf_counter() - trace._t0) * 1000
+        _finish(trace)
+
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Iterator[None]:
+    trace = current()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, start, time.perf_counter(), **attrs)
+
+
+def add_span(name: str, start: float, end: float, **attrs: Any) -> None:
+    """Record a span measured elsewhere (perf_counter() readings) on the current trace, if any."""
+    if (trace := current()) is not None:
+        trace.add(name, start, end, **attrs)
+
+
+def set_attr(name: str, value: Any) -> None:
+    if (trace := current()) is not None:
+        trace.attrs[name] = value
+
+
+def _finish(trace: Trace) -> None:
+    # Imported here: db imports this module, and must stay importable without the bot's config (benchmarks, tests).
+    from nanoclaw.config import TRACE_SAMPLE_RATE, TRACE_SLOW_SECONDS
+
+    _recent.append(trace)
+    slow = TRACE_SLOW_SECONDS > 0 and trace.duration_ms >= TRACE_SLOW_SECONDS * 1000
+    if not slow and random.random() >= TRACE_SAMPLE_RATE:
+        return
+    try:
+        _trace_writer().info(json.dumps(trace.to_dict(), ensure_ascii=False))
+    except Exception:
+        logger.warning("Could not write trace %s", trace.id, exc_info=True)
+
+
+def _trace_writer() -> logging.Logger:
+    global _writer
+    if _writer is None:
+        from nanoclaw.config import TRACE_BACKUPS, TRACE_FILE, TRACE_MAX_BYTES
+
+        TRACE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(TRACE_FILE, maxBytes=TRACE_MAX_BYTES, backupCount=TRACE_BACKUPS, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        _writer = logging.getLogger("nanoclaw.traces")
+        _writer.propagate = False
+        _writer.setLevel(logging.INFO)
+        _writer.addHandler(handler)
+    return _writer
+
+
+def recent(chat_id: int | None = None) -> list[Trace]:
+    """Finished traces still in memory, oldest first; only `chat_id`'s when given."""
+    return [t for t in _recent if chat_id is None or t.chat_id == chat_id]
+
+
+def _seconds(ms: float) -> str:
+    return f"{ms:.0f}ms" if ms < 1000 else f"{ms / 1000:.1f}s"
+
+
+def _dominant(trace: Trace, top: int) -> list[tuple[str, float, int]]:
+    """(span name, total ms, count) of the trace's costliest span names."""
+    totals: dict[str, list] = {}
+    for s in trace.spans:
+        entry = totals.setdefault(s["name"], [0.0, 0])
+        entry[0] += s["ms"]
+        entry[1] += 1
+    return sorted(((name, ms, n) for name, (ms, n) in totals.items()), key=lambda x: -x[1])[:top]
+
+
+def profile_text(chat_id: int | None = None, limit: int = 5) -> str:
+    """The slowest recent turns and the spans they spent most time in."""
+    traces = recent(chat_id)
+    if not traces:
+        return "No traced turns yet."
+    lines = [f"Slowest {min(limit, len(traces))} of the last {len(traces)} turns:"]
+    for trace in sorted(traces, key=lambda t: -t.duration_ms)[:limit]:
+        flags = "".join(f", {k}" for k in ("cold_start", "compacted") if trace.attrs.get(k))
+        lines.append(f"- {trace.started_at:%m-%d %H:%M:%S} {trace.kind} {_seconds(trace.duration_ms)}{flags}")
+        for name, ms, n in _dominant(trace, 3):
+            share = ms / trace.duration_ms * 100 if trace.duration_ms else 0.0
+            lines.append(f"    {name}{f' ×{n}' if n > 1 else ''}: {_seconds(ms)} ({share:.0f}%)")
+    return "\n".join(lines)
@@ -0,0 +1,150 @@
+"""Bounded capture of an agent run's text output.
+
+`TranscriptCollector` is fed the run's TextBlocks and its final
+ResultMessage.result. The result is dropped when it repeats the text already
+streamed, which is the usual case. At most `budget` characters are kept in
+memory. Past that, the output streams to a file in the content-addressed
+blob store (BLOB_DIR/<sha256[:2]>/<sha256>.txt), and the text handed back by
+`finish()` is the head of the output plus a reference to the blob. What gets
+stored (archive, run log, last_result) stays within `budget`; `full_text()`
+reads the whole output back for the one place that needs it, the reply.
+
+Each blob's owners are recorded in the blob_refs table (see db); retention
+deletes a blob once pruning removed its last owner.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import time
+from pathlib import Path
+from typing import IO
+
+from nanoclaw import metrics
+from nanoclaw.config import BASE_DIR, BLOB_DIR
+
+logger = logging.getLogger(__name__)
+
+# Room reserved at the end of a spilled text for the blob reference.
+_MARKER_RESERVE = 200
+_BLOB_REF_RE = re.compile(r"full output in \S*?([0-9a-f]{64})\.txt\]")
+# A spill file untouched this long was left behind by a process that died mid-run.
+_STALE_SPILL_SECONDS = 3600
+
+
+def blob_path(digest: str) -> Path:
+    return BLOB_DIR / digest[:2] / f"{digest}.txt"
+
+
+class TranscriptCollector:
+    def __init__(self, budget: int) -> None:
+        self.budget = max(budget, 2 * _MARKER_RESERVE)
+        self.chars = 0
+        self._parts: list[str] = []
+        self._tail = ""
+        self._hash = hashlib.sha256()
+        # (length, sha256) of the last TextBlock, stripped: the result usually repeats it, however long it is.
+        self._last_block: tuple[int, bytes] | None = None
+        self._spill: IO[str] | None = None
+        self._spill_path: str | None = None
+        self._head = ""
+        self._blob: Path | None = None
+        # Digest of the blob the output spilled to, once finish() stored it.
+        self.blob_digest: str | None = None
+
+    async def add(self, text: str) -> None:
+        """Append one TextBlock."""
+        if not text:
+            return
+        self.chars += len(text)
+        self._hash.update(text.encode())
+        self._last_block = _fingerprint(text)
+        self._tail = (self._tail + text)[-self.budget :]
+        if self._spill is not None:
+            await asyncio.to_thread(self._spill.write, text)
+            return
+        self._parts.append(text)
+        if self.chars > self.budget:
+            await asyncio.to_thread(self._start_spill)
+
+    async def add_result(self, text: str | None) -> None:
+        """Append the ResultMessage's result, unless it repeats what was already streamed."""
+        if not text:
+            return
+        if _fingerprint(text) == self._last_block or self._tail.rstrip().endswith(text.strip()):
+            metrics.TRANSCRIPT_RESULTS_DEDUPED.inc()
+            return
+        await self.add(text)
+
+    def _start_spill(self) -> None:
+        BLOB_DIR.mkdir(parents=True, exist_ok=True)
+        fd, self._spill_path = tempfile.mkstemp(dir=BLOB_DIR, prefix=".spill-", suffix=".txt")
+        self._spill = os.fdopen(fd, "w", encoding="utf-8")
+        text = "".join(self._parts)
+        self._parts = []
+        self._head = text[: self.budget - _MARKER_RESERVE]
+        self._spill.write(text)
+
+    def _store_spill(self) -> Path:
+        self._spill.close()
+        self._spill = None
+        path = blob_path(self._hash.hexdigest())
+        if path.exists():
+            os.unlink(self._spill_path)
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(self._spill_path, path)
+        return path
+
+    async def finish(self) -> str:
+        """The output, or its head plus a blob reference when it outgrew the budget."""
+        if self._spill is None:
+            return "".join(self._parts)
+        path = self._blob = await asyncio.to_thread(self._store_spill)
+        self.blob_digest = self._hash.hexdigest()
+        metrics.TRANSCRIPT_SPILLED_CHARS.inc(self.chars)
+        logger.info("Spilled %d chars of agent output to %s", self.chars, path)
+        return f"{self._head}\n…[{self.chars - len(self._head)} more chars; full output in {path.relative_to(BASE_DIR)}]"
+
+    async def full_text(self) -> str:
+        """The whole output, read back from its blob if it was spilled. Call after finish()."""
+        if self._blob is None:
+            return "".join(self._parts)
+        return await asyncio.to_thread(self._blob.read_text, encoding="utf-8")
+
+
+def _fingerprint(text: str) -> tuple[int, bytes]:
+    stripped = text.strip()
+    return len(stripped), hashlib.sha256(stripped.encode()).digest()
+
+
+def blob_refs(texts: list[str]) -> set[str]:
+    """Digests of the blobs referenced from `texts`."""
+    return {digest for text in texts for digest in _BLOB_REF_RE.findall(text)}
+
+
+def delete_blob(digest: str) -> bool:
+    try:
+        blob_path(digest).unlink()
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def remove_stale_spills() -> int:
+    """Delete spill files left behind by runs that never finished. Returns how many."""
+    if not BLOB_DIR.exists():
+        return 0
+    cutoff = time.time() - _STALE_SPILL_SECONDS
+    removed = 0
+    for path in BLOB_DIR.glob(".spill-*"):
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+                removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
@@ -0,0 +1,168 @@
+"""Webhook ingestion: Telegram POSTs updates to a local HTTP server.
+
+Used instead of long polling when WEBHOOK_URL is set. Every request must
+carry the X-Telegram-Bot-Api-Secret-Token registered with setWebhook. A
+valid update is put on the application's update queue and acknowledged at
+once, so handlers (and the agent turns they start) run in the background,
+exactly as with polling. Connections are kept alive between updates.
+
+Like the metrics endpoint, this is a plain asyncio server: Telegram needs
+one POST route, which doesn't justify a web framework (python-telegram-bot's
+own webhook server needs tornado).
+"""
+
+import asyncio
+import hmac
+import json
+import logging
+import signal
+from http import HTTPStatus
+from urllib.parse import urlsplit
+
+from telegram import Bot, Update
+from telegram.ext import Application
+
+from nanoclaw import metrics
+from nanoclaw.config import WEBHOOK_HOST, WEBHOOK_MAX_CONNECTIONS, WEBHOOK_PORT, WEBHOOK_SECRET, WEBHOOK_URL
+
+logger = logging.getLogger(__name__)
+
+_SECRET_HEADER = "x-telegram-bot-api-secret-token"
+# Updates are a few KB; anything far bigger isn't from Telegram.
+_MAX_BODY = 1 << 20
+# Idle keep-alive connections are closed after this many seconds.
+_IDLE_TIMEOUT = 120.0
+
+
+async def _read_request(request_line: bytes, reader: asyncio.StreamReader) -> tuple[str, str, dict[str, str], bytes] | None:
+    """(method, path, headers, body) of the request starting with `request_line`, or None at end of stream."""
+    if not request_line.strip():
+        return None
+    method, target, version = request_line.decode("latin-1").split(maxsplit=2)
+    headers = {}
+    while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    if version.strip() == "HTTP/1.0" and headers.get("connection", "").lower() != "keep-alive":
+        headers.setdefault("connection", "close")
+    length = int(headers.get("content-length") or 0)
+    if length > _MAX_BODY:
+        raise ValueError(f"request body of {length} bytes")
+    body = await reader.readexactly(length) if length else b""
+    return method, target.split("?")[0], headers, body
+
+
+class WebhookServer:
+    def __init__(self, bot: Bot, update_queue: asyncio.Queue, path: str, secret: str) -> None:
+        self.bot = bot
+        self.update_queue = update_queue
+        self.path = path
+        self._secret = secret.encode()
+        self._server: asyncio.Server | None = None
+        # Connection handlers waiting for their next request; stop() closes these.
+        self._idle: set[asyncio.Task] = set()
+        self._closing = False
+
+    async def start(self, host: str, port: int) -> None:
+        self._server = await asyncio.start_server(self._serve, host, port)
+        logger.info("Webhook listening on %s:%d%s", host, port, self.path)
+
+    async def stop(self, timeout: float = 5.0) -> None:
+        """Stop accepting, close idle connections and let in-flight requests finish."""
+        if self._server is None:
+            return
+        self._closing = True
+        self._server.close()
+        for task in self._idle:
+            task.cancel()
+        try:
+            await asyncio.wait_for(self._server.wait_closed(), timeout)
+        except TimeoutError:
+            logger.warning("Webhook connections still open after %.0fs; not waiting for them", timeout)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        try:
+            while not self._closing:
+                # Only a connection waiting for its next request is idle: one that
+                # is part way through a request gets to finish it when stop() runs.
+                self._idle.add(task)
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), _IDLE_TIMEOUT)
+                except (TimeoutError, ConnectionError, asyncio.CancelledError):
+                    # CancelledError: stop() closing an idle connection; not an error.
+                    return
+                finally:
+                    self._idle.discard(task)
+                try:
+                    request = await asyncio.wait_for(_read_request(request_line, reader), _IDLE_TIMEOUT)
+                except (TimeoutError, ConnectionError, asyncio.IncompleteReadError):
+                    return
+                except ValueError:
+                    request, status = None, HTTPStatus.BAD_REQUEST
+                else:
+                    if request is None:
+                        return
+                    status = self._accept(*request)
+                metrics.WEBHOOK_REQUESTS.inc(status=str(status.value))
+                keep_alive = request is not None and request[2].get("connection", "").lower() != "close" and not self._closing
+                writer.write(
+                    f"HTTP/1.1 {status.value} {status.phrase}\r\nContent-Length: 0\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode()
+                )
+                await writer.drain()
+                if not keep_alive:
+                    return
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def _accept(self, method: str, path: str, headers: dict[str, str], body: bytes) -> HTTPStatus:
+        """Validate one request and queue its update. Never waits on the handlers."""
+        if path != self.path:
+            return HTTPStatus.NOT_FOUND
+        if method != "POST":
+            return HTTPStatus.METHOD_NOT_ALLOWED
+        if not hmac.compare_digest(headers.get(_SECRET_HEADER, "").encode(), self._secret):
+            return HTTPStatus.FORBIDDEN
+        try:
+            update = Update.de_json(json.loads(body), self.bot)
+        except Exception:
+            logger.warning("Dropping malformed webhook update: %r", body[:200])
+            return HTTPStatus.BAD_REQUEST
+        self.update_queue.put_nowait(update)
+        return HTTPStatus.OK
+
+
+async def run_webhook(app: Application, stop: asyncio.Event | None = None) -> None:
+    """Run `app` on webhook updates until SIGINT/SIGTERM (or until `stop` is set).
+
+    Mirrors Application.run_polling: post_init runs before the first update
+    and post_shutdown after the last one has been handled.
+    """
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET must be set when WEBHOOK_URL is")
+    if stop is None:
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+    server = WebhookServer(app.bot, app.update_queue, urlsplit(WEBHOOK_URL).path or "/", WEBHOOK_SECRET)
+    await app.initialize()
+    try:
+        if app.post_init:
+            await app.post_init(app)
+        await server.start(WEBHOOK_HOST, WEBHOOK_PORT)
+        await app.start()
+        await app.bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET, max_connections=WEBHOOK_MAX_CONNECTIONS)
+        logger.info("Webhook registered at %s", WEBHOOK_URL)
+        await stop.wait()
+    finally:
+        # Take no new updates, then let app.stop() handle the ones already queued.
+        await server.stop()
+        if app.running:
+            await app.stop()
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
@@ -0,0 +1,35 @@
+import asyncio
+import os
+import tempfile
+
+import pytest
+
+# nanoclaw reads its configuration at import time.
+os.environ.setdefault("NANOCLAW_BASE_DIR", tempfile.mkdtemp(prefix="nanoclaw-tests-"))
+for _var, _value in (("TELEGRAM_BOT_TOKEN", "0"), ("OWNER_ID", "1"), ("ANTHROPIC_API_KEY", "0")):
+    os.environ.setdefault(_var, _value)
+
+from nanoclaw import db  # noqa: E402
+
+
+@pytest.fixture
+def db_path(tmp_path) -> str:
+    return str(tmp_path / "nanoclaw.db")
+
+
+@pytest.fixture
+def run_db(db_path):
+    """Run `fn(*args)` on a fresh event loop with the DB at `db_path` open and initialised."""
+
+    def run(fn, *args):
+        async def main():
+            await db.open_db(db_path)
+            try:
+                await db.init_db(db_path)
+                return await fn(*args)
+            finally:
+                await db.close_db()
+
+        return asyncio.run(main())
+
+    return run
@@ -0,0 +1,118 @@
+import asyncio
+
+import pytest
+
+from nanoclaw import bot, outbox
+
+
+class _Sent:
+    def __init__(self, chat: "_Chat", text: str) -> None:
+        self.chat, self.text = chat, text
+
+    async def edit_text(self, text: str) -> "_Sent":
+        self.text = text
+        return self
+
+    async def delete(self) -> bool:
+        self.chat.messages.remove(self)
+        return True
+
+
+class _Chat:
+    """The user's message; replies to it are collected in `messages`."""
+
+    chat_id = 1
+
+    def __init__(self) -> None:
+        self.messages: list[_Sent] = []
+
+    async def reply_text(self, text: str) -> _Sent:
+        sent = _Sent(self, text)
+        self.messages.append(sent)
+        return sent
+
+
+@pytest.fixture(autouse=True)
+def direct_outbox(monkeypatch):
+    async def call(chat_id, method, fn):
+        # Like the outbox's worker, a call goes through even if the caller is cancelled.
+        return await asyncio.shield(asyncio.ensure_future(fn()))
+
+    monkeypatch.setattr(outbox, "call", call)
+
+
+def test_streaming_reply_deletes_messages_the_final_text_no_longer_needs():
+    chat = _Chat()
+
+    async def scenario():
+        reply = bot._StreamingReply(chat, edit_interval=0, max_chars=100_000)
+        await reply.push("x" * 5000)
+        await reply.push("y" * 5000)
+        streamed = len(chat.messages)
+        await reply.finish("short answer")
+        return streamed
+
+    assert asyncio.run(scenario()) > 1
+    assert [m.text for m in chat.messages] == ["short answer"]
+
+
+def test_streaming_preview_is_capped_but_finish_shows_everything():
+    chat = _Chat()
+    full = "z" * 9000
+
+    async def scenario():
+        reply = bot._StreamingReply(chat, edit_interval=0, max_chars=3000)
+        await reply.push(full)
+        preview = "".join(m.text for m in chat.messages)
+        await reply.finish(full)
+        return preview
+
+    assert len(asyncio.run(scenario())) == 3000
+    assert "".join(m.text for m in chat.messages) == full
+
+
+def test_finish_during_a_pending_render_does_not_send_a_chunk_twice():
+    sending = asyncio.Event()
+
+    class _SlowChat(_Chat):
+        async def reply_text(self, text: str) -> _Sent:
+            if self.messages:
+                sending.set()
+                await asyncio.sleep(0.05)
+            return await super().reply_text(text)
+
+    chat = _SlowChat()
+    text = "a" + "b" * 5000
+
+    async def scenario():
+        reply = bot._StreamingReply(chat, edit_interval=0.01, max_chars=100_000)
+        await reply.push("a")
+        await reply.push("b" * 5000)
+        # The deferred render is now sending the second chunk.
+        await sending.wait()
+        await reply.finish(text)
+
+    asyncio.run(scenario())
+    assert "".join(m.text for m in chat.messages) == text
+    assert len(chat.messages) == 2
+
+
+def test_a_failed_turn_is_reported_and_later_messages_still_run(monkeypatch):
+    inbox = bot._ChatInbox(debounce=0)
+    turns, notices = [], []
+
+    async def run_turn(bot_, chat_id, updates):
+        turns.append(updates)
+        if len(turns) == 1:
+            inbox.add("second")
+            raise RuntimeError("boom")
+
+    async def send(bot_, chat_id, text):
+        notices.append(text)
+
+    monkeypatch.setattr(bot, "_run_turn", run_turn)
+    monkeypatch.setattr(outbox, "send", send)
+    inbox.add("first")
+    asyncio.run(bot._drain_inbox(None, 1, inbox))
+    assert turns == [["first"], ["second"]]
+    assert len(notices) == 1
@@ -0,0 +1,56 @@
+import asyncio
+
+from nanoclaw import conversations
+from nanoclaw.conversations import ArchiveWriter, parse_archive
+
+
+def _entry(time: str, user: str, assistant: str) -> str:
+    return f"## {time} UTC\n\n**User**: {user}\n\n**Ape**: {assistant}\n\n---\n\n"
+
+
+def test_parse_archive_keeps_replies_with_horizontal_rules(tmp_path):
+    reply = "Part one.\n\n---\n\nPart two, after a rule.\n\n---\n\nPart three."
+    path = tmp_path / "2025-01-01.md"
+    path.write_text("# Conversations - 2025-01-01\n\n" + _entry("09:00:00", "hi", reply) + _entry("09:05:00", "next", "short"), encoding="utf-8")
+
+    assert parse_archive(path) == [("09:00:00", "hi", reply), ("09:05:00", "next", "short")]
+
+
+def test_parse_archive_last_entry_without_trailing_blank_line(tmp_path):
+    path = tmp_path / "2025-01-01.md"
+    path.write_text("# Conversations - 2025-01-01\n\n" + _entry("09:00:00", "hi", "a\n\n---\n\nb")[:-1], encoding="utf-8")
+
+    assert parse_archive(path) == [("09:00:00", "hi", "a\n\n---\n\nb")]
+
+
+def test_fsync_skipped_in_a_burst_still_happens_after_the_interval(tmp_path, monkeypatch):
+    synced = []
+    monkeypatch.setattr(conversations.os, "fsync", synced.append)
+
+    async def scenario():
+        writer = ArchiveWriter(tmp_path, flush_interval=0, fsync_interval=0.05)
+        for i in range(2):
+            writer.append("2025-01-01", _entry(f"09:00:0{i}", "hi", "hello"))
+            await writer.flush()
+        in_burst = len(synced)
+        await asyncio.sleep(0.1)
+        after_interval = len(synced)
+        await writer.close()
+        return in_burst, after_interval
+
+    # The first write syncs, the second is too soon and is synced once the interval passes.
+    assert asyncio.run(scenario()) == (1, 2)
+
+
+def test_close_archive_waits_for_evicted_writers(tmp_path, monkeypatch):
+    monkeypatch.setattr(conversations, "DB_MAX_OPEN", 1)
+
+    async def scenario():
+        for name in ("a", "b"):
+            conversations._get_writer(tmp_path / name).append("2025-01-01", _entry("09:00:00", name, "hello"))
+        await conversations.close_archive()
+        return len(conversations._closing)
+
+    assert asyncio.run(scenario()) == 0
+    for name in ("a", "b"):
+        assert parse_archive(tmp_path / name / "2025-01-01.md") == [("09:00:00", name, "hello")]
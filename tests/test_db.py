@@ -0,0 +1,13 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+_SRC = str(Path(__file__).resolve().parents[1] / "src")
+
+
+def test_db_imports_without_the_bot_config():
+    # The DB benchmarks import db with none of the bot's required settings.
+    env = {"PATH": os.environ.get("PATH", ""), "PYTHONPATH": _SRC}
+    code = "import sys; from nanoclaw import db; assert 'nanoclaw.config' not in sys.modules"
+    subprocess.run([sys.executable, "-c", code], env=env, check=True)
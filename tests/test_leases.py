@@ -0,0 +1,86 @@
+from datetime import datetime, timedelta, timezone
+
+from nanoclaw import db, scheduler
+
+_HOUR_MS = str(3600 * 1000)
+
+
+async def _due_task(db_path: str) -> str:
+    return await db.create_task(db_path, 1, "p", "interval", _HOUR_MS, db.now_ms() - 1000)
+
+
+async def _task(db_path: str, task_id: str) -> dict:
+    [task] = await db.get_tasks(db_path, [task_id])
+    return task
+
+
+def test_a_due_task_is_claimed_by_one_scheduler_only(run_db, db_path):
+    async def scenario():
+        due = await _due_task(db_path)
+        later = await db.create_task(db_path, 1, "p", "interval", _HOUR_MS, db.now_ms() + 60_000)
+        first = await db.claim_tasks(db_path, [due, later], "a", 60)
+        second = await db.claim_tasks(db_path, [due, later], "b", 60)
+        return first, second, await _task(db_path, due)
+
+    first, second, task = run_db(scenario)
+    assert [t["lease_owner"] for t in first] == ["a"]
+    assert second == []
+    assert (task["status"], task["attempts"]) == ("running", 1)
+
+
+def test_renew_lease_only_for_its_owner(run_db, db_path):
+    async def scenario():
+        task_id = await _due_task(db_path)
+        await db.claim_tasks(db_path, [task_id], "a", 60)
+        return await db.renew_lease(db_path, task_id, "a", 60), await db.renew_lease(db_path, task_id, "b", 60)
+
+    assert run_db(scenario) == (True, False)
+
+
+def test_expired_lease_makes_the_task_claimable_again(run_db, db_path):
+    async def scenario():
+        task_id = await _due_task(db_path)
+        await db.claim_tasks(db_path, [task_id], "a", -1)
+        blocked = await db.claim_tasks(db_path, [task_id], "b", 60)
+        expired = await db.expire_leases(db_path)
+        renewed = await db.renew_lease(db_path, task_id, "a", 60)
+        reclaimed = await db.claim_tasks(db_path, [task_id], "b", 60)
+        return blocked, expired, renewed, reclaimed
+
+    blocked, expired, renewed, reclaimed = run_db(scenario)
+    assert blocked == []
+    assert [(t["status"], t["lease_owner"], t["attempts"]) for t in expired] == [("active", None, 1)]
+    assert not renewed
+    assert [(t["lease_owner"], t["attempts"]) for t in reclaimed] == [("b", 2)]
+
+
+def test_released_leases_do_not_count_as_attempts(run_db, db_path):
+    async def scenario():
+        task_id = await _due_task(db_path)
+        await db.claim_tasks(db_path, [task_id], "a", 60)
+        await db.release_leases(db_path, "a")
+        return await _task(db_path, task_id)
+
+    task = run_db(scenario)
+    assert (task["status"], task["lease_owner"], task["attempts"]) == ("active", None, 0)
+
+
+def test_sweep_gives_up_a_run_after_max_attempts(run_db, db_path, monkeypatch):
+    monkeypatch.setattr(scheduler, "TASK_MAX_ATTEMPTS", 2)
+
+    async def scenario():
+        task_id = await _due_task(db_path)
+        timer = scheduler.NextRunTimer(scheduler.TaskExecutor(None, db_path, 1), 60)
+        states = []
+        for _ in range(2):
+            await db.claim_tasks(db_path, [task_id], "a", -1)
+            await timer._sweep(datetime.now(timezone.utc))
+            states.append(await _task(db_path, task_id))
+        return states, await db.get_task_runs(db_path, task_id)
+
+    (retried, abandoned), log = run_db(scenario)
+    assert (retried["status"], retried["attempts"]) == ("active", 1)
+    assert db.from_epoch_ms(retried["next_run"]) < datetime.now(timezone.utc)
+    assert (abandoned["status"], abandoned["attempts"]) == ("active", 0)
+    assert db.from_epoch_ms(abandoned["next_run"]) > datetime.now(timezone.utc) + timedelta(minutes=50)
+    assert [(r["status"], r["error"]) for r in log] == [("error", "Abandoned after 2 interrupted attempts")]
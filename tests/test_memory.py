@@ -0,0 +1,52 @@
+import asyncio
+
+from nanoclaw import db, memory
+
+_LEGACY = """# Ape - Personal AI Assistant
+
+## Memory
+- This file (CLAUDE.md) is your long-term memory for preferences and important facts
+- Update this file anytime using Write/Edit tools to remember important information
+
+## Conversation History
+- Use Glob and Grep to search past conversations
+
+## User Preferences
+(Add user preferences as you learn them)
+- Prefers metric units
+
+## Projects
+- Garden planner, due in May
+"""
+
+
+def test_legacy_claude_md_moves_into_memory_store(run_db, db_path, tmp_path, monkeypatch):
+    monkeypatch.setattr(memory, "get_chat_workspace", lambda chat_id: tmp_path)
+    claude_md = tmp_path / "CLAUDE.md"
+    claude_md.write_text(_LEGACY)
+
+    async def migrate_twice():
+        first = await memory.migrate_claude_md(tmp_path, db_path, 1)
+        second = await memory.migrate_claude_md(tmp_path, db_path, 1)
+        return first, second, await db.get_memory(db_path, 1, "claude-md-notes")
+
+    first, second, notes = run_db(migrate_twice)
+    assert (first, second) == (True, False)
+    assert notes["content"] == "## User Preferences\n- Prefers metric units\n\n## Projects\n- Garden planner, due in May"
+    assert notes["pinned"]
+    text = claude_md.read_text()
+    assert "Write/Edit" not in text
+    assert "Prefers metric units" in text.split(memory._SUMMARY_START)[1]
+    assert (tmp_path / "CLAUDE.md.pre-memory").read_text() == _LEGACY
+
+
+def test_write_summary_leaves_no_temp_files(tmp_path):
+    claude_md = tmp_path / "CLAUDE.md"
+    claude_md.write_text(memory._INITIAL_CLAUDE_MD)
+
+    async def write_concurrently():
+        await asyncio.gather(*(asyncio.to_thread(memory._write_summary, claude_md, f"- item {i}") for i in range(8)))
+
+    asyncio.run(write_concurrently())
+    assert [p.name for p in tmp_path.iterdir()] == ["CLAUDE.md"]
+    assert claude_md.read_text().count(memory._SUMMARY_START) == 1
@@ -0,0 +1,144 @@
+import asyncio
+import sqlite3
+
+from nanoclaw import db
+
+
+# The schema as the last unversioned release created it (db._CREATE_TABLES
+# there), copied verbatim: what real installs upgrade from.
+_BASELINE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS scheduled_tasks (
+    id TEXT PRIMARY KEY,
+    chat_id INTEGER NOT NULL,
+    prompt TEXT NOT NULL,
+    schedule_type TEXT NOT NULL,
+    schedule_value TEXT NOT NULL,
+    next_run TEXT,
+    last_run TEXT,
+    last_result TEXT,
+    status TEXT DEFAULT 'active',
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_scheduled_tasks_next_run ON scheduled_tasks(next_run);
+CREATE INDEX IF NOT EXISTS idx_scheduled_tasks_status ON scheduled_tasks(status);
+
+CREATE TABLE IF NOT EXISTS task_run_logs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    task_id TEXT NOT NULL,
+    run_at TEXT NOT NULL,
+    duration_ms INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    FOREIGN KEY (task_id) REFERENCES scheduled_tasks(id)
+);
+CREATE INDEX IF NOT EXISTS idx_task_run_logs_task_id ON task_run_logs(task_id);
+"""
+
+
+def _legacy_db(path: str, script: str = "") -> None:
+    """A DB as an unversioned (pre-migration) release left it, plus `script`."""
+    conn = sqlite3.connect(path)
+    conn.executescript(db._SCHEMA_V1 + script)
+    conn.close()
+
+
+def _init(path: str) -> None:
+    async def main():
+        await db.open_db(path)
+        try:
+            await db.init_db(path)
+        finally:
+            await db.close_db()
+
+    asyncio.run(main())
+
+
+def _query(path: str, sql: str) -> list[tuple]:
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute(sql).fetchall()
+    finally:
+        conn.close()
+
+
+def test_fresh_db_is_at_current_version(db_path):
+    _init(db_path)
+    assert _query(db_path, "PRAGMA user_version") == [(db.SCHEMA_VERSION,)]
+
+
+def test_v3_recomputes_rollups_whose_raw_runs_are_complete(db_path):
+    _legacy_db(
+        db_path,
+        """
+        INSERT INTO task_run_logs (task_id, run_at, duration_ms, status) VALUES
+            ('full', '2025-03-01T01:00:00+00:00', 100, 'success'),
+            ('full', '2025-03-01T02:00:00+00:00', 200, 'success'),
+            ('full', '2025-03-01T03:00:00+00:00', 0, 'skipped'),
+            ('full', '2025-03-01T04:00:00+00:00', 0, 'skipped'),
+            ('pruned', '2025-03-01T01:00:00+00:00', 300, 'success');
+        -- Old rollups timed skipped runs as 0 ms.
+        INSERT INTO task_run_rollups (task_id, day, run_count, error_count, p50_ms, p95_ms) VALUES
+            ('full', '2025-03-01', 4, 0, 0, 200),
+            ('pruned', '2025-03-01', 4, 1, 0, 300);
+        """,
+    )
+    _init(db_path)
+    rows = _query(db_path, "SELECT task_id, run_count, error_count, skipped_count, p50_ms, p95_ms FROM task_run_rollups ORDER BY task_id")
+    # 'pruned' lost raw rows to retention, so its rollup is kept as it was.
+    assert rows == [("full", 4, 0, 2, 100, 200), ("pruned", 4, 1, 0, 0, 300)]
+
+
+def test_v2_converts_next_run_and_lease_to_epoch_ms(db_path):
+    _legacy_db(
+        db_path,
+        """
+        INSERT INTO scheduled_tasks (id, chat_id, prompt, schedule_type, schedule_value, next_run, status, created_at, lease_owner, lease_expires) VALUES
+            ('offset', 1, 'p', 'once', '2025-06-01T09:00:00+08:00', '2025-06-01T09:00:00+08:00', 'active', '2025-01-01', NULL, NULL),
+            ('naive', 1, 'p', 'interval', '3600000', '2025-06-01T01:00:00', 'running', '2025-01-01', 'host:1', '2025-06-01T01:05:00+00:00'),
+            ('text', 1, 'p', 'once', 'tomorrow at 9', 'tomorrow at 9', 'active', '2025-01-01', NULL, NULL),
+            ('paused', 1, 'p', 'once', 'next week', 'next week', 'paused', '2025-01-01', NULL, NULL),
+            ('done', 1, 'p', 'once', '2025-01-01T00:00:00Z', NULL, 'completed', '2025-01-01', NULL, NULL);
+        """,
+    )
+    _init(db_path)
+    rows = dict((r[0], r[1:]) for r in _query(db_path, "SELECT id, next_run, lease_expires, status FROM scheduled_tasks"))
+    one_am = db.to_epoch_ms(db.parse_timestamp("2025-06-01T01:00:00+00:00"))
+    # An offset is honoured and a naive time is taken as UTC: both are 01:00 UTC.
+    assert rows["offset"] == (one_am, None, "active")
+    assert rows["naive"] == (one_am, one_am + 5 * 60_000, "running")
+    # Free text could never fire: an active task with it fails, a paused one keeps its status.
+    assert rows["text"] == (None, None, "failed")
+    assert rows["paused"] == (None, None, "paused")
+    assert rows["done"] == (None, None, "completed")
+    assert _query(db_path, "SELECT typeof(next_run) FROM scheduled_tasks WHERE id = 'offset'") == [("integer",)]
+
+
+def test_baseline_db_upgrades_to_the_current_schema(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.executescript(
+        _BASELINE_SCHEMA
+        + """
+        INSERT INTO scheduled_tasks (id, chat_id, prompt, schedule_type, schedule_value, next_run, last_run, last_result, status, created_at) VALUES
+            ('daily', 1, 'weather', 'cron', '0 9 * * *', '2025-06-02T09:00:00+00:00', '2025-06-01T09:00:05+00:00', 'Sunny', 'active', '2025-05-01T00:00:00+00:00'),
+            ('later', 1, 'remind me', 'once', '2025-07-01T12:00:00+00:00', '2025-07-01T12:00:00+00:00', NULL, NULL, 'paused', '2025-05-02T00:00:00+00:00');
+        INSERT INTO task_run_logs (task_id, run_at, duration_ms, status, result) VALUES
+            ('daily', '2025-06-01T09:00:05+00:00', 5000, 'success', 'Sunny');
+        """
+    )
+    conn.close()
+
+    _init(db_path)
+    assert _query(db_path, "PRAGMA user_version") == [(db.SCHEMA_VERSION,)]
+    tasks = _query(
+        db_path,
+        "SELECT id, prompt, next_run, typeof(next_run), last_result, status, misfire_policy, misfire_max, lease_owner, attempts FROM scheduled_tasks ORDER BY id",
+    )
+    assert tasks == [
+        ("daily", "weather", db.to_epoch_ms(db.parse_timestamp("2025-06-02T09:00:00+00:00")), "integer", "Sunny", "active", "once", 10, None, 0),
+        ("later", "remind me", db.to_epoch_ms(db.parse_timestamp("2025-07-01T12:00:00+00:00")), "integer", None, "paused", "once", 10, None, 0),
+    ]
+    assert _query(db_path, "SELECT task_id, duration_ms, status, result FROM task_run_logs") == [("daily", 5000, "success", "Sunny")]
+    # Tables later migrations added are there and usable.
+    assert _query(db_path, "SELECT COUNT(*) FROM task_run_rollups") == [(0,)]
+    assert _query(db_path, "SELECT COUNT(*) FROM blob_refs") == [(0,)]
@@ -0,0 +1,93 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from nanoclaw import db, scheduler
+
+_NOW = datetime(2025, 3, 1, 12, 0, 30, tzinfo=timezone.utc)
+_HOUR_MS = str(3600 * 1000)
+
+
+@pytest.fixture(autouse=True)
+def no_jitter(monkeypatch):
+    monkeypatch.setattr(scheduler, "MISFIRE_JITTER", 0)
+
+
+async def _misfire(db_path: str, schedule_type: str, schedule_value: str, next_run: datetime, policy: str, misfire_max: int = 10) -> tuple[bool, dict, list]:
+    """Apply the misfire policy to a new task at _NOW; (runs now, task row after, run log)."""
+    task_id = await db.create_task(db_path, 1, "p", schedule_type, schedule_value, db.to_epoch_ms(next_run), policy, misfire_max)
+    timer = scheduler.NextRunTimer(scheduler.TaskExecutor(None, db_path, 1), 60)
+    [task] = await db.get_tasks(db_path, [task_id])
+    runs_now = await timer._handle_misfire(task, _NOW)
+    [after] = await db.get_tasks(db_path, [task_id])
+    return runs_now, after, await db.get_task_runs(db_path, task_id)
+
+
+def test_skip_moves_interval_task_to_next_future_slot_in_phase(run_db, db_path):
+    runs_now, task, log = run_db(_misfire, db_path, "interval", _HOUR_MS, datetime(2025, 3, 1, 8, 15, tzinfo=timezone.utc), "skip")
+    assert not runs_now
+    assert db.from_epoch_ms(task["next_run"]) == datetime(2025, 3, 1, 12, 15, tzinfo=timezone.utc)
+    assert [r["status"] for r in log] == ["skipped"]
+
+
+def test_skip_moves_cron_task_past_now(run_db, db_path):
+    runs_now, task, _ = run_db(_misfire, db_path, "cron", "0 9 * * *", datetime(2025, 2, 27, 9, tzinfo=timezone.utc), "skip")
+    assert not runs_now
+    assert db.from_epoch_ms(task["next_run"]) == datetime(2025, 3, 2, 9, tzinfo=timezone.utc)
+
+
+def test_skip_retires_a_missed_one_off_task(run_db, db_path):
+    runs_now, task, _ = run_db(_misfire, db_path, "once", "2025-03-01T09:00:00+00:00", datetime(2025, 3, 1, 9, tzinfo=timezone.utc), "skip")
+    assert not runs_now
+    assert (task["next_run"], task["status"]) == (None, "missed")
+
+
+def test_once_runs_now_without_moving_the_slot(run_db, db_path):
+    missed = datetime(2025, 3, 1, 8, tzinfo=timezone.utc)
+    runs_now, task, log = run_db(_misfire, db_path, "interval", _HOUR_MS, missed, "once")
+    assert runs_now and log == []
+    assert db.from_epoch_ms(task["next_run"]) == missed
+
+
+def test_all_rewinds_to_the_last_misfire_max_slots(run_db, db_path):
+    # Slots 00:00 .. 12:00 were missed (13 of them); only the last 3 are replayed.
+    runs_now, task, _ = run_db(_misfire, db_path, "interval", _HOUR_MS, datetime(2025, 3, 1, 0, tzinfo=timezone.utc), "all", 3)
+    assert runs_now
+    assert db.from_epoch_ms(task["next_run"]) == datetime(2025, 3, 1, 10, tzinfo=timezone.utc)
+
+
+def test_all_within_cap_replays_from_the_first_missed_slot(run_db, db_path):
+    first = datetime(2025, 3, 1, 10, tzinfo=timezone.utc)
+    runs_now, task, _ = run_db(_misfire, db_path, "interval", _HOUR_MS, first, "all", 5)
+    assert runs_now
+    assert db.from_epoch_ms(task["next_run"]) == first
+
+
+def test_catch_up_start_for_cron():
+    task = {"schedule_type": "cron", "schedule_value": "0 * * * *", "next_run": db.to_epoch_ms(_NOW - timedelta(hours=6, seconds=30)), "misfire_max": 2}
+    assert scheduler._catch_up_start(task, _NOW) == datetime(2025, 3, 1, 11, tzinfo=timezone.utc)
+
+
+def test_pausing_a_task_in_its_jitter_window_forgets_the_jitter(run_db, db_path, monkeypatch):
+    monkeypatch.setattr(scheduler, "MISFIRE_JITTER", 30)
+    timer = scheduler.NextRunTimer(scheduler.TaskExecutor(None, db_path, 1), 60)
+    monkeypatch.setattr(db, "_task_listeners", [timer.update])
+    missed = datetime(2025, 3, 1, 8, tzinfo=timezone.utc)
+
+    async def scenario():
+        task_id = await db.create_task(db_path, 1, "p", "interval", _HOUR_MS, db.to_epoch_ms(missed), "once")
+        [task] = await db.get_tasks(db_path, [task_id])
+        deferred = not await timer._handle_misfire(task, _NOW)
+        jittered = task_id in timer._jittered
+        await db.update_task_status(db_path, task_id, "paused")
+        after_pause = task_id in timer._jittered
+        await db.update_task_status(db_path, task_id, "active")
+        # Late again after the resume: it is jittered anew, not run at once on the stale entry.
+        [task] = await db.get_tasks(db_path, [task_id])
+        runs_now = await timer._handle_misfire(task, _NOW)
+        return deferred, jittered, after_pause, runs_now
+
+    deferred, jittered, after_pause, runs_now = run_db(scenario)
+    assert deferred and jittered
+    assert not after_pause
+    assert not runs_now
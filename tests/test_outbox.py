@@ -0,0 +1,132 @@
+import asyncio
+import os
+import subprocess
+import sys
+from datetime import timedelta
+from pathlib import Path
+
+import pytest
+from telegram.error import RetryAfter
+
+from nanoclaw import outbox
+from nanoclaw.outbox import Outbox, split_message
+
+_SRC = str(Path(__file__).resolve().parents[1] / "src")
+
+
+class _Bot:
+    def __init__(self) -> None:
+        self.sent: list[tuple[int, str]] = []
+
+    async def send_message(self, chat_id: int, text: str) -> str:
+        self.sent.append((chat_id, text))
+        return text
+
+
+def _fast_outbox() -> Outbox:
+    return Outbox(global_rate=10_000, chat_rate=10_000)
+
+
+def test_split_message_prefers_paragraph_then_line_then_word_breaks():
+    assert split_message("short", limit=10) == ["short"]
+    assert split_message("", limit=10) == [""]
+    assert split_message("aaaaaa\n\nbbbb\ncc", limit=10) == ["aaaaaa", "bbbb\ncc"]
+    assert split_message("aaaaaa\nbbbb cc", limit=10) == ["aaaaaa", "bbbb cc"]
+    assert split_message("aaaaaa bbbbbbb", limit=10) == ["aaaaaa", "bbbbbbb"]
+    # No break past the middle of the window: cut hard.
+    assert split_message("a b" + "c" * 15, limit=10) == ["a bccccccc", "cccccccc"]
+    chunks = split_message(("word " * 2000).strip())
+    assert all(len(c) <= outbox.TELEGRAM_MAX_LENGTH for c in chunks)
+    assert " ".join(chunks) == ("word " * 2000).strip()
+
+
+def test_sends_queued_back_to_back_share_one_message():
+    bot = _Bot()
+    box = _fast_outbox()
+
+    async def scenario():
+        results = await asyncio.gather(box.send(bot, 1, "one"), box.send(bot, 1, "two"), box.send(bot, 1, "three"), box.send(bot, 2, "other"))
+        await box.close()
+        return results
+
+    results = asyncio.run(scenario())
+    assert sorted(bot.sent) == [(1, "one\n\ntwo\n\nthree"), (2, "other")]
+    assert results[:3] == [["one\n\ntwo\n\nthree"]] * 3
+
+
+def test_sends_too_long_to_merge_go_out_separately():
+    bot = _Bot()
+    box = _fast_outbox()
+    long = "x" * (outbox.TELEGRAM_MAX_LENGTH - 5)
+
+    async def scenario():
+        await asyncio.gather(box.send(bot, 1, long), box.send(bot, 1, "tail"))
+        await box.close()
+
+    asyncio.run(scenario())
+    assert bot.sent == [(1, long), (1, "tail")]
+
+
+def test_retry_after_waits_and_retries():
+    calls = []
+
+    async def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise RetryAfter(timedelta(0))
+        return "ok"
+
+    async def scenario():
+        box = _fast_outbox()
+        result = await box.call(1, "edit_message_text", flaky)
+        await box.close()
+        return result
+
+    assert asyncio.run(scenario()) == "ok"
+    assert len(calls) == 3
+
+
+def test_retry_after_gives_up_after_the_last_attempt():
+    calls = []
+
+    async def flooded():
+        calls.append(1)
+        raise RetryAfter(timedelta(0))
+
+    async def scenario():
+        box = _fast_outbox()
+        with pytest.raises(RetryAfter):
+            await box.call(1, "send_message", flooded)
+        # The chat's queue keeps working after a dropped call.
+        assert await box.call(1, "send_message", lambda: asyncio.sleep(0, "next")) == "next"
+        await box.close()
+
+    asyncio.run(scenario())
+    assert len(calls) == outbox._MAX_ATTEMPTS
+
+
+def test_idle_chats_buckets_are_dropped_once_refilled():
+    bot = _Bot()
+
+    async def scenario():
+        box = Outbox(global_rate=10_000, chat_rate=1_000)
+        for chat_id in range(50):
+            await box.send(bot, chat_id, "hi")
+        # Every bucket refills in 3 ms; the next finished send sweeps them.
+        await asyncio.sleep(0.01)
+        await box.send(bot, 99, "hi")
+        await box.close()
+        return box
+
+    box = asyncio.run(scenario())
+    assert list(box._buckets) == [99]
+    assert len(bot.sent) == 51
+
+
+@pytest.mark.parametrize("var", ["TELEGRAM_CHAT_RATE", "TELEGRAM_GLOBAL_RATE"])
+@pytest.mark.parametrize("value", ["0", "-1"])
+def test_non_positive_rates_are_rejected(var, value):
+    env = {**os.environ, "PYTHONPATH": _SRC, var: value}
+    proc = subprocess.run([sys.executable, "-c", "import nanoclaw.config"], env=env, capture_output=True, text=True)
+    assert proc.returncode != 0
+    assert f"ValueError: {var} must be greater than 0" in proc.stderr
@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+
+from nanoclaw import pool
+
+
+class _Client:
+    """Stands in for ClaudeSDKClient; `hung` clients never answer control requests."""
+
+    hung: set[int] = set()
+    connected: list["_Client"] = []
+
+    def __init__(self, options=None) -> None:
+        self.options = options
+        self.disconnected = False
+
+    async def connect(self) -> None:
+        _Client.connected.append(self)
+
+    async def query(self, prompt: str) -> None:
+        self.prompt = prompt
+
+    async def receive_response(self):
+        yield f"reply to {self.prompt}"
+
+    async def get_mcp_status(self) -> dict:
+        if self.options in _Client.hung:
+            await asyncio.sleep(3600)
+        return {"mcpServers": []}
+
+    async def disconnect(self) -> None:
+        self.disconnected = True
+
+
+@pytest.fixture(autouse=True)
+def fake_client(monkeypatch):
+    _Client.hung, _Client.connected = set(), []
+    monkeypatch.setattr(pool, "ClaudeSDKClient", _Client)
+
+
+async def _turn(agents: pool.AgentPool, key, options) -> pool.WarmAgent:
+    agent = await agents.get(key, lambda: options)
+    assert [m async for m in agent.run("hi")] == ["reply to hi"]
+    return agent
+
+
+def test_wedged_agent_is_replaced():
+    async def main():
+        agents = pool.AgentPool(4, idle_timeout=60, ping_timeout=0.05)
+        first = await _turn(agents, (1, "chat"), 1)
+        assert await _turn(agents, (1, "chat"), 1) is first
+
+        _Client.hung.add(1)
+        second = await agents.get((1, "chat"), lambda: 2)
+        assert second is not first
+        await first.wait_closed()
+        assert not first.alive and _Client.connected[0].disconnected
+        await _turn(agents, (1, "chat"), 2)
+        await agents.close()
+
+    asyncio.run(main())
+
+
+def test_trim_closes_least_recently_used_idle_agents():
+    async def main():
+        agents = pool.AgentPool(4, idle_timeout=60)
+        for chat_id in (1, 2, 3):
+            await _turn(agents, (chat_id, "chat"), chat_id)
+        agents.trim(1, keep=(1, "chat"))
+        await asyncio.sleep(0)
+        assert sorted(key for key, a in agents._agents.items()) == [(1, "chat"), (3, "chat")]
+        await agents.close()
+
+    asyncio.run(main())
@@ -0,0 +1,41 @@
+import asyncio
+import sqlite3
+
+from nanoclaw import response_cache
+
+
+def test_chats_with_the_same_prompt_do_not_share_entries(tmp_path):
+    cache = response_cache.ResponseCache(tmp_path / "response_cache.db", max_entries=10)
+
+    async def scenario():
+        (tmp_path / "a").mkdir()
+        (tmp_path / "b").mkdir()
+        key_a = await response_cache.cache_key(1, "daily briefing", [], tmp_path / "a")
+        key_b = await response_cache.cache_key(2, "daily briefing", [], tmp_path / "b")
+        await cache.put(key_a, 1, "task-a", ["chat 1's briefing"], 0.5, ttl=60)
+        try:
+            return key_a, key_b, await cache.get(key_b, 2), await cache.get(key_a, 2), await cache.get(key_a, 1)
+        finally:
+            await cache.close()
+
+    key_a, key_b, other_key, other_chat, own = asyncio.run(scenario())
+    assert key_a != key_b
+    assert other_key is None
+    assert other_chat is None
+    assert own == (["chat 1's briefing"], 0.5)
+
+
+def test_entries_from_before_chat_scoping_are_dropped(tmp_path):
+    path = tmp_path / "response_cache.db"
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE response_cache (key TEXT PRIMARY KEY, task_id TEXT NOT NULL, messages TEXT NOT NULL)")
+        conn.execute("INSERT INTO response_cache VALUES ('k', 't', '[]')")
+    cache = response_cache.ResponseCache(path, max_entries=10)
+
+    async def scenario():
+        try:
+            return await cache.stats()
+        finally:
+            await cache.close()
+
+    assert asyncio.run(scenario())["entries"] == 0
@@ -0,0 +1,86 @@
+import random
+
+from nanoclaw import db
+
+_DAY = "2025-03-01"
+
+
+async def _log(db_path: str, runs: list[tuple[str, str, int, str]]) -> None:
+    """Insert (task_id, run_at, duration_ms, status) rows."""
+    async with db._write(db_path) as conn:
+        await conn.executemany("INSERT INTO task_run_logs (task_id, run_at, duration_ms, status) VALUES (?, ?, ?, ?)", runs)
+
+
+async def _rollups_and_stats(db_path: str, task_ids: list[str]) -> list[tuple[dict, dict]]:
+    await db.rollup_task_runs(db_path, "2025-03-02")
+    stats = {s["task_id"]: s for s in await db.get_task_stats(db_path, _DAY)}
+    return [((await db.get_task_rollups(db_path, t))[0], stats[t]) for t in task_ids]
+
+
+def _assert_matches(rollup: dict, stats: dict) -> None:
+    assert (rollup["run_count"], rollup["error_count"], rollup["skipped_count"]) == (stats["runs"], stats["errors"], stats["skipped"])
+    assert (rollup["p50_ms"], rollup["p95_ms"]) == (stats["p50_ms"], stats["p95_ms"])
+
+
+def test_skipped_runs_are_counted_but_not_timed(run_db, db_path):
+    async def scenario():
+        outcomes = [(100, "success"), (200, "success"), (0, "skipped"), (0, "skipped"), (0, "skipped")]
+        runs = [("t1", f"{_DAY}T0{i}:00:00+00:00", ms, status) for i, (ms, status) in enumerate(outcomes)]
+        await _log(db_path, runs)
+        return await _rollups_and_stats(db_path, ["t1"])
+
+    [(rollup, stats)] = run_db(scenario)
+    assert (rollup["run_count"], rollup["skipped_count"], rollup["p50_ms"], rollup["p95_ms"]) == (5, 3, 100, 200)
+    _assert_matches(rollup, stats)
+
+
+def test_day_of_only_skipped_runs_has_no_percentiles(run_db, db_path):
+    async def scenario():
+        await _log(db_path, [("t1", f"{_DAY}T01:00:00+00:00", 0, "skipped"), ("t1", f"{_DAY}T02:00:00+00:00", 0, "skipped")])
+        return await _rollups_and_stats(db_path, ["t1"])
+
+    [(rollup, stats)] = run_db(scenario)
+    assert (rollup["run_count"], rollup["skipped_count"], rollup["p50_ms"]) == (2, 2, None)
+    _assert_matches(rollup, stats)
+
+
+def test_rollups_match_raw_stats(run_db, db_path):
+    rng = random.Random(9)
+    task_ids = [f"t{i}" for i in range(20)]
+    runs = []
+    for task_id in task_ids:
+        for _ in range(rng.randint(1, 60)):
+            status = rng.choices(["success", "error", "cached", "skipped"], [70, 10, 10, 10])[0]
+            at = f"{_DAY}T{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d}.{rng.randint(0, 999999):06d}+00:00"
+            runs.append((task_id, at, 0 if status == "skipped" else rng.randint(1, 90_000), status))
+
+    async def scenario():
+        await _log(db_path, runs)
+        return await _rollups_and_stats(db_path, task_ids)
+
+    for rollup, stats in run_db(scenario):
+        _assert_matches(rollup, stats)
+
+
+def test_today_is_not_rolled_up_and_rollups_survive_pruning(run_db, db_path):
+    async def scenario():
+        await _log(db_path, [("t1", f"{_DAY}T01:00:00+00:00", 50, "success"), ("t1", "2025-03-02T01:00:00+00:00", 70, "success")])
+        assert await db.rollup_task_runs(db_path, "2025-03-02") == 1
+        assert await db.rollup_task_runs(db_path, "2025-03-02") == 0
+        assert (await db.prune_task_runs(db_path, "2025-03-02", max_age_days=1, max_rows_per_task=1000))[0] == 1
+        return await db.get_task_rollups(db_path, "t1")
+
+    [rollup] = run_db(scenario)
+    assert (rollup["day"], rollup["run_count"], rollup["p50_ms"]) == (_DAY, 1, 50)
+
+
+def test_rollup_ignores_days_already_rolled_up(run_db, db_path):
+    async def scenario():
+        await _log(db_path, [("t1", f"{_DAY}T01:00:00+00:00", 50, "success")])
+        await db.rollup_task_runs(db_path, "2025-03-02")
+        await _log(db_path, [("t1", f"{_DAY}T02:00:00+00:00", 80, "success")])
+        await db.rollup_task_runs(db_path, "2025-03-02")
+        return await db.get_task_rollups(db_path, "t1")
+
+    assert [r["run_count"] for r in run_db(scenario)] == [1]
+
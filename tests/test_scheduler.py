@@ -0,0 +1,205 @@
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from nanoclaw import db, scheduler
+
+_HOUR_MS = str(3600 * 1000)
+
+
+class _FakeRuns:
+    """Stands in for _execute_task: records start order and how many run at once."""
+
+    def __init__(self, seconds: float = 0.005) -> None:
+        self.seconds = seconds
+        self.started: list[str] = []
+        self.finished: list[str] = []
+        self.at: dict[str, float] = {}
+        self.running = 0
+        self.peak = 0
+
+    async def __call__(self, task, bot, db_path, owner) -> None:
+        self.started.append(task["id"])
+        self.at[task["id"]] = time.monotonic()
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        try:
+            await asyncio.sleep(self.seconds)
+        finally:
+            self.running -= 1
+            self.finished.append(task["id"])
+
+
+@pytest.fixture
+def runs(monkeypatch) -> _FakeRuns:
+    fake = _FakeRuns()
+    monkeypatch.setattr(scheduler, "_execute_task", fake)
+    return fake
+
+
+def _task(task_id: str, chat_id: int) -> dict:
+    return {"id": task_id, "chat_id": chat_id, "next_run": None}
+
+
+async def _until_idle(executor: scheduler.TaskExecutor) -> None:
+    while executor._running or executor._queues:
+        await asyncio.sleep(0.001)
+
+
+def test_a_flooding_chat_does_not_starve_another(run_db, db_path, runs):
+    async def scenario():
+        executor = scheduler.TaskExecutor(None, db_path, concurrency=1)
+        for i in range(10):
+            executor.submit(_task(f"flood-{i}", 1))
+        executor.submit(_task("quiet", 2))
+        await _until_idle(executor)
+        await executor.stop()
+
+    run_db(scenario)
+    # The quiet chat's task gets the next turn, not a place after the flooding chat's backlog.
+    assert runs.started[:4] == ["flood-0", "flood-1", "quiet", "flood-2"]
+    assert runs.finished.index("quiet") < runs.finished.index("flood-3")
+    assert sorted(runs.started) == sorted([f"flood-{i}" for i in range(10)] + ["quiet"])
+
+
+def test_chats_take_turns(run_db, db_path, runs):
+    async def scenario():
+        executor = scheduler.TaskExecutor(None, db_path, concurrency=1)
+        for i in range(3):
+            for chat_id in (1, 2, 3):
+                executor.submit(_task(f"{chat_id}-{i}", chat_id))
+        await _until_idle(executor)
+        await executor.stop()
+
+    run_db(scenario)
+    assert [t.split("-")[0] for t in runs.started] == ["1", "2", "3"] * 3
+
+
+def test_no_more_than_concurrency_tasks_run_at_once(run_db, db_path, runs):
+    async def scenario():
+        executor = scheduler.TaskExecutor(None, db_path, concurrency=3)
+        for i in range(12):
+            executor.submit(_task(f"t{i}", i % 4))
+        assert executor.stats()["running"] == 3
+        assert executor.stats()["queued"] == 9
+        await _until_idle(executor)
+        await executor.stop()
+
+    run_db(scenario)
+    assert runs.peak == 3
+    assert len(runs.finished) == 12
+
+
+def test_a_task_already_queued_or_running_is_not_submitted_twice(run_db, db_path, runs):
+    async def scenario():
+        executor = scheduler.TaskExecutor(None, db_path, concurrency=1)
+        first = executor.submit(_task("a", 1))
+        executor.submit(_task("b", 1))
+        # "a" is running and "b" queued: both are refused.
+        again = [executor.submit(_task("a", 1)), executor.submit(_task("b", 1))]
+        await _until_idle(executor)
+        # Once a run is over the task can be submitted for its next run.
+        after = executor.submit(_task("a", 1))
+        await _until_idle(executor)
+        await executor.stop()
+        return first, again, after
+
+    first, again, after = run_db(scenario)
+    assert (first, again, after) == (True, [False, False], True)
+    assert runs.started == ["a", "b", "a"]
+
+
+async def _started(runs: _FakeRuns, count: int, timeout: float = 2.0) -> None:
+    deadline = time.monotonic() + timeout
+    while len(runs.started) < count and time.monotonic() < deadline:
+        await asyncio.sleep(0.005)
+
+
+async def _in(db_path: str, seconds: float) -> str:
+    """A new task due `seconds` from now."""
+    return await db.create_task(db_path, 1, "p", "interval", _HOUR_MS, db.now_ms() + int(seconds * 1000))
+
+
+@pytest.fixture
+def timer(db_path, monkeypatch) -> scheduler.NextRunTimer:
+    timer = scheduler.NextRunTimer(scheduler.TaskExecutor(None, db_path, 4), 60)
+    monkeypatch.setattr(db, "_task_listeners", [timer.update])
+    return timer
+
+
+async def _stop(timer: scheduler.NextRunTimer) -> None:
+    await timer.stop()
+    await timer.executor.stop()
+
+
+def test_timer_wakes_early_for_a_sooner_task(run_db, db_path, runs, timer):
+    async def scenario():
+        timer.start()
+        await asyncio.sleep(0.05)
+        added = time.monotonic()
+        late = await _in(db_path, 0.4)
+        # The timer is now asleep until `late`; a sooner task must cut that short.
+        soon = await _in(db_path, 0.05)
+        await _started(runs, 2)
+        await _stop(timer)
+        return added, late, soon
+
+    added, late, soon = run_db(scenario)
+    assert runs.started == [soon, late]
+    assert runs.at[soon] - added < 0.3
+    assert runs.at[late] - added >= 0.35
+
+
+def test_rescheduled_and_deleted_tasks_leave_entries_dropped_at_the_top(timer):
+    now = datetime.now(timezone.utc)
+    timer.update("a", db.to_epoch_ms(now + timedelta(seconds=1)))
+    timer.update("b", db.to_epoch_ms(now + timedelta(seconds=2)))
+    timer.update("a", db.to_epoch_ms(now + timedelta(seconds=3)))
+    timer.update("b", None)
+    assert len(timer._heap) == 3
+    assert timer._peek() == db.from_epoch_ms(db.to_epoch_ms(now + timedelta(seconds=3)))
+    assert len(timer._heap) == 1
+    assert timer._pop_due(now + timedelta(seconds=2)) == []
+    assert timer._pop_due(now + timedelta(seconds=5)) == ["a"]
+    assert timer._heap == [] and timer._deadlines == {}
+
+
+def test_rescheduled_and_deleted_tasks_fire_at_their_new_time_or_not_at_all(run_db, db_path, runs, timer):
+    async def scenario():
+        timer.start()
+        await asyncio.sleep(0.05)
+        added = time.monotonic()
+        moved = await _in(db_path, 0.05)
+        await db.set_task_next_run(db_path, moved, db.now_ms() + 300)
+        deleted = await _in(db_path, 0.1)
+        await db.delete_task(db_path, deleted)
+        await _started(runs, 1)
+        await asyncio.sleep(0.2)
+        await _stop(timer)
+        return added, moved
+
+    added, moved = run_db(scenario)
+    assert runs.started == [moved]
+    assert runs.at[moved] - added >= 0.25
+
+
+def test_sweep_picks_up_tasks_the_timer_was_not_told_about(run_db, db_path, runs, monkeypatch):
+    timer = scheduler.NextRunTimer(scheduler.TaskExecutor(None, db_path, 4), 0.1)
+    # Nothing notifies this timer, as for tasks written by another process.
+    monkeypatch.setattr(db, "_task_listeners", [])
+
+    async def scenario():
+        timer.start()
+        await asyncio.sleep(0.05)
+        unseen = await _in(db_path, 0)
+        abandoned = await _in(db_path, 0)
+        # Claimed by a scheduler that died: its lease has already run out.
+        await db.claim_tasks(db_path, [abandoned], "elsewhere", -1)
+        await _started(runs, 2)
+        await _stop(timer)
+        return unseen, abandoned
+
+    unseen, abandoned = run_db(scenario)
+    assert sorted(runs.started) == sorted([unseen, abandoned])
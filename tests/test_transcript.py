@@ -0,0 +1,112 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from nanoclaw import agent, config, db, scheduler, transcript
+
+
+@pytest.fixture(autouse=True)
+def blob_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(transcript, "BASE_DIR", tmp_path)
+    monkeypatch.setattr(transcript, "BLOB_DIR", tmp_path / "blobs")
+    return tmp_path / "blobs"
+
+
+async def _collect(blocks: list[str], result: str | None = None, budget: int = 400) -> transcript.TranscriptCollector:
+    collector = transcript.TranscriptCollector(budget)
+    for block in blocks:
+        await collector.add(block)
+    await collector.add_result(result)
+    return collector
+
+
+def _spilled(text: str) -> str:
+    async def run():
+        return await (await _collect([text[i : i + 100] for i in range(0, len(text), 100)])).finish()
+
+    return asyncio.run(run())
+
+
+def test_long_output_is_stored_capped_but_read_back_in_full():
+    text = "".join(f"line {i}\n" for i in range(500))
+
+    async def run():
+        collector = await _collect([text[i : i + 100] for i in range(0, len(text), 100)])
+        return await collector.finish(), await collector.full_text()
+
+    record, full = asyncio.run(run())
+    assert len(record) <= 400
+    assert full == text
+    [digest] = transcript.blob_refs([record])
+    assert transcript.blob_path(digest).read_text() == text
+
+
+def test_result_longer_than_the_budget_is_not_added_twice():
+    reply = "".join(f"paragraph {i}\n\n" for i in range(4000))
+
+    async def run():
+        collector = await _collect(["Let me check.", reply], result=reply, budget=32_000)
+        await collector.finish()
+        return await collector.full_text()
+
+    assert len(reply) > 32_000
+    assert asyncio.run(run()) == "Let me check." + reply
+
+
+async def _old_run(db_path: str, record: str) -> None:
+    """Log a task run from long ago whose result is `record`, as the scheduler does."""
+    await db.log_task_run(db_path, "t1", 1, "success", result=record, blobs=transcript.blob_refs([record]))
+    async with db._write(db_path) as conn:
+        await conn.execute("UPDATE task_run_logs SET run_at = '2025-03-01T00:00:00+00:00'")
+
+
+def test_retention_deletes_blobs_once_their_last_owner_is_pruned(run_db, db_path):
+    pruned_only, also_recent = _spilled("a" * 1000), _spilled("b" * 1000)
+    [orphan], [kept] = transcript.blob_refs([pruned_only]), transcript.blob_refs([also_recent])
+
+    async def scenario():
+        await _old_run(db_path, pruned_only)
+        await _old_run(db_path, also_recent)
+        await db.log_task_run(db_path, "t1", 1, "success", result=also_recent, blobs=[kept])
+        await scheduler.run_retention(db_path)
+
+    run_db(scenario)
+    assert not transcript.blob_path(orphan).exists()
+    assert transcript.blob_path(kept).exists()
+
+
+def test_retention_keeps_blobs_a_sharded_chat_references(run_db, db_path, tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "MULTI_CHAT", True)
+    monkeypatch.setattr(config, "DB_SHARDING", True)
+    monkeypatch.setattr(config, "STORE_DIR", tmp_path / "store")
+    monkeypatch.setattr(agent, "DB_PATH", db_path)
+    chat_id = 42
+    shard = str(config.get_chat_db(chat_id))
+    assert shard != db_path
+
+    async def scenario():
+        # A session summary that spilled: its memory lives in the chat's shard.
+        summary = await _collect(["s" * 1000])
+        record = await summary.finish()
+        await db.upsert_memory(shard, chat_id, "session-summary", record, ["session"])
+        await agent._keep_blob(summary, chat_id)
+        # The same output also came out of a task run that is now pruned.
+        await _old_run(db_path, record)
+        await scheduler.run_retention(db_path)
+        return summary.blob_digest
+
+    digest = run_db(scenario)
+    assert transcript.blob_path(digest).exists()
+
+
+def test_stale_spill_files_are_removed(blob_dir):
+    blob_dir.mkdir()
+    stale, live = blob_dir / ".spill-old.txt", blob_dir / ".spill-new.txt"
+    stale.write_text("x")
+    live.write_text("y")
+    old = time.time() - 2 * 3600
+    os.utime(stale, (old, old))
+    assert transcript.remove_stale_spills() == 1
+    assert [p.name for p in blob_dir.iterdir()] == [".spill-new.txt"]
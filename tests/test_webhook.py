@@ -0,0 +1,113 @@
+import asyncio
+import json
+
+from nanoclaw import webhook
+
+_PATH = "/telegram/hook"
+_SECRET = "s3cret"
+_UPDATE = json.dumps({"update_id": 1, "message": {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"}, "text": "hi"}}).encode()
+
+
+def _request(method: str = "POST", path: str = _PATH, secret: str | None = _SECRET, body: bytes = _UPDATE, headers: dict[str, str] | None = None) -> bytes:
+    lines = [f"{method} {path} HTTP/1.1", "Host: localhost", f"Content-Length: {len(body)}"]
+    if secret is not None:
+        lines.append(f"X-Telegram-Bot-Api-Secret-Token: {secret}")
+    lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode() + body
+
+
+async def _response(reader: asyncio.StreamReader) -> tuple[int, dict[str, str]]:
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while (line := await reader.readline()) not in (b"\r\n", b""):
+        name, _, value = line.decode().partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return status, headers
+
+
+async def _server() -> tuple[webhook.WebhookServer, asyncio.Queue, int]:
+    queue: asyncio.Queue = asyncio.Queue()
+    server = webhook.WebhookServer(None, queue, _PATH, _SECRET)
+    await server.start("127.0.0.1", 0)
+    return server, queue, server._server.sockets[0].getsockname()[1]
+
+
+async def _status_of(payload: bytes) -> tuple[int, int]:
+    """Status of one request on a fresh connection, and the number of updates queued."""
+    server, queue, port = await _server()
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(payload)
+        await writer.drain()
+        status, _ = await _response(reader)
+        writer.close()
+        return status, queue.qsize()
+    finally:
+        await server.stop()
+
+
+def test_valid_update_is_queued():
+    assert asyncio.run(_status_of(_request())) == (200, 1)
+
+
+def test_wrong_or_missing_secret_is_forbidden():
+    assert asyncio.run(_status_of(_request(secret="wrong"))) == (403, 0)
+    assert asyncio.run(_status_of(_request(secret=None))) == (403, 0)
+
+
+def test_wrong_path_is_not_found():
+    assert asyncio.run(_status_of(_request(path="/other"))) == (404, 0)
+
+
+def test_get_is_not_allowed():
+    assert asyncio.run(_status_of(_request(method="GET", body=b""))) == (405, 0)
+
+
+def test_malformed_or_oversized_body_is_a_bad_request():
+    assert asyncio.run(_status_of(_request(body=b"{not json"))) == (400, 0)
+    oversized = _request(body=b"").replace(b"Content-Length: 0", f"Content-Length: {webhook._MAX_BODY + 1}".encode())
+    assert asyncio.run(_status_of(oversized)) == (400, 0)
+
+
+def test_keep_alive_connection_carries_two_updates():
+    async def scenario():
+        server, queue, port = await _server()
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            results = []
+            for _ in range(2):
+                writer.write(_request())
+                await writer.drain()
+                results.append(await _response(reader))
+            writer.close()
+            return results, queue.qsize()
+        finally:
+            await server.stop()
+
+    results, queued = asyncio.run(scenario())
+    assert [(status, headers["connection"]) for status, headers in results] == [(200, "keep-alive"), (200, "keep-alive")]
+    assert queued == 2
+
+
+def test_stop_lets_an_in_flight_request_finish_and_closes_idle_connections():
+    async def scenario():
+        server, queue, port = await _server()
+        idle_reader, _ = await asyncio.open_connection("127.0.0.1", port)
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        payload = _request()
+        writer.write(payload[:-10])
+        await writer.drain()
+        await asyncio.sleep(0.05)
+        stopping = asyncio.create_task(server.stop())
+        await asyncio.sleep(0.05)
+        waited = not stopping.done()
+        writer.write(payload[-10:])
+        await writer.drain()
+        status, headers = await _response(reader)
+        await asyncio.wait_for(stopping, 5)
+        return waited, status, headers["connection"], queue.qsize(), await idle_reader.read()
+
+    waited, status, connection, queued, idle_rest = asyncio.run(scenario())
+    assert waited
+    assert (status, connection, queued) == (200, "close", 1)
+    assert idle_rest == b""